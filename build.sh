@@ -7,23 +7,23 @@ echo "🏗️ Building agentic platform containers for Azure..."
 
 # Build Agent Core
 echo "Building agent-core..."
-docker build -t ${REGISTRY}/agent-core:latest docker/agent-core/
+docker build -t ${REGISTRY}/agent-core:latest -f docker/agent-core/Dockerfile docker/
 
 # Build Azure MCP
 echo "Building azure-mcp..."
-docker build -t ${REGISTRY}/azure-mcp:latest docker/azure-mcp/
+docker build -t ${REGISTRY}/azure-mcp:latest -f docker/azure-mcp/Dockerfile docker/
 
 # Build Database MCP
 echo "Building database-mcp..."
-docker build -t ${REGISTRY}/database-mcp:latest docker/database-mcp/
+docker build -t ${REGISTRY}/database-mcp:latest -f docker/database-mcp/Dockerfile docker/
 
 # Build Custom MCP
 echo "Building custom-mcp..."
-docker build -t ${REGISTRY}/custom-mcp:latest docker/custom-mcp/
+docker build -t ${REGISTRY}/custom-mcp:latest -f docker/custom-mcp/Dockerfile docker/
 
 # Build K8s MCP
 echo "Building k8s-mcp..."
-docker build -t ${REGISTRY}/k8s-mcp:latest docker/k8s-mcp/
+docker build -t ${REGISTRY}/k8s-mcp:latest -f docker/k8s-mcp/Dockerfile docker/
 
 # Build Frontend
 echo "Building frontend..."
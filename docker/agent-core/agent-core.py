@@ -1,178 +1,286 @@
 #!/usr/bin/env python3
+import asyncio
+import functools
 import json
 import sys
 import os
-from openai import AzureOpenAI
-import requests
-from typing import Dict, List, Any
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from openai import AsyncAzureOpenAI
+from typing import Dict, List, Any, Tuple
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+from common import metrics, tracing
+from common.llm_cache import LLMCache
+from common.server import serve
+from jobs import JobRunner
+from llm_batch import BATCH_SLOT, OFFLINE, OfflineLLMQueue
+from llm_gateway import BATCH, PRIORITY, LLMGateway, ThrottledError
+from results import WorkflowResults
+from runtime import GROUP_CALLS, AgentRuntime, AsyncMCPClient, AsyncSingleFlight, ToolCatalog
+from workflows import WorkflowEngine, WorkflowRegistry
+
+SYSTEM_PROMPT = "You are an AI assistant that provides concise, helpful analysis and recommendations."
+
+AGENT_REQUESTS = metrics.counter('agent_requests', 'Agent core API requests', ('method', 'outcome'))
+AGENT_LATENCY = metrics.histogram('agent_request_duration_seconds', 'Agent core API latency', ('method',))
 
 class AgentCore:
     def __init__(self):
-        self.azure_openai = AzureOpenAI(
+        self.azure_openai = AsyncAzureOpenAI(
             api_key=os.getenv("AZURE_OPENAI_API_KEY"),
             api_version="2024-02-01",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            # Retries and Retry-After are handled by the gateway, across all callers
+            max_retries=0
         )
+        self.llm_gateway = LLMGateway()
         self.mcp_endpoints = {
             'azure': 'http://azure-mcp-service:80',
             'database': 'http://database-mcp-service:80',
             'custom': 'http://custom-mcp-service:80',
             'k8s': 'http://k8s-mcp-service.k8s-admin:80'
         }
+        # MCP_ENDPOINTS="name=url,..." adds servers or overrides the defaults
+        for entry in filter(None, os.getenv('MCP_ENDPOINTS', '').split(',')):
+            name, _, url = entry.partition('=')
+            self.mcp_endpoints[name.strip()] = url.strip()
+        self.mcp = AsyncMCPClient(self.mcp_endpoints)
+        self.runtime = AgentRuntime()
+        self.tools = ToolCatalog(self.mcp)
+        self.llm_cache = LLMCache.from_env()
+        # SQLite lookups and similarity scoring block, so they run off the loop
+        self._cache_pool = ThreadPoolExecutor(2, thread_name_prefix='agent-llm-cache')
+        self.llm_flight = AsyncSingleFlight()
+        self.llm_queue = OfflineLLMQueue.from_env()
+        self.offline_deadline = float(os.getenv('LLM_BATCH_DEADLINE_SECONDS', '86400'))
+        self.batch_concurrency = int(os.getenv('AGENT_BATCH_CONCURRENCY', '32'))
+        self.batch_max_concurrency = int(os.getenv('AGENT_BATCH_MAX_CONCURRENCY', '256'))
+        self.batch_max_items = int(os.getenv('AGENT_BATCH_MAX_ITEMS', '10000'))
+        self.batch_deadline = float(os.getenv('AGENT_BATCH_DEADLINE_SECONDS', '3600'))
+        self.workflows = WorkflowRegistry.load(self.mcp_endpoints)
+        self.engine = WorkflowEngine(self)
+        self.results = WorkflowResults()
+        self.pipeline_runs = OrderedDict()
+        self.pipeline_runs_lock = threading.Lock()
+        self.tools.start(self.runtime, on_update=self.check_workflow_tools)
+        self.jobs = JobRunner(self)
+        # Each long-poll holds an HTTP worker: keep waits short and let only a few wait at once
+        self.job_wait_max = float(os.getenv('AGENT_JOB_WAIT_MAX_SECONDS', '5'))
+        self.job_waiters = threading.BoundedSemaphore(int(os.getenv('AGENT_JOB_MAX_WAITERS', '4')))
+        self.jobs.start(self.runtime)
+    
+    def check_workflow_tools(self, server: str, tools: Dict):
+        """Warn about workflow steps calling tools the server does not list"""
+        for workflow in self.workflows.workflows.values():
+            for step in workflow.steps:
+                if step.server != server:
+                    continue
+                if step.tool not in tools:
+                    print(f"Workflow {workflow.name} step {step.id}: {server} has no tool {step.tool}")
+                elif workflow.cache_ttl and not self.tools.read_only(server, step.tool):
+                    print(f"Workflow {workflow.name} has cache_ttl but {server}.{step.tool} is not read-only;"
+                          f" its results will not be cached")
     
-    def call_mcp_tool(self, server: str, tool: str, args: Dict) -> Dict:
+    def cacheable(self, workflow) -> bool:
+        """Workflows with a cache_ttl, as long as every tool they call is read-only"""
+        return workflow.cache_ttl > 0 and all(
+            step.prompt is not None or self.tools.read_only(step.server, step.tool) for step in workflow.steps)
+    
+    async def call_mcp_tool(self, server: str, tool: str, args: Dict) -> Dict:
         """Call MCP server tool"""
-        url = self.mcp_endpoints.get(server)
-        if not url:
-            return {"error": f"Unknown MCP server: {server}"}
-        
-        payload = {
-            "method": "tools/call",
-            "params": {"name": tool, "arguments": args}
-        }
-        
+        if self.tools.knows(server) and not self.tools.tool(server, tool):
+            return {"error": f"Unknown tool {tool} on MCP server {server}"}
+        with tracing.span(f'mcp {server}/{tool}', kind='client', server=server, tool=tool) as span:
+            result = await self.mcp.call_tool(server, tool, args)
+            if span and 'error' in result:
+                span.set_error(str(result['error']))
+            return result
+    
+    async def call_mcp_tools(self, server: str, calls: List[Tuple[str, Dict]]) -> List[Dict]:
+        """Call several tools on one MCP server in a single batch request"""
+        with tracing.span(f'mcp {server}/batch', kind='client', server=server, calls=len(calls)):
+            return await self.mcp.call_tool_batch(server, calls)
+    
+    async def invoke_azure_openai(self, prompt: str, on_token=None) -> str:
+        """Invoke Azure OpenAI for reasoning.
+
+        With on_token, the completion is streamed and each content delta is
+        awaited through on_token as it arrives.
+        """
+        params = {"model": "gpt-4o-mini", "max_tokens": 200, "temperature": 0.7, "system": SYSTEM_PROMPT}
+        if self.llm_cache:
+            cached = await self._cache(self.llm_cache.get, prompt, **params)
+            if cached is not None:
+                metrics.LLM_REQUESTS.labels(params["model"], 'cache_hit').inc()
+                if on_token:
+                    await on_token(cached)
+                return cached
+        if on_token is None and self.llm_queue and OFFLINE.get():
+            result = await self.llm_queue.complete(prompt, params)
+            if self.llm_cache and isinstance(result, str) and not result.startswith("Azure OpenAI error:"):
+                await self._cache(self.llm_cache.put, prompt, result, **params)
+            return result
+        if on_token is None:
+            # Identical prompts in flight together (e.g. across a workflow batch) share one completion
+            if self.llm_flight.in_flight(prompt):
+                metrics.LLM_REQUESTS.labels(params["model"], 'coalesced').inc()
+            return await self.llm_flight.do(prompt, lambda: self._complete(prompt, params))
+        return await self._complete(prompt, params, on_token)
+    
+    async def _cache(self, method, *args, **kwargs):
+        """Await an LLMCache call made on the cache threads"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._cache_pool, functools.partial(method, *args, **kwargs))
+    
+    async def _complete(self, prompt: str, params: Dict, on_token=None):
+        """Completion text, an "Azure OpenAI error: ..." string, or a throttling error dict"""
+        tokens = self.engine.prompts.counter.count(params["system"] + prompt) + params["max_tokens"]
+        emitted = []
+        if on_token:
+            async def forward(text):
+                emitted.append(True)
+                await on_token(text)
         try:
-            response = requests.post(url, json=payload, timeout=30)
-            return response.json()
+            result = await self.llm_gateway.run(lambda: self._request(prompt, params, on_token and forward),
+                                                tokens, retryable=lambda: not emitted)
+            metrics.LLM_REQUESTS.labels(params["model"], 'ok').inc()
+        except ThrottledError as e:
+            metrics.LLM_REQUESTS.labels(params["model"], 'throttled').inc()
+            return e.to_dict()
         except Exception as e:
-            return {"error": str(e)}
+            metrics.LLM_REQUESTS.labels(params["model"], 'error').inc()
+            return f"Azure OpenAI error: {str(e)}"
+        if self.llm_cache and result:
+            await self._cache(self.llm_cache.put, prompt, result, **params)
+        return result
     
-    def invoke_azure_openai(self, prompt: str) -> str:
-        """Invoke Azure OpenAI for reasoning"""
-        try:
-            response = self.azure_openai.chat.completions.create(
-                model="gpt-4o-mini",
+    async def _request(self, prompt: str, params: Dict, on_token=None) -> Tuple[str, Any]:
+        """One chat completion call: (text, total tokens used if reported)"""
+        with metrics.upstream('azure_openai', 'chat_completions'):
+            response = await self.azure_openai.chat.completions.create(
+                model=params["model"],
                 messages=[
-                    {"role": "system", "content": "You are an AI assistant that provides concise, helpful analysis and recommendations."},
+                    {"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
-                max_tokens=200,
-                temperature=0.7
+                max_tokens=params["max_tokens"],
+                temperature=params["temperature"],
+                stream=bool(on_token)
             )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Azure OpenAI error: {str(e)}"
+            if on_token:
+                parts, used = [], None
+                async for chunk in response:
+                    # Usage only arrives on a final chunk when the API version reports it
+                    usage = getattr(chunk, 'usage', None)
+                    metrics.record_tokens(params["model"], usage)
+                    used = usage.total_tokens if usage else used
+                    # Azure sends a leading chunk with no choices (content filter results)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        await on_token(parts[-1])
+                return ''.join(parts), used
+            metrics.record_tokens(params["model"], response.usage)
+            return response.choices[0].message.content, response.usage.total_tokens if response.usage else None
     
-    def execute_workflow(self, workflow: Dict) -> Dict:
-        """Execute agentic workflow"""
-        task = workflow.get('task', '')
-        
-        if 'openai' in task.lower() or 'ai' in task.lower():
-            prompt = workflow.get('prompt', 'Hello from Agent Core!')
-            result = self.invoke_azure_openai(prompt)
-            return {'workflow': 'azure_openai_test', 'result': result}
-        
-        if 'blob' in task.lower() or 'storage' in task.lower():
-            result = self.call_mcp_tool('azure', 'list_blob_containers', {})
-            return {'workflow': 'blob_storage_list', 'result': result}
-        
-        if 'weather' in task.lower():
-            city = workflow.get('city', 'San Francisco')
-            # Multi-step workflow: Get weather -> Analyze -> Store
-            weather = self.call_mcp_tool('custom', 'get_weather', {'city': city})
-            analysis = self.invoke_azure_openai(f"Analyze this weather data and provide insights: {weather}")
-            storage = self.call_mcp_tool('custom', 'store_data', {
-                'key': f'weather_{city}',
-                'value': analysis
-            })
-            return {
-                'workflow': 'weather_analysis',
-                'steps': [
-                    {'step': 'get_weather', 'result': weather},
-                    {'step': 'ai_analysis', 'result': analysis},
-                    {'step': 'store_result', 'result': storage}
-                ]
-            }
-        
-        if 'database' in task.lower():
-            query = workflow.get('query', 'SELECT * FROM users')
-            result = self.call_mcp_tool('database', 'execute_query', {'query': query})
-            analysis = self.invoke_azure_openai(f"Analyze this database query result: {result}")
-            return {
-                'workflow': 'database_analysis',
-                'steps': [
-                    {'step': 'execute_query', 'result': result},
-                    {'step': 'ai_analysis', 'result': analysis}
-                ]
-            }
-        
-        if 'kubernetes' in task.lower() or 'k8s' in task.lower():
-            if 'scale' in task.lower():
-                deployment = workflow.get('deployment_name', 'agent-core')
-                replicas = workflow.get('replicas', 3)
-                result = self.call_mcp_tool('k8s', 'scale_deployment', {
-                    'deployment_name': deployment,
-                    'replicas': replicas
-                })
-                return {'workflow': 'k8s_scale', 'result': result}
-            elif 'status' in task.lower() or 'health' in task.lower():
-                result = self.call_mcp_tool('k8s', 'get_cluster_status', {})
-                analysis = self.invoke_azure_openai(f"Analyze this Kubernetes cluster status and provide recommendations: {result}")
-                return {
-                    'workflow': 'k8s_health_check',
-                    'steps': [
-                        {'step': 'get_status', 'result': result},
-                        {'step': 'ai_analysis', 'result': analysis}
-                    ]
-                }
-            elif 'pods' in task.lower():
-                namespace = workflow.get('namespace', 'default')
-                result = self.call_mcp_tool('k8s', 'list_pods', {'namespace': namespace})
-                return {'workflow': 'k8s_list_pods', 'result': result}
-            elif 'troubleshoot' in task.lower():
-                pod_name = workflow.get('pod_name')
-                if pod_name:
-                    result = self.call_mcp_tool('k8s', 'troubleshoot_pod', {'pod_name': pod_name})
-                    analysis = self.invoke_azure_openai(f"Provide troubleshooting recommendations for this pod: {result}")
-                    return {
-                        'workflow': 'k8s_troubleshoot',
-                        'steps': [
-                            {'step': 'analyze_pod', 'result': result},
-                            {'step': 'ai_recommendations', 'result': analysis}
-                        ]
-                    }
-                return {'error': 'pod_name required for troubleshooting'}
-            else:
-                result = self.call_mcp_tool('k8s', 'get_cluster_status', {})
-                return {'workflow': 'k8s_general', 'result': result}
+    async def execute_workflow(self, workflow: Dict, emit=None, idempotency_key: str = None) -> Dict:
+        """Execute agentic workflow, optionally emitting step and token events.
+
+        Repeats may be answered from the workflow result cache or, with an
+        idempotency key (argument or `idempotency_key` param), by the run that
+        first used the key; neither replays step events.
+        """
+        definition = self.workflows.resolve(workflow)
+        if not definition:
+            return {"error": "Unknown workflow"}
+        return await self.results.run(
+            definition, workflow, lambda: self.engine.run(definition, workflow, emit=emit),
+            self.cacheable(definition), idempotency_key or workflow.get('idempotency_key'),
+            self.offline_deadline if OFFLINE.get() else self.runtime.deadline)
+    
+    async def execute_batch(self, items: List, emit, concurrency: int = None, offline: bool = False) -> Dict:
+        """Run many workflows, emitting a 'result' event as each one finishes.
+
+        At most `concurrency` workflows run at once. While the batch runs,
+        tool calls from its workflows are grouped into MCP batch requests and
+        identical LLM prompts share one completion, queued behind interactive
+        LLM calls at the gateway. Every item has its own
+        deadline, and a failing item only affects its own result. With
+        offline (and LLM_BATCH_API set), LLM steps are answered by Azure
+        OpenAI batch jobs and items may take up to LLM_BATCH_DEADLINE_SECONDS;
+        an item waiting on a batch job gives up its slot meanwhile.
+        """
+        concurrency = max(1, min(int(concurrency or self.batch_concurrency), self.batch_max_concurrency))
+        slots = asyncio.Semaphore(concurrency)
+        GROUP_CALLS.set(True)
+        PRIORITY.set(BATCH)
+        offline = bool(offline and self.llm_queue)
+        OFFLINE.set(offline)
+        deadline = self.offline_deadline if offline else self.runtime.deadline
+        errors = 0
         
-        if 'data factory' in task.lower() or 'pipeline' in task.lower():
-            if 'start' in task.lower() or 'run' in task.lower():
-                pipeline_name = workflow.get('pipeline_name', 'sample-pipeline')
-                # Multi-step: Start pipeline -> Monitor -> Report
-                start_result = self.call_mcp_tool('azure', 'start_data_factory_pipeline', {'pipeline_name': pipeline_name})
-                
-                # Get initial status
-                status_result = self.call_mcp_tool('azure', 'get_pipeline_status', {
-                    'pipeline_name': pipeline_name
-                })
-                
-                # AI analysis of pipeline execution
-                analysis = self.invoke_azure_openai(f"Analyze this Data Factory pipeline execution: {status_result}")
-                
-                return {
-                    'workflow': 'data_factory_execution',
-                    'steps': [
-                        {'step': 'start_pipeline', 'result': start_result},
-                        {'step': 'check_status', 'result': status_result},
-                        {'step': 'ai_analysis', 'result': analysis}
-                    ]
-                }
-            else:
-                # List pipelines workflow
-                pipelines_result = self.call_mcp_tool('azure', 'list_data_factory_pipelines', {})
-                analysis = self.invoke_azure_openai(f"Analyze these Data Factory pipelines and suggest optimizations: {pipelines_result}")
-                
-                return {
-                    'workflow': 'data_factory_analysis',
-                    'steps': [
-                        {'step': 'list_pipelines', 'result': pipelines_result},
-                        {'step': 'ai_analysis', 'result': analysis}
-                    ]
-                }
+        async def run(index, item):
+            nonlocal errors
+            async with slots:
+                if offline:
+                    BATCH_SLOT.set(slots)
+                try:
+                    if not isinstance(item, dict):
+                        raise ValueError("Batch items must be objects")
+                    result = await asyncio.wait_for(self.execute_workflow(item), deadline)
+                except asyncio.TimeoutError:
+                    result = {"error": f"Workflow exceeded deadline of {deadline}s"}
+                except Exception as e:
+                    result = {"error": str(e)}
+            if isinstance(result, dict) and 'error' in result:
+                errors += 1
+            event = {"event": "result", "index": index, "result": result}
+            if isinstance(item, dict) and 'id' in item:
+                event["id"] = item["id"]
+            await emit(event)
         
-        return {"error": "Unknown workflow"}
+        await asyncio.gather(*(run(i, item) for i, item in enumerate(items)))
+        return {"total": len(items), "errors": errors}
+    
+    def job_status(self, job_id: str, known_version=None, wait_seconds=0) -> Dict:
+        """A background job, long-polled until its version moves past known_version"""
+        if not job_id:
+            return {"error": "job_id is required"}
+        try:
+            known_version = int(known_version) if known_version is not None else None
+            wait = max(0.0, min(float(wait_seconds or 0), self.job_wait_max))
+        except (TypeError, ValueError):
+            return {"error": "known_version and wait_seconds must be numbers"}
+        # With every long-poll slot taken, answer at once; the client polls again
+        waiting = bool(wait) and self.job_waiters.acquire(blocking=False)
+        try:
+            job = self.runtime.run(self.jobs.wait(job_id, known_version, wait if waiting else 0), wait + 5)
+        finally:
+            if waiting:
+                self.job_waiters.release()
+        return job if job is not None else {"error": f"Unknown job {job_id}"}
+    
+    def record_pipeline_event(self, event: Dict) -> Dict:
+        """Keep the latest state pushed by azure-mcp for each pipeline run.
+
+        Held in this pod's memory only: with several replicas each pod sees
+        the events the Service routed to it.
+        """
+        if not event.get('run_id'):
+            return {"error": "run_id is required"}
+        with self.pipeline_runs_lock:
+            current = self.pipeline_runs.get(event['run_id'])
+            # Callbacks can arrive out of order; never go back to an older version
+            if current is None or event.get('version', 0) >= current.get('version', 0):
+                self.pipeline_runs[event['run_id']] = event
+                self.pipeline_runs.move_to_end(event['run_id'])
+            while len(self.pipeline_runs) > 1000:
+                self.pipeline_runs.popitem(last=False)
+        return {"received": True}
 
 class AgentHandler(BaseHTTPRequestHandler):
     def __init__(self, agent_core, *args, **kwargs):
@@ -183,26 +291,170 @@ class AgentHandler(BaseHTTPRequestHandler):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
         
+        # Root of the trace unless the caller sent a traceparent
+        with tracing.span('agent request', kind='server', parent=tracing.extract(self.headers)) as span:
+            self.handle_post(post_data, span)
+    
+    def handle_post(self, post_data: bytes, span):
+        method, outcome = 'invalid', 'error'
+        start = time.perf_counter()
         try:
             request = json.loads(post_data.decode('utf-8'))
-            method = request.get('method')
+            method = str(request.get('method'))
+            if span:
+                span.name = method
             
-            if method == 'workflow/execute':
-                result = self.agent_core.execute_workflow(request.get('params', {}))
+            idempotency_key = request.get('idempotency_key') or self.headers.get('Idempotency-Key')
+            if method == 'workflow/execute' and request.get('stream'):
+                outcome = 'stream'
+                self.stream_workflow(request.get('params', {}), idempotency_key)
+                return
+            elif method == 'workflow/execute':
+                outcome = 'detached'
+                self.respond_later(method, start, self.agent_core.execute_workflow(
+                    request.get('params', {}), idempotency_key=idempotency_key))
+                return
+            elif method == 'workflow/batch':
+                params = request.get('params', {})
+                items = params.get('workflows')
+                if not isinstance(items, list) or not items:
+                    result = {"error": "workflows must be a non-empty list"}
+                elif len(items) > self.agent_core.batch_max_items:
+                    result = {"error": f"Batch exceeds {self.agent_core.batch_max_items} workflows"}
+                elif params.get('offline') and self.agent_core.llm_queue is not None:
+                    # Batch jobs take hours: hand back a job to poll instead of holding a stream open
+                    result = self.agent_core.jobs.submit_batch(items, params.get('concurrency'), idempotency_key)
+                else:
+                    outcome = 'stream'
+                    self.stream_events(
+                        lambda emit: self.agent_core.execute_batch(items, emit, params.get('concurrency')),
+                        self.agent_core.batch_deadline)
+                    return
+            elif method == 'workflow/submit':
+                result = self.agent_core.jobs.submit(request.get('params', {}), idempotency_key)
+            elif method == 'job/status':
+                params = request.get('params', {})
+                result = self.agent_core.job_status(params.get('job_id'), params.get('known_version'),
+                                                    params.get('wait_seconds'))
+            elif method == 'pipeline/run_event':
+                result = self.agent_core.record_pipeline_event(request.get('params', {}))
             else:
                 result = {"error": "Unknown method"}
+            outcome = metrics.request_outcome(result)
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
             self.wfile.write(json.dumps(result).encode('utf-8'))
+        except TimeoutError:
+            outcome = 'timeout'
+            self.send_response(504)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({
+                "error": f"Workflow exceeded deadline of {self.agent_core.runtime.deadline}s"
+            }).encode('utf-8'))
         except Exception as e:
             self.send_response(500)
             self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
             self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
+        finally:
+            if span and outcome in ('error', 'timeout'):
+                span.set_error(outcome)
+            if outcome != 'detached':
+                AGENT_REQUESTS.labels(method, outcome).inc()
+                AGENT_LATENCY.labels(method).observe(time.perf_counter() - start)
+    
+    def respond_later(self, method: str, start: float, coro):
+        """Answer once coro finishes on the runtime loop; this worker moves on meanwhile"""
+        connection = self.connection
+        deadline = self.agent_core.runtime.deadline
+        
+        async def traced():
+            # The request span ends when the worker returns; this one covers the run
+            with tracing.span(f'{method} run') as span:
+                result = await coro
+                if span and isinstance(result, dict) and 'error' in result:
+                    span.set_error(str(result['error']))
+                return result
+        
+        def done(future):
+            outcome = 'error'
+            try:
+                status, result = 200, future.result()
+                outcome = metrics.request_outcome(result)
+            except TimeoutError:
+                outcome, status = 'timeout', 504
+                result = {"error": f"Workflow exceeded deadline of {deadline}s"}
+            except Exception as e:
+                status, result = 500, {"error": str(e)}
+            body = json.dumps(result).encode('utf-8')
+            head = (f"{self.protocol_version} {status} {self.responses[status][0]}\r\n"
+                    f"Content-type: application/json\r\n"
+                    f"Access-Control-Allow-Origin: *\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: close\r\n\r\n")
+            self.server.send_detached(connection, head.encode('latin-1') + body)
+            AGENT_REQUESTS.labels(method, outcome).inc()
+            AGENT_LATENCY.labels(method).observe(time.perf_counter() - start)
+        
+        self.server.detach()
+        self.agent_core.runtime.submit(traced()).add_done_callback(done)
+    
+    def stream_workflow(self, params: Dict, idempotency_key: str = None):
+        """Stream step results and LLM tokens as they are produced"""
+        self.stream_events(lambda emit: self.agent_core.execute_workflow(params, emit, idempotency_key))
+    
+    def stream_events(self, start, deadline: float = None):
+        """Write the events emitted by start(emit), then its result as 'done'.
+
+        Sends Server-Sent Events when the client accepts text/event-stream,
+        NDJSON otherwise. The body ends when the connection closes.
+        """
+        sse = 'text/event-stream' in self.headers.get('Accept', '')
+        events = queue.Queue()
+        deadline = deadline or self.agent_core.runtime.deadline
+        
+        async def emit(event):
+            events.put(event)
+        
+        future = self.agent_core.runtime.submit(start(emit), deadline)
+        future.add_done_callback(lambda _: events.put(None))
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream' if sse else 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                self.write_event(event, sse)
+            try:
+                self.write_event({"event": "done", "result": future.result()}, sse)
+            except TimeoutError:
+                self.write_event({"event": "error", "error": f"Workflow exceeded deadline of {deadline}s"}, sse)
+            except Exception as e:
+                self.write_event({"event": "error", "error": str(e)}, sse)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away; stop spending MCP and LLM calls on it
+            future.cancel()
+    
+    def write_event(self, event: Dict, sse: bool):
+        data = json.dumps(event)
+        if sse:
+            self.wfile.write(f"event: {event['event']}\ndata: {data}\n\n".encode('utf-8'))
+        else:
+            self.wfile.write(f"{data}\n".encode('utf-8'))
+        self.wfile.flush()
     
     def do_GET(self):
         if self.path == '/health':
@@ -211,24 +463,77 @@ class AgentHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(b'OK')
         elif self.path == '/metrics':
-            # Simple Prometheus metrics
-            metrics = '''# HELP agent_core_requests_total Total requests processed
-# TYPE agent_core_requests_total counter
-agent_core_requests_total 42
-# HELP agent_core_active_workflows Active workflows
-# TYPE agent_core_active_workflows gauge
-agent_core_active_workflows 3
-'''
             self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
+            self.send_header('Content-type', metrics.CONTENT_TYPE)
+            self.end_headers()
+            self.wfile.write(metrics.REGISTRY.render().encode('utf-8'))
+        elif self.path == '/llm/cache':
+            stats = self.agent_core.llm_cache.stats() if self.agent_core.llm_cache else {"enabled": False}
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(stats).encode('utf-8'))
+        elif self.path == '/workflow/cache':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.agent_core.results.stats()).encode('utf-8'))
+        elif self.path == '/llm/gateway':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.agent_core.llm_gateway.stats()).encode('utf-8'))
+        elif self.path == '/llm/batches':
+            llm_queue = self.agent_core.llm_queue
+            stats = self.agent_core.runtime.call(llm_queue.stats) if llm_queue else {"enabled": False}
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(stats).encode('utf-8'))
+        elif self.path == '/mcp/stats':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.agent_core.mcp.stats()).encode('utf-8'))
+        elif self.path == '/tools':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.agent_core.tools.snapshot()).encode('utf-8'))
+        elif self.path == '/jobs':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.agent_core.jobs.store.recent()).encode('utf-8'))
+        elif self.path.startswith('/jobs/'):
+            # /jobs/<id>?known_version=3&wait=20 long-polls for the next change
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            job = self.agent_core.job_status(url.path[len('/jobs/'):], query.get('known_version'),
+                                             query.get('wait'))
+            if 'job_id' in job:
+                self.send_response(200)
+            else:
+                self.send_response(404 if job['error'].startswith('Unknown job') else 400)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps(job).encode('utf-8'))
+        elif self.path == '/pipeline/runs':
+            with self.agent_core.pipeline_runs_lock:
+                runs = list(self.agent_core.pipeline_runs.values())
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            # Per-pod view; say which pod answered
+            self.send_header('X-Served-By', socket.gethostname())
             self.end_headers()
-            self.wfile.write(metrics.encode('utf-8'))
+            self.wfile.write(json.dumps(runs).encode('utf-8'))
     
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Idempotency-Key')
         self.end_headers()
 
 if __name__ == "__main__":
@@ -237,6 +542,4 @@ if __name__ == "__main__":
     def handler(*args, **kwargs):
         AgentHandler(agent, *args, **kwargs)
     
-    httpd = HTTPServer(('0.0.0.0', 8000), handler)
-    print("Agent Core running on port 8000")
-    httpd.serve_forever()
\ No newline at end of file
+    serve(handler, "Agent Core")
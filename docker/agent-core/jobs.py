@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from common import metrics
+from llm_gateway import BATCH, PRIORITY
+
+FINISHED = ('completed', 'failed')
+# Job "workflow" name of an offline workflow batch; not a valid workflow name
+BATCH_JOB = 'workflow/batch'
+
+JOBS_FINISHED = metrics.counter('agent_jobs_finished', 'Background workflow jobs finished', ('workflow', 'status'))
+JOBS_RESUMED = metrics.counter('agent_jobs_resumed', 'Background jobs resumed from checkpoints', ('workflow',))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT UNIQUE,
+    workflow TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS job_steps (
+    job_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    value TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    PRIMARY KEY (job_id, step)
+);
+"""
+
+
+class JobStore:
+    """Background jobs and their step checkpoints in a SQLite file.
+
+    A job is claimed by one process at a time through a lease that its
+    owner renews while it runs; a job whose lease ran out (its owner died)
+    can be claimed again and resumes from its checkpoints. Every change
+    bumps the job's version, which long-polling clients compare against.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('AGENT_JOBS_DB', '/data/agent-jobs.db')
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def create(self, workflow: str, params: Dict, idempotency_key: str = None) -> Tuple[Dict, bool]:
+        """(job, created); a known idempotency key returns its job instead.
+
+        Raises ValueError when the key was used for another workflow or params.
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            try:
+                self._db.execute(
+                    'INSERT INTO jobs (id, idempotency_key, workflow, params, status, created, updated)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, idempotency_key, workflow, json.dumps(params), 'queued', now, now))
+                created = True
+            except sqlite3.IntegrityError:
+                row = self._db.execute('SELECT id, workflow, params FROM jobs WHERE idempotency_key = ?',
+                                       (idempotency_key,)).fetchone()
+                if row['workflow'] != workflow or json.loads(row['params']) != json.loads(json.dumps(params)):
+                    raise ValueError("Idempotency key was already used with different params")
+                job_id, created = row['id'], False
+        return self.get(job_id), created
+
+    def claim(self, owner: str, lease: float) -> Optional[Dict]:
+        """Take the oldest queued job, or a running one whose owner's lease expired"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE status IN ('queued', 'running')"
+                    " AND (owner IS NULL OR lease_until < ?) ORDER BY created LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, attempts = attempts + 1,"
+                        " version = version + 1, updated = ? WHERE id = ?", (owner, now + lease, now, row['id']))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = dict(row)
+        job['attempts'] += 1
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def renew(self, owner: str, job_ids: List[str], lease: float):
+        if not job_ids:
+            return
+        with self._lock:
+            self._db.executemany('UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ?',
+                                 [(time.time() + lease, job_id, owner) for job_id in job_ids])
+
+    def release(self, owner: str):
+        """Make jobs left running by an earlier process of this owner claimable at once"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET owner = NULL WHERE owner = ? AND status = 'running'", (owner,))
+
+    def checkpoint(self, job_id: str, owner: str, step: str, value, outputs: Dict) -> bool:
+        """Record a finished step; False (and nothing written) once owner has lost the job"""
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                owned = self._db.execute(
+                    'UPDATE jobs SET version = version + 1, updated = ? WHERE id = ? AND owner = ?',
+                    (time.time(), job_id, owner)).rowcount
+                if owned:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO job_steps (job_id, step, value, outputs) VALUES (?, ?, ?, ?)',
+                        (job_id, step, json.dumps(value, default=str), json.dumps(outputs, default=str)))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return bool(owned)
+
+    def steps(self, job_id: str) -> Dict:
+        """Checkpointed steps as {step_id: (value, outputs)}"""
+        with self._lock:
+            rows = self._db.execute('SELECT step, value, outputs FROM job_steps WHERE job_id = ?',
+                                    (job_id,)).fetchall()
+        return {row['step']: (json.loads(row['value']), json.loads(row['outputs'])) for row in rows}
+
+    def finish(self, job_id: str, owner: str, status: str, result: Dict = None, error: str = None):
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, owner = NULL, lease_until = NULL,'
+                ' version = version + 1, updated = ? WHERE id = ? AND owner = ?',
+                (status, json.dumps(result, default=str) if result is not None else None, error, time.time(),
+                 job_id, owner))
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            steps = [r['step'] for r in self._db.execute(
+                'SELECT step FROM job_steps WHERE job_id = ? ORDER BY rowid', (job_id,)).fetchall()] if row else []
+        if row is None:
+            return None
+        job = {"job_id": row['id'], "workflow": row['workflow'], "status": row['status'],
+               "version": row['version'], "attempts": row['attempts'], "params": json.loads(row['params']),
+               "created": row['created'], "updated": row['updated'], "steps_done": steps}
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error'] is not None:
+            job['error'] = row['error']
+        return job
+
+    def recent(self, limit: int = 100) -> List[Dict]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id AS job_id, workflow, status, version, attempts, created, updated FROM jobs'
+                ' ORDER BY created DESC LIMIT ?', (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def prune(self, older_than: float):
+        """Delete finished jobs last updated before older_than"""
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute(
+                "DELETE FROM job_steps WHERE job_id IN (SELECT id FROM jobs WHERE status IN ('completed', 'failed')"
+                " AND updated < ?)", (older_than,))
+            self._db.execute("DELETE FROM jobs WHERE status IN ('completed', 'failed') AND updated < ?",
+                             (older_than,))
+            self._db.execute('COMMIT')
+
+
+class JobRunner:
+    """Runs submitted workflows in the background, checkpointing each step.
+
+    Up to AGENT_JOB_WORKERS jobs run at once on the runtime loop, at batch
+    priority for LLM calls, and their SQLite calls run on one store thread
+    rather than on the loop. Each attempt is bounded by
+    AGENT_JOB_DEADLINE_SECONDS; a job interrupted by a restart is picked up
+    again (by this pod once it is back, or by any process sharing the store
+    once the lease expires) and skips the steps it already checkpointed. A
+    step that was mid-call when the process died runs again.
+
+    An offline workflow batch is one job: each item's result is
+    checkpointed as it finishes, and the job's result lists them all.
+    """
+
+    def __init__(self, agent, store: JobStore = None):
+        self.agent = agent
+        self.store = store or JobStore()
+        self.workers = int(os.getenv('AGENT_JOB_WORKERS', '4'))
+        self.lease = float(os.getenv('AGENT_JOB_LEASE_SECONDS', '60'))
+        self.deadline = float(os.getenv('AGENT_JOB_DEADLINE_SECONDS', '3600'))
+        self.max_attempts = int(os.getenv('AGENT_JOB_MAX_ATTEMPTS', '3'))
+        self.poll_interval = float(os.getenv('AGENT_JOB_POLL_SECONDS', '5'))
+        self.retention = float(os.getenv('AGENT_JOB_RETENTION_SECONDS', '604800'))
+        self.owner = os.getenv('HOSTNAME') or socket.gethostname()
+        self.running = {}
+        self._changes = {}
+        self._waiting = {}
+        self._wakeup = asyncio.Event()
+        self._db = ThreadPoolExecutor(1, thread_name_prefix='agent-jobs-db')
+        self.loop = None
+        metrics.gauge('agent_jobs_running', 'Background jobs running in this process').set_function(
+            lambda: len(self.running))
+
+    def start(self, runtime):
+        self.loop = runtime.loop
+        self.store.release(self.owner)
+        return asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    def submit(self, params: Dict, idempotency_key: str = None) -> Dict:
+        """Queue a workflow run and return its job at once (thread-safe)"""
+        definition = self.agent.workflows.resolve(params)
+        if not definition:
+            return {"error": "Unknown workflow"}
+        return self._create(definition.name, params, idempotency_key)
+
+    def submit_batch(self, items: List, concurrency: int = None, idempotency_key: str = None) -> Dict:
+        """Queue workflows to run as an offline batch job (thread-safe)"""
+        return self._create(BATCH_JOB, {"workflows": items, "concurrency": concurrency}, idempotency_key)
+
+    def _create(self, workflow: str, params: Dict, idempotency_key: str = None) -> Dict:
+        try:
+            job, created = self.store.create(workflow, params, idempotency_key)
+        except ValueError as e:
+            return {"error": str(e)}
+        if created:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+        return {"job_id": job["job_id"], "workflow": job["workflow"], "status": job["status"],
+                "version": job["version"]}
+
+    async def _store(self, method, *args):
+        """Await a JobStore call made on the store thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._db, method, *args)
+
+    async def wait(self, job_id: str, known_version: int = None, timeout: float = 0) -> Optional[Dict]:
+        """The job once its version differs from known_version, it finishes, or timeout passes"""
+        end = time.monotonic() + timeout
+        while True:
+            job = await self._store(self.store.get, job_id)
+            remaining = end - time.monotonic()
+            if (job is None or known_version is None or job['version'] != known_version
+                    or job['status'] in FINISHED or remaining <= 0):
+                return job
+            event = self._changes.setdefault(job_id, asyncio.Event())
+            self._waiting[job_id] = self._waiting.get(job_id, 0) + 1
+            try:
+                # Jobs run by another process only show up in the store
+                await asyncio.wait_for(event.wait(), min(1.0, remaining))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # The last waiter drops the event, or polled jobs this runner never changes would pile up
+                self._waiting[job_id] -= 1
+                if not self._waiting[job_id]:
+                    del self._waiting[job_id]
+                    self._changes.pop(job_id, None)
+
+    def _changed(self, job_id: str):
+        event = self._changes.pop(job_id, None)
+        if event:
+            event.set()
+
+    async def _run(self):
+        pruned = 0
+        while True:
+            try:
+                while len(self.running) < self.workers:
+                    job = await self._store(self.store.claim, self.owner, self.lease)
+                    if job is None:
+                        break
+                    self.running[job['id']] = asyncio.ensure_future(self._execute(job))
+                await self._store(self.store.renew, self.owner, list(self.running), self.lease)
+                if time.time() - pruned > 3600:
+                    await self._store(self.store.prune, time.time() - self.retention)
+                    pruned = time.time()
+            except Exception as e:
+                print(f"Job scheduler error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_batch(self, job_id: str, params: Dict, checkpoint, restored: Dict) -> Dict:
+        """Run the items not yet checkpointed offline, checkpointing each result event"""
+        items = params['workflows']
+        todo = [index for index in range(len(items)) if f"item-{index}" not in restored]
+
+        async def emit(event):
+            event["index"] = todo[event["index"]]
+            await checkpoint(f"item-{event['index']}", event, {})
+
+        await self.agent.execute_batch([items[index] for index in todo], emit, params.get('concurrency'),
+                                       offline=True)
+        steps = await self._store(self.store.steps, job_id)
+        results = [steps[f"item-{index}"][0] for index in range(len(items)) if f"item-{index}" in steps]
+        errors = sum(1 for event in results if isinstance(event['result'], dict) and 'error' in event['result'])
+        return {"total": len(items), "errors": errors, "results": results}
+
+    async def _execute(self, job: Dict):
+        job_id, name = job['id'], job['workflow']
+        status, result, error = 'failed', None, None
+        deadline = self.deadline
+        PRIORITY.set(BATCH)
+        try:
+            definition = self.agent.workflows.workflows.get(name)
+            if definition is None and name != BATCH_JOB:
+                error = f"Workflow {name} no longer exists"
+            elif job['attempts'] > self.max_attempts:
+                error = f"Gave up after {self.max_attempts} attempts"
+            else:
+                restored = await self._store(self.store.steps, job_id)
+                if restored:
+                    JOBS_RESUMED.labels(name).inc()
+
+                async def checkpoint(step_id, value, outputs):
+                    if await self._store(self.store.checkpoint, job_id, self.owner, step_id, value, outputs):
+                        self._changed(job_id)
+
+                if definition is None:
+                    deadline = self.agent.offline_deadline
+                    run = self._run_batch(job_id, job['params'], checkpoint, restored)
+                else:
+                    deadline = self.deadline
+                    run = self.agent.engine.run(definition, job['params'], checkpoint=checkpoint,
+                                                restored=restored)
+                result = await asyncio.wait_for(run, deadline)
+                status = 'failed' if 'error' in result else 'completed'
+        except asyncio.TimeoutError:
+            error = f"Job exceeded deadline of {deadline}s"
+        except asyncio.CancelledError:
+            # Shutting down: leave the job running in the store to be resumed
+            self.running.pop(job_id, None)
+            raise
+        except Exception as e:
+            error = str(e)
+        await self._store(self.store.finish, job_id, self.owner, status, result, error)
+        JOBS_FINISHED.labels(name, status).inc()
+        self.running.pop(job_id, None)
+        self._changed(job_id)
+        self._wakeup.set()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+from typing import Dict, Optional
+
+from openai import AsyncAzureOpenAI
+
+from common import metrics
+
+# Set for non-interactive workflows: their LLM calls may wait for a batch job
+OFFLINE = contextvars.ContextVar('offline_llm', default=False)
+# The concurrency slot of the batch item being run, given up while it waits on a batch job
+BATCH_SLOT = contextvars.ContextVar('batch_slot', default=None)
+
+LLM_BATCH_REQUESTS = metrics.counter('llm_batch_requests', 'Prompts answered through batch jobs', ('outcome',))
+LLM_BATCH_JOBS = metrics.counter('llm_batch_jobs', 'Batch jobs by final status', ('status',))
+
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class AzureBatchAPI:
+    """Azure OpenAI global batch: JSONL upload, batch job, output file download"""
+
+    def __init__(self, client, completion_window: str = '24h'):
+        self.client = client
+        self.completion_window = completion_window
+
+    async def submit(self, jsonl: bytes) -> str:
+        with metrics.upstream('azure_openai', 'batch_submit'):
+            uploaded = await self.client.files.create(file=('analysis.jsonl', jsonl), purpose='batch')
+            batch = await self.client.batches.create(input_file_id=uploaded.id, endpoint='/chat/completions',
+                                                     completion_window=self.completion_window)
+        return batch.id
+
+    async def status(self, batch_id: str) -> Dict:
+        with metrics.upstream('azure_openai', 'batch_status'):
+            batch = await self.client.batches.retrieve(batch_id)
+        return {"status": batch.status, "output_file_id": batch.output_file_id,
+                "error_file_id": batch.error_file_id}
+
+    async def download(self, file_id: str) -> bytes:
+        with metrics.upstream('azure_openai', 'batch_download'):
+            content = await self.client.files.content(file_id)
+        return content.read()
+
+
+class StubBatchAPI:
+    """In-process stand-in for the batch API, for tests and local runs.
+
+    Jobs complete `latency` seconds after submission. Each line is answered
+    by `respond(body)`, which by default echoes the start of the prompt, and
+    lines whose prompt contains `fail_marker` come back as per-line errors.
+    """
+
+    def __init__(self, latency: float = 1.0, respond=None, fail_marker: str = '[fail]'):
+        self.latency = latency
+        self.respond = respond or (lambda body: f"Batch analysis: {body['messages'][-1]['content'][:80]}")
+        self.fail_marker = fail_marker
+        self.jobs = {}
+        self._ids = itertools.count(1)
+
+    async def submit(self, jsonl: bytes) -> str:
+        batch_id = f"batch_stub_{next(self._ids)}"
+        self.jobs[batch_id] = (time.monotonic() + self.latency, jsonl)
+        return batch_id
+
+    async def status(self, batch_id: str) -> Dict:
+        ready, _ = self.jobs[batch_id]
+        if time.monotonic() < ready:
+            return {"status": "in_progress", "output_file_id": None, "error_file_id": None}
+        return {"status": "completed", "output_file_id": batch_id, "error_file_id": None}
+
+    async def download(self, file_id: str) -> bytes:
+        lines = []
+        for line in self.jobs[file_id][1].splitlines():
+            request = json.loads(line)
+            body = request['body']
+            if self.fail_marker in body['messages'][-1]['content']:
+                lines.append({"custom_id": request['custom_id'], "response": None,
+                              "error": {"code": "stub_failure", "message": "Stub failed this line"}})
+                continue
+            content = self.respond(body)
+            lines.append({"custom_id": request['custom_id'], "error": None, "response": {
+                "status_code": 200,
+                "body": {"choices": [{"message": {"role": "assistant", "content": content}}],
+                         "usage": {"prompt_tokens": len(body['messages'][-1]['content']) // 4,
+                                   "completion_tokens": len(content) // 4}}
+            }})
+        return '\n'.join(json.dumps(line) for line in lines).encode('utf-8')
+
+
+class OfflineLLMQueue:
+    """Answers prompts through batch jobs instead of synchronous completions.
+
+    Prompts are collected for up to `flush_interval` seconds (or until
+    `max_requests` are waiting), written as one JSONL batch job and polled
+    every `poll_interval` seconds. Callers await a future that resolves
+    with the completion text, or an "Azure OpenAI error: ..." string when
+    the line or the job failed. Identical pending prompts share one line.
+    A caller holding a BATCH_SLOT releases it while it waits, so the rest
+    of its batch can queue prompts into the same job.
+    """
+
+    def __init__(self, api, model: str, max_requests: int = None, flush_interval: float = None,
+                 poll_interval: float = None):
+        self.api = api
+        self.model = model
+        self.max_requests = max_requests or int(os.getenv('LLM_BATCH_MAX_REQUESTS', '5000'))
+        self.flush_interval = flush_interval or float(os.getenv('LLM_BATCH_FLUSH_SECONDS', '30'))
+        self.poll_interval = poll_interval or float(os.getenv('LLM_BATCH_POLL_SECONDS', '30'))
+        self.jobs = {}
+        self._pending = {}
+        self._flush_handle = None
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_env(cls) -> Optional['OfflineLLMQueue']:
+        """LLM_BATCH_API=azure|stub enables the queue; off (default) keeps every call synchronous"""
+        kind = os.getenv('LLM_BATCH_API', 'off')
+        model = os.getenv('AZURE_OPENAI_BATCH_DEPLOYMENT', 'gpt-4o-mini-batch')
+        if kind == 'azure':
+            # Batch jobs need a newer API version than chat completions use here
+            client = AsyncAzureOpenAI(
+                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                api_version=os.getenv("AZURE_OPENAI_BATCH_API_VERSION", "2024-10-21"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+            )
+            return cls(AzureBatchAPI(client), model)
+        if kind == 'stub':
+            return cls(StubBatchAPI(float(os.getenv('LLM_BATCH_STUB_LATENCY', '1'))), model)
+        return None
+
+    async def complete(self, prompt: str, params: Dict) -> str:
+        key = (prompt, params['max_tokens'], params['temperature'], params['system'])
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = (f"req-{next(self._ids)}", asyncio.get_running_loop().create_future(),
+                                          params)
+            if len(self._pending) >= self.max_requests:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._flush)
+        slot = BATCH_SLOT.get()
+        if slot is not None:
+            slot.release()
+        try:
+            # Shielded so one caller's deadline does not fail the line for the others
+            return await asyncio.shield(entry[1])
+        finally:
+            if slot is not None:
+                # Shielded too: a cancelled caller still ends up holding the slot its
+                # `async with` gives back
+                await asyncio.shield(slot.acquire())
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            asyncio.ensure_future(self._run_job(pending))
+
+    def _line(self, custom_id: str, prompt: str, params: Dict) -> Dict:
+        return {"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": {
+            "model": self.model,
+            "messages": [{"role": "system", "content": params["system"]}, {"role": "user", "content": prompt}],
+            "max_tokens": params["max_tokens"],
+            "temperature": params["temperature"]
+        }}
+
+    async def _run_job(self, pending: Dict):
+        futures = {custom_id: future for custom_id, future, _ in pending.values()}
+        jsonl = '\n'.join(json.dumps(self._line(custom_id, key[0], params))
+                          for key, (custom_id, _, params) in pending.items()).encode('utf-8')
+        batch_id, status = None, 'failed'
+        try:
+            batch_id = await self.api.submit(jsonl)
+            self.jobs[batch_id] = {"status": "submitted", "requests": len(futures), "submitted": time.time()}
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                state = await self.api.status(batch_id)
+                status = state["status"]
+                self.jobs[batch_id]["status"] = status
+                if status in TERMINAL_STATUSES:
+                    break
+            for file_id in (state.get("output_file_id"), state.get("error_file_id")):
+                if file_id:
+                    self._resolve(futures, await self.api.download(file_id))
+        except Exception as e:
+            print(f"LLM batch job {batch_id or '(unsubmitted)'} failed: {e}")
+        finally:
+            LLM_BATCH_JOBS.labels(status).inc()
+            for future in futures.values():
+                if not future.done():
+                    LLM_BATCH_REQUESTS.labels('error').inc()
+                    future.set_result(f"Azure OpenAI error: batch job {batch_id} ended with status {status}")
+            if batch_id:
+                self.jobs[batch_id]["finished"] = time.time()
+                # Keep the job list from growing without bound
+                while len(self.jobs) > 100:
+                    self.jobs.pop(next(iter(self.jobs)))
+
+    def _resolve(self, futures: Dict, output: bytes):
+        for line in output.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            future = futures.get(record.get("custom_id"))
+            if future is None or future.done():
+                continue
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                error = record.get("error") or response.get("body", {}).get("error") or {}
+                LLM_BATCH_REQUESTS.labels('error').inc()
+                future.set_result(f"Azure OpenAI error: {error.get('message', 'batch request failed')}")
+                continue
+            body = response["body"]
+            metrics.record_tokens(self.model, body.get("usage"))
+            LLM_BATCH_REQUESTS.labels('ok').inc()
+            future.set_result(body["choices"][0]["message"]["content"])
+
+    def stats(self) -> Dict:
+        """A copy of the queue state; call it on the loop (AgentRuntime.call)"""
+        return {"pending": len(self._pending), "jobs": {batch_id: dict(job) for batch_id, job in self.jobs.items()}}
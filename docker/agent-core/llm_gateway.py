@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from common import metrics
+
+INTERACTIVE, BATCH = 0, 1
+# Priority of LLM calls made from this context; workflow batches lower it
+PRIORITY = contextvars.ContextVar('llm_priority', default=INTERACTIVE)
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BATCH: 'batch'}
+
+GATEWAY_QUEUE = metrics.histogram('llm_gateway_queue_seconds', 'Time LLM calls waited for admission',
+                                  ('priority',))
+GATEWAY_THROTTLED = metrics.counter('llm_gateway_throttled', 'LLM calls throttled', ('reason',))
+
+
+class ThrottledError(Exception):
+    """The LLM call could not be made within its quota; retry after retry_after seconds"""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def to_dict(self) -> Dict:
+        error = {"error": f"Azure OpenAI throttled: {self}", "throttled": True}
+        if self.retry_after is not None:
+            error["retry_after"] = round(self.retry_after, 3)
+        return error
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the service asked us to wait, or None when error is not a 429"""
+    if getattr(error, 'status_code', None) != 429:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return 1.0
+
+
+class LLMGateway:
+    """Admission control shared by every Azure OpenAI call in the process.
+
+    Concurrency follows AIMD: each success raises the limit by 1/limit
+    (about one per round of calls), a 429 halves it, once per round of
+    calls that saw it. A 429's Retry-After pauses all admissions until it
+    expires and the call is retried, up to max_retries times. With `tpm`
+    set, calls reserve their estimated tokens in a sliding one-minute
+    window, settled to the reported usage afterwards, and wait while the
+    window is full. Waiting calls are admitted interactive first, then
+    batch, oldest first; a call that cannot be admitted within `max_wait`
+    seconds fails with ThrottledError rather than queueing forever.
+    """
+
+    def __init__(self, initial: float = None, min_limit: float = None, max_limit: float = None,
+                 tpm: int = None, max_retries: int = None, max_wait: float = None):
+        self.limit = float(initial or os.getenv('LLM_CONCURRENCY_INITIAL', '8'))
+        self.min_limit = float(min_limit or os.getenv('LLM_CONCURRENCY_MIN', '1'))
+        self.max_limit = float(max_limit or os.getenv('LLM_CONCURRENCY_MAX', '64'))
+        self.tpm = int(tpm if tpm is not None else os.getenv('LLM_TPM_LIMIT', '0'))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv('LLM_MAX_RETRIES', '3'))
+        self.max_wait = float(max_wait or os.getenv('LLM_QUEUE_MAX_SECONDS', '30'))
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._window = deque()
+        self._used = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        metrics.gauge('llm_gateway_limit', 'Current LLM concurrency limit').set_function(lambda: self.limit)
+        metrics.gauge('llm_gateway_inflight', 'LLM calls in flight').set_function(lambda: self.inflight)
+        metrics.gauge('llm_gateway_queued', 'LLM calls waiting for admission').set_function(
+            lambda: len(self._waiters))
+
+    async def run(self, call, tokens: int, retryable=None):
+        """Await call() once admitted; it returns (result, tokens actually used or None).
+
+        retryable, when given, is asked before retrying a rate-limited call;
+        a streamed call that already delivered tokens must not be repeated.
+        """
+        for attempt in range(self.max_retries + 1):
+            reservation = await self._acquire(PRIORITY.get(), tokens)
+            started = time.monotonic()
+            released = False
+            try:
+                result, used = await call()
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None:
+                    if type(e).__name__ == 'APITimeoutError':
+                        self._decrease(started)
+                    raise
+                self.throttled += 1
+                GATEWAY_THROTTLED.labels('rate_limited').inc()
+                self._decrease(started)
+                # Paused before the slot is released, so no waiter slips in first
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+                self._release(reservation, 0)
+                released = True
+                if retryable is not None and not retryable():
+                    raise ThrottledError(f"rate limited mid-stream: {e}", wait)
+                continue
+            finally:
+                # Also on cancellation (deadline, client gone), which is not an Exception
+                if not released:
+                    self._release(reservation, None)
+                    released = True
+            self._settle(reservation, used)
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._dispatch()
+            return result
+        raise ThrottledError(f"rate limited after {self.max_retries} retries",
+                             max(0.0, self.paused_until - time.monotonic()))
+
+    def _decrease(self, started: float):
+        # Calls already in flight when the limit dropped must not drop it again
+        if started >= self._last_decrease:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self._last_decrease = time.monotonic()
+
+    async def _acquire(self, priority: int, tokens: int):
+        queued = time.monotonic()
+        if not self._waiters and self._delay(tokens) == 0 and self.inflight < int(self.limit):
+            return self._admit(tokens)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        self._dispatch()
+        try:
+            reservation = await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return future.result()
+            future.cancel()
+            self._waiters = [w for w in self._waiters if not w[3].done()]
+            heapq.heapify(self._waiters)
+            self.throttled += 1
+            GATEWAY_THROTTLED.labels('queue_timeout').inc()
+            raise ThrottledError(f"no capacity within {self.max_wait}s",
+                                 max(self._delay(tokens), 1.0))
+        except asyncio.CancelledError:
+            # Admitted just as the caller gave up: hand the slot back
+            if future.done() and not future.cancelled():
+                self._release(future.result(), 0)
+            future.cancel()
+            raise
+        finally:
+            GATEWAY_QUEUE.labels(PRIORITY_NAMES.get(priority, str(priority))).observe(time.monotonic() - queued)
+        return reservation
+
+    def _admit(self, tokens: int):
+        self.inflight += 1
+        reservation = [time.monotonic(), tokens]
+        if self.tpm:
+            self._window.append(reservation)
+            self._used += tokens
+        return reservation
+
+    def _release(self, reservation, used: Optional[int]):
+        """Free the slot; used replaces the token estimate (0 when the call never ran)"""
+        self.inflight -= 1
+        self._settle(reservation, used)
+        self._dispatch()
+
+    def _settle(self, reservation, used: Optional[int]):
+        # Reservations older than the window have already been dropped from it
+        if self.tpm and used is not None and reservation[0] > time.monotonic() - 60:
+            self._used += used - reservation[1]
+            reservation[1] = used
+
+    def _delay(self, tokens: int) -> float:
+        """Seconds until a call of `tokens` tokens may start, ignoring concurrency"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if not self.tpm:
+            return 0
+        while self._window and self._window[0][0] <= now - 60:
+            self._used -= self._window.popleft()[1]
+        # A call bigger than the whole budget still runs once the window is empty
+        excess = self._used + tokens - self.tpm
+        if excess <= 0 or not self._window:
+            return 0
+        for started, reserved in self._window:
+            excess -= reserved
+            if excess <= 0:
+                return started + 60 - now
+        return 60
+
+    def _dispatch(self):
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.inflight >= int(self.limit):
+                return
+            delay = self._delay(tokens)
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self._waiters)
+            future.set_result(self._admit(tokens))
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def stats(self) -> Dict:
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "queued": len(self._waiters),
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 3)),
+            "tpm_limit": self.tpm,
+            "tokens_last_minute": self._used,
+            "throttled": self.throttled
+        }
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import json
+import os
+from typing import List
+
+from common import metrics
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+PROMPT_TOKENS = metrics.histogram('agent_prompt_tokens', 'Prompt tokens after compaction', ('workflow',),
+                                  buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192))
+PROMPT_COMPACTED = metrics.counter('agent_prompt_compactions', 'Tool outputs shrunk to fit a prompt budget',
+                                   ('workflow',))
+
+
+class TokenCounter:
+    """Counts tokens with the model's tokenizer.
+
+    Uses tiktoken's encoding for the model when it is installed and its
+    ranks can be loaded; otherwise falls back to a conservative estimate of
+    one token per three characters, which over-counts English and JSON so
+    budgets still hold.
+    """
+
+    def __init__(self, model: str = 'gpt-4o-mini'):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding('o200k_base')
+            except Exception as e:
+                # e.g. no network to fetch the ranks; the fallback encoding can fail the same way
+                print(f"Tokenizer unavailable, estimating prompt tokens: {e}")
+
+    def count(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + 2) // 3
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """text cut to at most `tokens` tokens, with a marker saying how much went"""
+        total = self.count(text)
+        if total <= tokens:
+            return text
+        keep = max(0, tokens - 12)
+        if self.encoding is not None:
+            head = self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:keep])
+        else:
+            head = text[:keep * 3]
+        return f"{head}…[truncated {total - keep} tokens]"
+
+
+def _unwrap(value):
+    """Replace MCP content envelopes with the data inside them"""
+    if isinstance(value, dict):
+        if 'structuredContent' in value:
+            return _unwrap(value['structuredContent'])
+        content = value.get('content')
+        if isinstance(content, list) and content and isinstance(content[0], dict) and 'text' in content[0]:
+            texts = [c.get('text', '') for c in content if isinstance(c, dict)]
+            value = texts[0] if len(texts) == 1 else texts
+            return _unwrap(value)
+        return {k: _unwrap(v) for k, v in value.items() if k != '_meta'}
+    if isinstance(value, list):
+        return [_unwrap(v) for v in value]
+    if isinstance(value, str) and value[:1] in '[{':
+        try:
+            return _unwrap(json.loads(value))
+        except ValueError:
+            return value
+    return value
+
+
+def _shrink(value, max_items: int, max_chars: int):
+    """One compaction pass: sample long lists, hoist repeated fields, clip strings"""
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return f"{value[:max_chars]}…[+{len(value) - max_chars} chars]"
+        return value
+    if isinstance(value, dict):
+        if isinstance(value.get('columns'), list) and isinstance(value.get('rows'), list):
+            # Columnar result sets only need their rows sampled
+            return dict(value, rows=_sample(value['rows'], max_items, max_chars))
+        return {k: _shrink(v, max_items, max_chars) for k, v in value.items()}
+    if isinstance(value, list):
+        common = {}
+        if len(value) > 1 and all(isinstance(r, dict) for r in value):
+            # Fields with the same value in every row are stated once
+            common = {k: v for k, v in value[0].items()
+                      if all(k in r and r[k] == v for r in value[1:])}
+        sampled = _sample(value, max_items, max_chars, set(common))
+        if common:
+            return {"all_rows": _shrink(common, max_items, max_chars), "rows": sampled}
+        return sampled
+    return value
+
+
+def _sample(rows: List, max_items: int, max_chars: int, drop=frozenset()) -> List:
+    """Head and tail of a long list with a marker for what was left out"""
+    marker = None
+    if len(rows) > max_items:
+        head = max(1, max_items * 3 // 4)
+        tail = max_items - head
+        marker = f"…[{len(rows) - head - tail} of {len(rows)} items omitted]"
+        rows = rows[:head] + [marker] + (rows[-tail:] if tail else [])
+    if drop:
+        rows = [{k: v for k, v in r.items() if k not in drop} if r is not marker else r for r in rows]
+    return [r if r is marker else _shrink(r, max_items, max_chars) for r in rows]
+
+
+class PromptBuilder:
+    """Fits tool outputs into an LLM prompt under a token budget.
+
+    Values are unwrapped from their MCP envelopes and serialized as compact
+    JSON. While a value is over its share of the budget, lists are sampled
+    (head and tail kept, the gap marked) and strings clipped, each pass
+    tighter than the last; whatever is still too long is truncated with a
+    marker. The whole prompt therefore stays within `budget` tokens however
+    large the tool output is.
+    """
+
+    def __init__(self, budget: int = None, counter: TokenCounter = None):
+        self.budget = budget or int(os.getenv('LLM_PROMPT_BUDGET_TOKENS', '3000'))
+        self.counter = counter or TokenCounter(os.getenv('LLM_MODEL', 'gpt-4o-mini'))
+
+    def compact(self, value, tokens: int) -> str:
+        """value as prompt text of at most `tokens` tokens"""
+        value = _unwrap(value)
+        if isinstance(value, str):
+            return self.counter.truncate(value, tokens)
+        text = json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+        max_items, max_chars = 50, 500
+        while self.counter.count(text) > tokens and (max_items > 1 or max_chars > 40):
+            text = json.dumps(_shrink(value, max_items, max_chars), separators=(',', ':'),
+                              ensure_ascii=False, default=str)
+            max_items, max_chars = max(1, max_items // 2), max(40, max_chars // 2)
+        return self.counter.truncate(text, tokens)
+
+    def build(self, parts: List, workflow: str = '') -> str:
+        """Join literal text (str) and values ((value,) tuples) into a prompt.
+
+        Literal text is kept as is; the rest of the budget is shared between
+        the values, and a value that needs less leaves its share to the
+        others.
+        """
+        fixed = sum(self.counter.count(p) for p in parts if isinstance(p, str))
+        values = [(i, p[0]) for i, p in enumerate(parts) if isinstance(p, tuple)]
+        remaining = max(0, self.budget - fixed)
+        rendered = {}
+        compacted = False
+        # Smallest first, so short values give their unused share to long ones
+        sized = sorted(((self._size(v), i, v) for i, v in values), key=lambda x: x[0])
+        for n, (size, i, value) in enumerate(sized):
+            share = remaining // (len(sized) - n)
+            rendered[i] = self.compact(value, share) if size > share else self._plain(value)
+            compacted = compacted or size > share
+            remaining -= self.counter.count(rendered[i])
+        if compacted:
+            PROMPT_COMPACTED.labels(workflow).inc()
+        prompt = ''.join(rendered[i] if isinstance(p, tuple) else p for i, p in enumerate(parts))
+        PROMPT_TOKENS.labels(workflow).observe(self.counter.count(prompt))
+        return prompt
+
+    @staticmethod
+    def _plain(value) -> str:
+        value = _unwrap(value)
+        if isinstance(value, str):
+            return value
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+    def _size(self, value) -> int:
+        return self.counter.count(self._plain(value))
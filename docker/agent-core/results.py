@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+from typing import Dict
+
+from common import metrics
+from common.singleflight import TTLCache
+from runtime import AsyncSingleFlight
+from workflows import Workflow, is_error
+
+# Params that pick the workflow or label the request rather than feed its steps
+ROUTING_PARAMS = {'task', 'workflow', 'id', 'idempotency_key'}
+
+WORKFLOW_CACHE = metrics.counter('agent_workflow_cache', 'Workflow result cache lookups', ('workflow', 'outcome'))
+IDEMPOTENT_REPLAYS = metrics.counter('agent_idempotent_replays', 'Requests answered by an earlier idempotency key',
+                                     ('workflow',))
+
+
+def fingerprint(workflow: Workflow, params: Dict) -> str:
+    """The workflow and its effective params, independent of key order and defaults"""
+    effective = {**workflow.defaults,
+                 **{k: v for k, v in params.items() if v is not None and k not in ROUTING_PARAMS}}
+    return workflow.name + ':' + json.dumps(effective, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def _succeeded(response: Dict) -> bool:
+    if 'error' in response or 'stopped_at' in response:
+        return False
+    if 'steps' in response:
+        return not any(is_error(step['result']) for step in response['steps'])
+    return not is_error(response.get('result'))
+
+
+class WorkflowResults:
+    """Result cache and idempotency keys in front of workflow execution.
+
+    Cacheable workflows (a cache_ttl and only read-only tools) are answered
+    from a TTL cache keyed on the workflow's effective params, and identical
+    requests arriving while one runs share it. Only fully successful runs are
+    cached. Independently, a request carrying an idempotency key gets the
+    result of the first request with that key (or joins it while it is still
+    running) for IDEMPOTENCY_TTL_SECONDS; reusing a key with other params is
+    an error. A run that ends without a result (e.g. it hit its deadline)
+    releases its key so the client can retry.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('WORKFLOW_RESULT_CACHE', 'on') != 'off'
+        self.cache = TTLCache(int(os.getenv('WORKFLOW_CACHE_MAX_ENTRIES', '1024')))
+        self.flight = AsyncSingleFlight()
+        self.idempotency_ttl = float(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+        self.keys = TTLCache(int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000')))
+
+    async def run(self, workflow: Workflow, params: Dict, execute, cacheable: bool,
+                  idempotency_key: str = None, deadline: float = None) -> Dict:
+        """The response for params, from execute() only when neither cache nor key has it.
+
+        A keyed run is bounded by `deadline` itself, since it is not
+        cancelled with the request that started it.
+        """
+        key = fingerprint(workflow, params)
+        if not idempotency_key:
+            return await self._cached(workflow, key, execute, cacheable)
+        entry = self.keys.get(idempotency_key)
+        if entry is not None:
+            if entry[0] != key:
+                return {"error": "Idempotency key was already used with different params"}
+            IDEMPOTENT_REPLAYS.labels(workflow.name).inc()
+            return dict(await asyncio.shield(entry[1]), idempotent_replay=True)
+        task = asyncio.ensure_future(asyncio.wait_for(self._cached(workflow, key, execute, cacheable), deadline))
+        self.keys.set(idempotency_key, (key, task), self.idempotency_ttl)
+
+        def release(done):
+            if done.cancelled() or done.exception() is not None:
+                self.keys.pop(idempotency_key)
+        task.add_done_callback(release)
+        # The run outlives a caller that gives up, so a retry with the key can collect it
+        return await asyncio.shield(task)
+
+    async def _cached(self, workflow: Workflow, key: str, execute, cacheable: bool) -> Dict:
+        if not (cacheable and self.enabled):
+            return await execute()
+        cached = self.cache.get(key)
+        if cached is not None:
+            WORKFLOW_CACHE.labels(workflow.name, 'hit').inc()
+            return dict(cached, cached=True)
+
+        async def fill():
+            response = await execute()
+            if _succeeded(response):
+                self.cache.set(key, response, workflow.cache_ttl)
+            return response
+
+        WORKFLOW_CACHE.labels(workflow.name, 'coalesced' if self.flight.in_flight(key) else 'miss').inc()
+        return await self.flight.do(key, fill)
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled, "entries": len(self.cache), "idempotency_keys": len(self.keys)}
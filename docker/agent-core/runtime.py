@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+import asyncio
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Any, Optional, Tuple
+
+import httpx
+
+from common import metrics, tracing, wire
+
+MCP_CLIENT_REQUESTS = metrics.counter('mcp_client_requests', 'Tool calls sent to MCP servers',
+                                      ('server', 'tool', 'outcome'))
+MCP_CLIENT_LATENCY = metrics.histogram('mcp_client_request_duration_seconds',
+                                       'Tool call latency including retries', ('server', 'tool'))
+MCP_CLIENT_RETRIES = metrics.counter('mcp_client_retries', 'Tool call retries', ('server',))
+MCP_CLIENT_COALESCED = metrics.counter('mcp_client_coalesced', 'Tool calls that shared an identical in-flight call',
+                                       ('server', 'tool'))
+MCP_CLIENT_GROUPED = metrics.counter('mcp_client_grouped_calls', 'Tool calls sent inside a grouped batch request',
+                                     ('server',))
+MCP_TOOL_DISCOVERY = metrics.counter('mcp_tool_discovery', 'Tool listing refreshes by result',
+                                     ('server', 'outcome'))
+
+
+class AgentRuntime:
+    """Single event loop that runs every in-flight workflow.
+
+    HTTP worker threads hand coroutines to the loop and block on the result,
+    so the number of concurrent workflows is bounded by `max_in_flight`
+    rather than by the number of threads.
+    """
+
+    def __init__(self, max_in_flight: int = None, deadline: float = None):
+        self.max_in_flight = max_in_flight or int(os.getenv('AGENT_MAX_INFLIGHT_WORKFLOWS', '500'))
+        self.deadline = deadline or float(os.getenv('WORKFLOW_DEADLINE_SECONDS', '60'))
+        self.loop = asyncio.new_event_loop()
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._thread = threading.Thread(target=self._run_loop, name='agent-runtime', daemon=True)
+        self._thread.start()
+        metrics.gauge('agent_workflows_in_flight', 'Workflows running on the runtime loop'
+                      ).set_function(lambda: self.in_flight)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _guarded(self, coro, deadline: float):
+        # Waiting for a slot counts against the deadline too
+        end = self.loop.time() + deadline
+        try:
+            await asyncio.wait_for(self._slots.acquire(), deadline)
+        except BaseException:
+            coro.close()
+            raise
+        self.in_flight += 1
+        try:
+            return await asyncio.wait_for(coro, max(0.0, end - self.loop.time()))
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def submit(self, coro, deadline: float = None):
+        """Schedule a coroutine on the runtime loop, returning a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self._guarded(coro, deadline or self.deadline), self.loop)
+
+    def run(self, coro, deadline: float = None) -> Any:
+        """Run a coroutine on the runtime loop and wait for its result.
+
+        Raises TimeoutError when the coroutine exceeds its deadline.
+        """
+        return self.submit(coro, deadline).result()
+
+    def call(self, fn, timeout: float = 5.0) -> Any:
+        """Run fn() on the runtime loop, for reading state only the loop changes"""
+        async def on_loop():
+            return fn()
+        return asyncio.run_coroutine_threadsafe(on_loop(), self.loop).result(timeout)
+
+
+# Failures where the request never reached the server
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+TRANSIENT_ERRORS = CONNECT_ERRORS + (httpx.ReadError, httpx.RemoteProtocolError, httpx.ReadTimeout)
+TRANSIENT_STATUS = {502, 503, 504}
+
+
+def _setting(server: str, name: str, default: str) -> str:
+    """Per-server override (MCP_AZURE_READ_TIMEOUT) falling back to MCP_READ_TIMEOUT"""
+    return os.getenv(f'MCP_{server.upper()}_{name}', os.getenv(f'MCP_{name}', default))
+
+
+class MCPServerPool:
+    """Keep-alive connection pool and call statistics for one MCP server"""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.connect_timeout = float(_setting(name, 'CONNECT_TIMEOUT', '2'))
+        self.read_timeout = float(_setting(name, 'READ_TIMEOUT', '30'))
+        self.max_connections = int(_setting(name, 'POOL_MAXSIZE', '20'))
+        self.keepalive_expiry = float(_setting(name, 'KEEPALIVE_EXPIRY', '4'))
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry
+            )
+        )
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def stats(self) -> Dict:
+        return {
+            'url': self.url,
+            'max_connections': self.max_connections,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'retries': self.retries,
+            'errors': self.errors
+        }
+
+
+class AsyncSingleFlight:
+    """Shares one in-flight coroutine between concurrent callers with the same key"""
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    def in_flight(self, key) -> bool:
+        """Whether a call for key is running, so a new caller would share it"""
+        return key in self._calls
+
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # A waiter hitting its own deadline must not cancel the shared call
+        return await asyncio.shield(task)
+
+
+# Set while running a workflow batch: tool calls then go through CallGrouper
+GROUP_CALLS = contextvars.ContextVar('group_mcp_calls', default=False)
+
+
+class CallGrouper:
+    """Collects tool calls made close together and sends them as one batch per server.
+
+    The first call to a server opens a window of MCP_GROUP_WINDOW_MS; calls
+    arriving in it ride along in the same batch request, which is sent early
+    once it reaches the client's batch size.
+    """
+
+    def __init__(self, client: 'AsyncMCPClient', window: float = None):
+        self.client = client
+        self.window = window if window is not None else float(os.getenv('MCP_GROUP_WINDOW_MS', '5')) / 1000
+        self._pending = {}
+
+    async def call(self, server: str, tool: str, args: Dict) -> Dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(server, [])
+        pending.append((tool, args, future))
+        if len(pending) == 1:
+            loop.call_later(self.window, self._flush, server, pending)
+        elif len(pending) >= self.client.batch_size:
+            self._flush(server, pending)
+        return await future
+
+    def _flush(self, server: str, pending: List):
+        if self._pending.get(server) is pending:
+            del self._pending[server]
+            asyncio.ensure_future(self._send(server, pending))
+
+    async def _send(self, server: str, pending: List):
+        GROUP_CALLS.set(False)
+        MCP_CLIENT_GROUPED.labels(server).inc(len(pending))
+        try:
+            # Straight to the wire: going back through call_tool would find the
+            # grouped call itself in flight and wait on it
+            if len(pending) == 1:
+                results = [await self.client._call_tool(server, *pending[0][:2])]
+            else:
+                results = await self.client._call_batch(server, [(tool, args) for tool, args, _ in pending])
+        except Exception as e:
+            results = [{"error": str(e)}] * len(pending)
+        for (_, _, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class AsyncMCPClient:
+    """Non-blocking MCP client with a keep-alive pool per server.
+
+    Identical concurrent calls to read-only tools share one request, and with
+    MCP_RESULT_CACHE_TTL set their successful results are reused briefly.
+    Read-only tools, which are also the ones retried after a failure
+    mid-request, are those their server annotates readOnlyHint: `read_only`
+    is answered by the ToolCatalog, and nothing counts as read-only before
+    discovery.
+    """
+
+    def __init__(self, endpoints: Dict[str, str], max_retries: int = None, backoff: float = None):
+        self.endpoints = endpoints
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('MCP_MAX_RETRIES', '2'))
+        self.backoff = backoff or float(os.getenv('MCP_RETRY_BACKOFF', '0.1'))
+        self.result_ttl = float(os.getenv('MCP_RESULT_CACHE_TTL', '0'))
+        self.batch_size = int(os.getenv('MCP_BATCH_MAX_SIZE', '100'))
+        self.pools = {}
+        self.flight = AsyncSingleFlight()
+        self.grouper = CallGrouper(self)
+        self._results = {}
+        self.cache_hits = 0
+        self.read_only = lambda server, tool: False
+
+    def _pool(self, server: str) -> MCPServerPool:
+        pool = self.pools.get(server)
+        if pool is None or pool.url != self.endpoints[server]:
+            pool = self.pools[server] = MCPServerPool(server, self.endpoints[server])
+        return pool
+
+    def stats(self) -> Dict:
+        stats = {name: pool.stats() for name, pool in self.pools.items()}
+        stats['coalesced'] = self.flight.shared
+        stats['cache_hits'] = self.cache_hits
+        return stats
+
+    async def call_tool(self, server: str, tool: str, args: Dict) -> Dict:
+        """Call MCP server tool"""
+        if server not in self.endpoints or not self.read_only(server, tool):
+            return await self._call_tool(server, tool, args)
+
+        key = (server, tool, json.dumps(args, sort_keys=True))
+        if self.result_ttl:
+            cached = self._results.get(key)
+            if cached and cached[1] > time.monotonic():
+                self.cache_hits += 1
+                return cached[0]
+
+        if self.flight.in_flight(key):
+            MCP_CLIENT_COALESCED.labels(server, tool).inc()
+        result = await self.flight.do(key, lambda: self._call_tool(server, tool, args))
+        if self.result_ttl and 'error' not in result:
+            if len(self._results) >= 1024:
+                self._results.clear()
+            self._results[key] = (result, time.monotonic() + self.result_ttl)
+        return result
+
+    async def call_tool_batch(self, server: str, calls: List[Tuple[str, Dict]]) -> List[Dict]:
+        """Call several tools on one server in as few round trips as possible.
+
+        Calls are sent as batch requests of up to MCP_BATCH_MAX_SIZE, which the
+        server runs concurrently; results come back in call order.
+        """
+        if server not in self.endpoints:
+            return [{"error": f"Unknown MCP server: {server}"} for _ in calls]
+        chunks = [calls[i:i + self.batch_size] for i in range(0, len(calls), self.batch_size)]
+        results = await asyncio.gather(*(self._call_batch(server, chunk) for chunk in chunks))
+        return [result for chunk in results for result in chunk]
+
+    async def _call_batch(self, server: str, calls: List[Tuple[str, Dict]]) -> List[Dict]:
+        if len(calls) == 1:
+            return [await self.call_tool(server, *calls[0])]
+        payload = [{"method": "tools/call", "params": {"name": tool, "arguments": args}}
+                   for tool, args in calls]
+        # Retrying after the server may have run part of the batch is only
+        # safe when every call in it is read-only
+        safe = all(self.read_only(server, tool) for tool, _ in calls)
+        result = await self._post(server, 'batch', payload, safe)
+        if isinstance(result, list) and len(result) == len(calls):
+            return result
+        error = result.get('error') if isinstance(result, dict) else None
+        return [{"error": error or "Malformed batch response"} for _ in calls]
+
+    async def _call_tool(self, server: str, tool: str, args: Dict) -> Dict:
+        if server not in self.endpoints:
+            return {"error": f"Unknown MCP server: {server}"}
+        if GROUP_CALLS.get():
+            return await self.grouper.call(server, tool, args)
+        payload = {
+            "method": "tools/call",
+            "params": {"name": tool, "arguments": args}
+        }
+        return await self._post(server, tool, payload, self.read_only(server, tool))
+
+    async def _post(self, server: str, tool: str, payload, safe: bool):
+        url = self.endpoints[server]
+        pool = self._pool(server)
+        pool.requests += 1
+        pool.in_flight += 1
+        outcome = 'error'
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                last = attempt == self.max_retries
+                try:
+                    response = await pool.http.post(url, content=wire.dumps(payload),
+                                                    headers=tracing.inject(wire.Codec.request_headers()))
+                except TRANSIENT_ERRORS as e:
+                    if last or not (safe or isinstance(e, CONNECT_ERRORS)):
+                        raise
+                else:
+                    # 503 is the server shedding load before reading the request
+                    if last or not (response.status_code == 503 or
+                                    (safe and response.status_code in TRANSIENT_STATUS)):
+                        result = wire.loads(response.content, response.headers.get('Content-Type'))
+                        outcome = 'error' if isinstance(result, dict) and 'error' in result else 'ok'
+                        return result
+                pool.retries += 1
+                MCP_CLIENT_RETRIES.labels(server).inc()
+                # Full jitter keeps retrying clients from synchronising
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        except Exception as e:
+            pool.errors += 1
+            return {"error": str(e)}
+        finally:
+            pool.in_flight -= 1
+            MCP_CLIENT_REQUESTS.labels(server, tool, outcome).inc()
+            MCP_CLIENT_LATENCY.labels(server, tool).observe(time.perf_counter() - start)
+
+    async def list_tools(self, server: str, etag: str = None) -> Tuple[int, Optional[str], Optional[Dict]]:
+        """(status, etag, listing) from the server's GET /tools; listing is None on 304"""
+        headers = wire.Codec.request_headers()
+        if etag:
+            headers['If-None-Match'] = etag
+        response = await self._pool(server).http.get(self.endpoints[server].rstrip('/') + '/tools',
+                                                     headers=headers)
+        if response.status_code == 304:
+            return 304, etag, None
+        response.raise_for_status()
+        return (response.status_code, response.headers.get('ETag'),
+                wire.loads(response.content, response.headers.get('Content-Type')))
+
+    async def call_tools(self, calls: List[Tuple[str, str, Dict]]) -> List[Dict]:
+        """Call independent tools concurrently, returning results in call order"""
+        return await asyncio.gather(*(self.call_tool(*call) for call in calls))
+
+
+class ToolCatalog:
+    """Tool schemas discovered from every MCP server.
+
+    Listings are fetched from each server's GET /tools at startup and then
+    every MCP_TOOLS_REFRESH_SECONDS in the background. Refreshes send the
+    last ETag, so an unchanged listing costs an empty 304. A server that has
+    not answered yet is treated as unknown rather than as having no tools.
+    """
+
+    def __init__(self, mcp: AsyncMCPClient, refresh_interval: float = None):
+        self.mcp = mcp
+        self.refresh_interval = refresh_interval or float(os.getenv('MCP_TOOLS_REFRESH_SECONDS', '60'))
+        self.servers = {}
+        self.on_update = None
+        mcp.read_only = self.read_only
+
+    def start(self, runtime: AgentRuntime, on_update=None):
+        """Discover now and keep refreshing on the runtime loop"""
+        self.on_update = on_update
+        return asyncio.run_coroutine_threadsafe(self._run(), runtime.loop)
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        await asyncio.gather(*(self._refresh(server) for server in list(self.mcp.endpoints)))
+
+    async def _refresh(self, server: str):
+        known = self.servers.get(server)
+        try:
+            status, etag, listing = await self.mcp.list_tools(server, known and known['etag'])
+        except Exception as e:
+            MCP_TOOL_DISCOVERY.labels(server, 'error').inc()
+            print(f"Tool discovery for {server} failed: {e}")
+            return
+        if status == 304:
+            known['checked'] = time.time()
+            MCP_TOOL_DISCOVERY.labels(server, 'unchanged').inc()
+            return
+        tools = {tool['name']: tool for tool in listing.get('tools', [])}
+        self.servers[server] = {'etag': etag, 'tools': tools, 'checked': time.time()}
+        MCP_TOOL_DISCOVERY.labels(server, 'changed').inc()
+        if self.on_update:
+            self.on_update(server, tools)
+
+    def knows(self, server: str) -> bool:
+        return server in self.servers
+
+    def tool(self, server: str, name: str) -> Optional[Dict]:
+        known = self.servers.get(server)
+        return known['tools'].get(name) if known else None
+
+    def read_only(self, server: str, tool: str) -> bool:
+        """Whether the server lists the tool as side-effect free (unknown counts as not)"""
+        listed = self.tool(server, tool) or {}
+        return bool((listed.get('annotations') or {}).get('readOnlyHint'))
+
+    def snapshot(self) -> Dict:
+        return {server: {'etag': known['etag'], 'checked': known['checked'], 'tools': list(known['tools'].values())}
+                for server, known in self.servers.items()}
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from common import metrics, tracing
+from prompts import PromptBuilder
+
+DEFAULT_WORKFLOWS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflows.yaml')
+
+# {params.city}, {steps.get_weather}, {steps.start_pipeline.run_id}
+PLACEHOLDER = re.compile(r'\{(params|steps)((?:\.[A-Za-z0-9_]+)*)\}')
+
+STEP_KEYS = {'id', 'tool', 'llm', 'args', 'after', 'foreach', 'as', 'stop_if_error'}
+WORKFLOW_KEYS = {'match', 'params', 'required_params', 'steps', 'cache_ttl'}
+
+
+WORKFLOW_RUNS = metrics.counter('agent_workflow_runs', 'Workflow runs', ('workflow', 'outcome'))
+WORKFLOW_LATENCY = metrics.histogram('agent_workflow_duration_seconds', 'Workflow run latency', ('workflow',))
+STEP_LATENCY = metrics.histogram('agent_workflow_step_duration_seconds', 'Workflow step latency',
+                                 ('workflow', 'step'))
+
+
+class WorkflowError(Exception):
+    """Raised when a workflow definition is invalid"""
+
+
+def normalize_task(task: str) -> str:
+    return ' '.join(re.findall(r'[a-z0-9]+', task.lower()))
+
+
+def _references(value) -> List[str]:
+    """Step ids referenced by the templates inside value"""
+    if isinstance(value, str):
+        return [path.split('.')[1] for kind, path in PLACEHOLDER.findall(value) if kind == 'steps' and path]
+    if isinstance(value, dict):
+        return [ref for v in value.values() for ref in _references(v)]
+    if isinstance(value, list):
+        return [ref for v in value for ref in _references(v)]
+    return []
+
+
+def _unwrap(result):
+    """The data inside an MCP result: structuredContent, or decoded content text"""
+    if isinstance(result, dict) and 'structuredContent' in result:
+        return result['structuredContent']
+    if isinstance(result, dict) and isinstance(result.get('content'), list) and result['content']:
+        text = result['content'][0].get('text', '')
+        try:
+            return json.loads(text)
+        except (TypeError, ValueError):
+            return text
+    return result
+
+
+def _lookup(root, path: List[str]):
+    value = root
+    for part in path:
+        if isinstance(value, dict) and part not in value:
+            value = _unwrap(value)
+        if isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def render(value, context: Dict):
+    """Substitute placeholders in a step template.
+
+    A string that is exactly one placeholder keeps the referenced value's type
+    (so replicas stay integers); otherwise placeholders are formatted inline.
+    """
+    if isinstance(value, dict):
+        return {k: render(v, context) for k, v in value.items()}
+    if isinstance(value, list):
+        return [render(v, context) for v in value]
+    if not isinstance(value, str):
+        return value
+
+    def resolve(kind, path):
+        parts = [p for p in path.split('.') if p]
+        return _lookup(context[kind], parts)
+
+    whole = PLACEHOLDER.fullmatch(value)
+    if whole:
+        return resolve(*whole.groups())
+    return PLACEHOLDER.sub(lambda m: str(resolve(*m.groups())), value)
+
+
+def render_prompt(template: str, context: Dict, builder: PromptBuilder, workflow: str = '') -> str:
+    """Fill an llm step's template, compacting step outputs to fit the prompt budget"""
+    parts, last = [], 0
+    for match in PLACEHOLDER.finditer(template):
+        parts.append(template[last:match.start()])
+        kind, path = match.groups()
+        parts.append((_lookup(context[kind], [p for p in path.split('.') if p]),))
+        last = match.end()
+    parts.append(template[last:])
+    return builder.build(parts, workflow)
+
+
+def is_error(result) -> bool:
+    if isinstance(result, dict):
+        return 'error' in result
+    return isinstance(result, str) and result.startswith('Azure OpenAI error:')
+
+
+class Step:
+    def __init__(self, workflow: str, spec: Dict, servers):
+        unknown = set(spec) - STEP_KEYS
+        if unknown:
+            raise WorkflowError(f"{workflow}: unknown step keys {sorted(unknown)}")
+        self.workflow = workflow
+        self.id = spec.get('id')
+        if not self.id:
+            raise WorkflowError(f"{workflow}: every step needs an id")
+        if ('tool' in spec) == ('llm' in spec):
+            raise WorkflowError(f"{workflow}.{self.id}: step needs exactly one of 'tool' or 'llm'")
+
+        self.server = self.tool = self.prompt = None
+        if 'tool' in spec:
+            self.server, _, self.tool = spec['tool'].partition('.')
+            if not self.tool:
+                raise WorkflowError(f"{workflow}.{self.id}: tool must be '<server>.<tool>'")
+            if self.server not in servers:
+                raise WorkflowError(f"{workflow}.{self.id}: unknown MCP server '{self.server}'")
+        else:
+            self.prompt = spec['llm']
+
+        self.args = spec.get('args', {})
+        self.foreach = spec.get('foreach')
+        self.foreach_as = spec.get('as')
+        if self.foreach and not self.foreach_as:
+            raise WorkflowError(f"{workflow}.{self.id}: foreach needs 'as' to name the per-item param")
+        self.stop_if_error = bool(spec.get('stop_if_error', False))
+        self.depends_on = set(spec.get('after', [])) | set(_references(self.args)) | set(_references(self.prompt))
+
+
+class Workflow:
+    """A compiled, validated workflow DAG"""
+
+    def __init__(self, name: str, spec: Dict, servers):
+        unknown = set(spec) - WORKFLOW_KEYS
+        if unknown:
+            raise WorkflowError(f"{name}: unknown workflow keys {sorted(unknown)}")
+        self.name = name
+        self.defaults = spec.get('params', {})
+        self.required_params = spec.get('required_params', [])
+        self.cache_ttl = float(spec.get('cache_ttl', 0))
+        self.match = [[normalize_task(term) for term in group] for group in spec.get('match', [])]
+        self.steps = [Step(name, s, servers) for s in spec.get('steps', [])]
+        if not self.steps:
+            raise WorkflowError(f"{name}: workflow has no steps")
+
+        by_id = {}
+        for index, step in enumerate(self.steps):
+            step.index = index
+            if step.id in by_id:
+                raise WorkflowError(f"{name}: duplicate step id '{step.id}'")
+            by_id[step.id] = step
+        for step in self.steps:
+            missing = step.depends_on - set(by_id)
+            if missing:
+                raise WorkflowError(f"{name}.{step.id}: depends on unknown steps {sorted(missing)}")
+        self._check_acyclic(by_id)
+
+    def _check_acyclic(self, by_id: Dict[str, Step]):
+        state = {}
+
+        def visit(step_id, trail):
+            if state.get(step_id) == 'done':
+                return
+            if state.get(step_id) == 'visiting':
+                raise WorkflowError(f"{self.name}: dependency cycle {' -> '.join(trail + [step_id])}")
+            state[step_id] = 'visiting'
+            for dep in by_id[step_id].depends_on:
+                visit(dep, trail + [step_id])
+            state[step_id] = 'done'
+
+        for step_id in by_id:
+            visit(step_id, [])
+
+    def matches(self, padded_task: str) -> bool:
+        return bool(self.match) and all(
+            any(f' {term} ' in padded_task for term in group) for group in self.match)
+
+
+class WorkflowRegistry:
+    """Workflow definitions compiled once at startup, routed by task"""
+
+    def __init__(self, workflows: Dict[str, Workflow]):
+        self.workflows = workflows
+        self._routes = {}
+
+    @classmethod
+    def load(cls, servers, path: str = None) -> 'WorkflowRegistry':
+        path = path or os.getenv('AGENT_WORKFLOWS_PATH', DEFAULT_WORKFLOWS_PATH)
+        with open(path) as f:
+            if path.endswith('.json'):
+                spec = json.load(f)
+            else:
+                import yaml
+                spec = yaml.safe_load(f)
+        return cls({name: Workflow(name, wf, servers) for name, wf in spec.get('workflows', {}).items()})
+
+    def route(self, task: str) -> Optional[Workflow]:
+        """Resolve a free-text task to a workflow.
+
+        Match rules are evaluated in definition order the first time a task
+        is seen; the outcome is memoized so repeat tasks are a dict lookup.
+        """
+        key = normalize_task(task)
+        if key not in self._routes:
+            padded = f' {key} '
+            name = next((wf.name for wf in self.workflows.values() if wf.matches(padded)), None)
+            if len(self._routes) < 10000:
+                self._routes[key] = name
+            return self.workflows.get(name)
+        return self.workflows.get(self._routes[key])
+
+    def resolve(self, params: Dict) -> Optional[Workflow]:
+        name = params.get('workflow')
+        if name:
+            return self.workflows.get(name)
+        return self.route(params.get('task', ''))
+
+
+class WorkflowEngine:
+    """Executes compiled workflows against an agent's MCP and LLM clients"""
+
+    def __init__(self, agent, prompts: PromptBuilder = None):
+        self.agent = agent
+        self.prompts = prompts or PromptBuilder()
+
+    @staticmethod
+    def _scope(step: Step, context: Dict, item=None) -> Dict:
+        if item is None:
+            return context
+        return dict(context, params={**context['params'], step.foreach_as: item})
+
+    async def _run_step(self, step: Step, context: Dict, item=None, emit=None):
+        local = self._scope(step, context, item)
+        if step.tool:
+            return await self.agent.call_mcp_tool(step.server, step.tool, render(step.args, local))
+        if emit:
+            async def on_token(text):
+                await emit({'event': 'token', 'step': step.id, 'text': text})
+        else:
+            on_token = None
+        prompt = render_prompt(step.prompt, local, self.prompts, step.workflow)
+        return await self.agent.invoke_azure_openai(prompt, on_token=on_token)
+
+    async def run(self, workflow: Workflow, params: Dict, emit=None, checkpoint=None, restored: Dict = None) -> Dict:
+        """Run a workflow to completion.
+
+        emit, when given, is awaited with a 'step' event as each step output
+        is ready and with 'token' events while LLM steps stream. checkpoint,
+        when given, is awaited as checkpoint(step_id, value, outputs) once a
+        step has finished; passing those back in `restored` ({step_id:
+        (value, outputs)}) resumes the workflow without re-running them.
+        """
+        outcome = 'error'
+        start = time.perf_counter()
+        try:
+            with tracing.span(f'workflow {workflow.name}', workflow=workflow.name):
+                response = await self._run(workflow, params, emit, checkpoint, restored or {})
+            outcome = 'error' if 'error' in response else 'stopped' if 'stopped_at' in response else 'ok'
+            return response
+        except asyncio.CancelledError:
+            # Deadline exceeded or the streaming client went away
+            outcome = 'cancelled'
+            raise
+        finally:
+            WORKFLOW_RUNS.labels(workflow.name, outcome).inc()
+            WORKFLOW_LATENCY.labels(workflow.name).observe(time.perf_counter() - start)
+
+    async def _run(self, workflow: Workflow, params: Dict, emit, checkpoint, restored: Dict) -> Dict:
+        params = {**workflow.defaults, **{k: v for k, v in params.items() if v is not None}}
+        for name in workflow.required_params:
+            if not params.get(name):
+                return {'error': f'{name} required for workflow {workflow.name}'}
+
+        context = {'params': params, 'steps': {}}
+        outputs = {}
+        stopped = asyncio.Event()
+        stopped_at = []
+        tasks = {}
+
+        async def execute(step: Step):
+            if step.depends_on:
+                await asyncio.gather(*(tasks[dep] for dep in step.depends_on))
+            if stopped.is_set():
+                return
+            items = params.get(step.foreach) if step.foreach else None
+            started = time.perf_counter()
+            if step.id in restored:
+                value, saved = restored[step.id]
+                context['steps'][step.id] = value
+                for output_id, result in saved.items():
+                    outputs[output_id] = (step.index, result)
+                failed = any(is_error(r) for r in saved.values())
+            elif isinstance(items, list):
+                if step.tool:
+                    # One batch round trip instead of a request per item
+                    results = await self.agent.call_mcp_tools(step.server, [
+                        (step.tool, render(step.args, self._scope(step, context, i))) for i in items])
+                else:
+                    results = await asyncio.gather(*(self._run_step(step, context, i, emit) for i in items))
+                for i, result in zip(items, results):
+                    outputs[f'{step.id}_{i}'] = (step.index, result)
+                    if emit:
+                        await emit({'event': 'step', 'step': f'{step.id}_{i}', 'result': result})
+                context['steps'][step.id] = dict(zip(map(str, items), results))
+                failed = any(is_error(r) for r in results)
+                if checkpoint:
+                    await checkpoint(step.id, context['steps'][step.id],
+                                     {f'{step.id}_{i}': r for i, r in zip(items, results)})
+            else:
+                result = await self._run_step(step, context, emit=emit)
+                outputs[step.id] = (step.index, result)
+                context['steps'][step.id] = result
+                if emit:
+                    await emit({'event': 'step', 'step': step.id, 'result': result})
+                failed = is_error(result)
+                if checkpoint:
+                    await checkpoint(step.id, result, {step.id: result})
+            if step.id not in restored:
+                STEP_LATENCY.labels(workflow.name, step.id).observe(time.perf_counter() - started)
+            if failed and step.stop_if_error:
+                stopped_at.append(step.id)
+                stopped.set()
+
+        for step in workflow.steps:
+            tasks[step.id] = asyncio.ensure_future(execute(step))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            # A step that raised (or our own cancellation) must not leave siblings running
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        ordered = sorted(outputs.items(), key=lambda output: output[1][0])
+        steps = [{'step': step_id, 'result': result} for step_id, (_, result) in ordered]
+        if len(workflow.steps) == 1 and len(steps) == 1:
+            response = {'workflow': workflow.name, 'result': steps[0]['result']}
+        else:
+            response = {'workflow': workflow.name, 'steps': steps}
+        if stopped_at:
+            response['stopped_at'] = stopped_at[0]
+        return response
@@ -1,195 +1,155 @@
 #!/usr/bin/env python3
-import json
 import sys
 import os
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.mgmt.datafactory import DataFactoryManagementClient
 from azure.mgmt.datafactory.models import *
-from openai import AzureOpenAI
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from common import metrics, wire
+from common.llm_cache import LLMCache
+from common.server import MCPHandler, serve
+from common.singleflight import ToolCallCoalescer
+from common.tools import ToolRegistry
+from clients import AzureClientRegistry, CachedTokenCredential
+from runs import RunTracker, TrackedRun
 import threading
 
+# Data Factory tools default to the configured factory when one is set
+FACTORY_NAME = {"type": "string", "description": "Data Factory name"}
+if os.getenv('AZURE_DATA_FACTORY_NAME'):
+    FACTORY_NAME["default"] = os.getenv('AZURE_DATA_FACTORY_NAME')
+
 class AzureMCP:
+    tools = ToolRegistry()
+    
     def __init__(self):
         self.credential = None
+        self.clients = None
+        self.llm_cache = LLMCache.from_env()
         self.subscription_id = os.getenv('AZURE_SUBSCRIPTION_ID')
         self.resource_group = os.getenv('AZURE_RESOURCE_GROUP', 'agentic-rg')
+        self.run_callback_url = os.getenv('ADF_RUN_CALLBACK_URL')
+        self.wait_max = float(os.getenv('ADF_WAIT_MAX_SECONDS', '25'))
         self.init_azure_clients()
+        self.runs = RunTracker(lambda: self.clients.data_factory(), self.resource_group)
     
     def init_azure_clients(self):
         try:
-            self.credential = DefaultAzureCredential()
-            # Test credential
+            self.credential = CachedTokenCredential(DefaultAzureCredential())
+            # Test credential and warm the token cache
             self.credential.get_token("https://management.azure.com/.default")
+            self.clients = AzureClientRegistry(self.credential, self.subscription_id)
         except Exception as e:
             print(f"Azure credential error: {e}")
             self.credential = None
     
     def handle_request(self, request):
-        method = request.get('method')
-        params = request.get('params', {})
-        
-        if method == 'tools/list':
-            return {
-                "tools": [
-                    {
-                        "name": "list_blob_containers",
-                        "description": "List Azure Blob Storage containers",
-                        "inputSchema": {"type": "object", "properties": {}}
-                    },
-                    {
-                        "name": "invoke_azure_openai",
-                        "description": "Invoke Azure OpenAI model",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "prompt": {"type": "string", "description": "Text prompt"},
-                                "max_tokens": {"type": "integer", "default": 100}
-                            },
-                            "required": ["prompt"]
-                        }
-                    },
-                    {
-                        "name": "list_data_factory_pipelines",
-                        "description": "List Azure Data Factory pipelines",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "factory_name": {"type": "string", "description": "Data Factory name"}
-                            },
-                            "required": ["factory_name"]
-                        }
-                    },
-                    {
-                        "name": "start_data_factory_pipeline",
-                        "description": "Start a Data Factory pipeline run",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "factory_name": {"type": "string", "description": "Data Factory name"},
-                                "pipeline_name": {"type": "string", "description": "Pipeline name"}
-                            },
-                            "required": ["factory_name", "pipeline_name"]
-                        }
-                    },
-                    {
-                        "name": "get_pipeline_status",
-                        "description": "Get Data Factory pipeline run status",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "factory_name": {"type": "string", "description": "Data Factory name"},
-                                "run_id": {"type": "string", "description": "Pipeline run ID"}
-                            },
-                            "required": ["factory_name", "run_id"]
-                        }
-                    }
-                ]
-            }
-        
-        elif method == 'tools/call':
-            if not self.credential:
-                return {"error": "Azure credentials not configured"}
-            
-            tool_name = params.get('name')
-            args = params.get('arguments', {})
-            
-            if tool_name == 'list_blob_containers':
-                return self.list_blob_containers()
-            elif tool_name == 'invoke_azure_openai':
-                return self.invoke_azure_openai(args['prompt'], args.get('max_tokens', 100))
-            elif tool_name == 'list_data_factory_pipelines':
-                return self.list_data_factory_pipelines(args['factory_name'])
-            elif tool_name == 'start_data_factory_pipeline':
-                return self.start_data_factory_pipeline(args['factory_name'], args['pipeline_name'])
-            elif tool_name == 'get_pipeline_status':
-                return self.get_pipeline_status(args['factory_name'], args['run_id'])
-        
-        return {"error": "Unknown method"}
+        if request.get('method') == 'tools/call' and not self.credential:
+            return {"error": "Azure credentials not configured"}
+        return self.tools.handle(self, request)
     
+    @tools.tool("List Azure Blob Storage containers", read_only=True, cache_ttl=10)
     def list_blob_containers(self):
         try:
             storage_account = os.getenv('AZURE_STORAGE_ACCOUNT_NAME')
             if not storage_account:
                 return {"error": "AZURE_STORAGE_ACCOUNT_NAME not configured"}
             
-            blob_service_client = BlobServiceClient(
-                account_url=f"https://{storage_account}.blob.core.windows.net",
-                credential=self.credential
-            )
+            blob_service_client = self.clients.blob_service(storage_account)
             
             containers = []
-            for container in blob_service_client.list_containers():
-                containers.append({
-                    "name": container.name,
-                    "last_modified": container.last_modified.isoformat() if container.last_modified else None
-                })
-            
-            return {"content": [{"type": "text", "text": f"Blob Containers: {json.dumps(containers, indent=2)}"}]}
+            with metrics.upstream('azure_storage', 'list_containers'):
+                for container in blob_service_client.list_containers():
+                    containers.append({
+                        "name": container.name,
+                        "last_modified": container.last_modified.isoformat() if container.last_modified else None
+                    })
+            
+            return wire.structured(containers)
         except Exception as e:
             return {"error": f"Blob Storage error: {str(e)}"}
     
-    def invoke_azure_openai(self, prompt, max_tokens):
+    @tools.tool("Invoke Azure OpenAI model", {
+        "prompt": {"type": "string", "description": "Text prompt"},
+        "max_tokens": {"type": "integer", "default": 100}
+    }, required=["prompt"])
+    def invoke_azure_openai(self, prompt, max_tokens=100):
+        params = {"model": "gpt-4o-mini", "max_tokens": min(max_tokens, 200), "temperature": 0.7,
+                  "system": "You are a helpful AI assistant."}
+        if self.llm_cache:
+            cached = self.llm_cache.get(prompt, **params)
+            if cached is not None:
+                metrics.LLM_REQUESTS.labels(params["model"], 'cache_hit').inc()
+                return {"content": [{"type": "text", "text": cached}]}
         try:
-            azure_openai = AzureOpenAI(
-                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-                api_version="2024-02-01",
-                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-            )
-            
-            response = azure_openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=min(max_tokens, 200),
-                temperature=0.7
-            )
+            azure_openai = self.clients.openai()
+            
+            with metrics.upstream('azure_openai', 'chat_completions'):
+                response = azure_openai.chat.completions.create(
+                    model=params["model"],
+                    messages=[
+                        {"role": "system", "content": params["system"]},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=params["max_tokens"],
+                    temperature=params["temperature"]
+                )
+            metrics.LLM_REQUESTS.labels(params["model"], 'ok').inc()
+            metrics.record_tokens(params["model"], response.usage)
             
             output_text = response.choices[0].message.content
+            if self.llm_cache and output_text:
+                self.llm_cache.put(prompt, output_text, **params)
             return {"content": [{"type": "text", "text": output_text}]}
         except Exception as e:
+            metrics.LLM_REQUESTS.labels(params["model"], 'error').inc()
             return {"error": f"Azure OpenAI error: {str(e)}"}
     
+    @tools.tool("List Azure Data Factory pipelines", {
+        "factory_name": FACTORY_NAME
+    }, required=["factory_name"], read_only=True, cache_ttl=30)
     def list_data_factory_pipelines(self, factory_name):
         try:
             if not self.subscription_id:
                 return {"error": "AZURE_SUBSCRIPTION_ID not configured"}
             
-            adf_client = DataFactoryManagementClient(
-                self.credential, 
-                self.subscription_id
-            )
+            adf_client = self.clients.data_factory()
             
             pipelines = []
-            for pipeline in adf_client.pipelines.list_by_factory(self.resource_group, factory_name):
-                pipelines.append({
-                    "name": pipeline.name,
-                    "type": pipeline.type,
-                    "etag": pipeline.etag
-                })
-            
-            return {"content": [{"type": "text", "text": json.dumps(pipelines, indent=2)}]}
+            with metrics.upstream('arm', 'list_pipelines'):
+                for pipeline in adf_client.pipelines.list_by_factory(self.resource_group, factory_name):
+                    pipelines.append({
+                        "name": pipeline.name,
+                        "type": pipeline.type,
+                        "etag": pipeline.etag
+                    })
+            
+            return wire.structured(pipelines)
         except Exception as e:
             return {"error": f"Data Factory error: {str(e)}"}
     
-    def start_data_factory_pipeline(self, factory_name, pipeline_name):
+    @tools.tool("Start a Data Factory pipeline run and track it server-side", {
+        "factory_name": FACTORY_NAME,
+        "pipeline_name": {"type": "string", "description": "Pipeline name"},
+        "callback_url": {"type": "string", "description": "URL to POST run status changes to"}
+    }, required=["factory_name", "pipeline_name"])
+    def start_data_factory_pipeline(self, factory_name, pipeline_name, callback_url=None):
         try:
             if not self.subscription_id:
                 return {"error": "AZURE_SUBSCRIPTION_ID not configured"}
+            if callback_url and not self.runs.callback_allowed(callback_url):
+                return {"error": f"callback_url host is not allowed: {callback_url}"}
+            
+            adf_client = self.clients.data_factory()
             
-            adf_client = DataFactoryManagementClient(
-                self.credential, 
-                self.subscription_id
-            )
+            with metrics.upstream('arm', 'create_pipeline_run'):
+                run_response = adf_client.pipeline_runs.create_run(
+                    self.resource_group, 
+                    factory_name, 
+                    pipeline_name
+                )
             
-            run_response = adf_client.pipeline_runs.create_run(
-                self.resource_group, 
-                factory_name, 
-                pipeline_name
-            )
+            # The shared poller follows the run from here; callers wait or get called back
+            self.runs.track(factory_name, run_response.run_id, pipeline_name,
+                            callback_url or self.run_callback_url)
             
             result = {
                 "factory_name": factory_name,
@@ -198,75 +158,70 @@ class AzureMCP:
                 "status": "InProgress"
             }
             
-            return {"content": [{"type": "text", "text": json.dumps(result, indent=2)}]}
+            return wire.structured(result)
         except Exception as e:
             return {"error": f"Data Factory pipeline start error: {str(e)}"}
     
+    @tools.tool("Get Data Factory pipeline run status", {
+        "factory_name": FACTORY_NAME,
+        "run_id": {"type": "string", "description": "Pipeline run ID"}
+    }, required=["factory_name", "run_id"], read_only=True, cache_ttl=5)
     def get_pipeline_status(self, factory_name, run_id):
         try:
             if not self.subscription_id:
                 return {"error": "AZURE_SUBSCRIPTION_ID not configured"}
             
-            adf_client = DataFactoryManagementClient(
-                self.credential, 
-                self.subscription_id
-            )
-            
-            run_info = adf_client.pipeline_runs.get(
-                self.resource_group, 
-                factory_name, 
-                run_id
-            )
-            
-            result = {
-                "factory_name": factory_name,
-                "run_id": run_id,
-                "status": run_info.status,
-                "run_start": run_info.run_start.isoformat() if run_info.run_start else None,
-                "run_end": run_info.run_end.isoformat() if run_info.run_end else None,
-                "duration_in_ms": run_info.duration_in_ms
-            }
-            
-            return {"content": [{"type": "text", "text": json.dumps(result, indent=2)}]}
+            run = self.runs.get(run_id)
+            if run is None or run.version == 0:
+                # Not tracked or not polled yet: fetch it, but leave tracking to the
+                # start and wait tools so this one stays read-only (and cacheable)
+                adf_client = self.clients.data_factory()
+                
+                with metrics.upstream('arm', 'get_pipeline_run'):
+                    run_info = adf_client.pipeline_runs.get(
+                        self.resource_group, 
+                        factory_name, 
+                        run_id
+                    )
+                run = TrackedRun(factory_name, run_id, None, 0)
+                run.update(run_info)
+            
+            return wire.structured(run.to_dict())
         except Exception as e:
             return {"error": f"Data Factory pipeline status error: {str(e)}"}
-
-class MCPHandler(BaseHTTPRequestHandler):
-    def __init__(self, mcp_server, *args, **kwargs):
-        self.mcp_server = mcp_server
-        super().__init__(*args, **kwargs)
     
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
+    @tools.tool("Long-poll a pipeline run until its status changes or it finishes", {
+        "factory_name": FACTORY_NAME,
+        "run_id": {"type": "string", "description": "Pipeline run ID"},
+        "known_version": {"type": "integer", "description": "Return once the run's version exceeds this (default: its current version)"},
+        "timeout_seconds": {"type": "number", "default": 20},
+        "callback_url": {"type": "string", "description": "URL to POST run status changes to"}
+    }, required=["factory_name", "run_id"])
+    def wait_for_pipeline_run(self, factory_name, run_id, known_version=None, timeout_seconds=20, callback_url=None):
+        # Not read-only: it starts tracking the run and may register a callback
+        if not self.subscription_id:
+            return {"error": "AZURE_SUBSCRIPTION_ID not configured"}
         
         try:
-            request = json.loads(post_data.decode('utf-8'))
-            response = self.mcp_server.handle_request(request)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-    
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
+            run = self.runs.track(factory_name, run_id, callback_url=callback_url)
+        except ValueError as e:
+            return {"error": str(e)}
+        if known_version is None:
+            known_version = run.version
+        # Each waiter holds a server worker, so the wait is capped
+        run = self.runs.wait(run_id, int(known_version), min(max(timeout_seconds, 0), self.wait_max))
+        if run is None:
+            return {"error": f"Pipeline run {run_id} is no longer tracked"}
+        result = run.to_dict()
+        result["changed"] = run.version > int(known_version)
+        return wire.structured(result)
 
 if __name__ == "__main__":
     server = AzureMCP()
     
+    coalesced = ToolCallCoalescer(server)
+    
     def handler(*args, **kwargs):
-        MCPHandler(server, *args, **kwargs)
+        MCPHandler(coalesced, *args, **kwargs)
     
-    httpd = HTTPServer(('0.0.0.0', 8000), handler)
-    print("Azure MCP Server running on port 8000")
-    httpd.serve_forever()
\ No newline at end of file
+    serve(handler, "Azure MCP Server")
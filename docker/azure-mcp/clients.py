@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import os
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+from azure.storage.blob import BlobServiceClient
+from azure.mgmt.datafactory import DataFactoryManagementClient
+from openai import AzureOpenAI
+
+
+class CachedTokenCredential:
+    """Token credential wrapper that caches tokens per scope.
+
+    Tokens are refreshed `refresh_margin` seconds before they expire. While a
+    refresh is in progress other threads keep using the still-valid token
+    instead of queueing behind the identity endpoint.
+    """
+
+    def __init__(self, credential, refresh_margin: float = None):
+        self.credential = credential
+        self.refresh_margin = refresh_margin or float(os.getenv('AZURE_TOKEN_REFRESH_MARGIN', '300'))
+        self._tokens = {}
+        self._refresh_locks = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs) -> AccessToken:
+        # Claims challenges (CAE) must always go to the identity endpoint
+        if kwargs.get('claims'):
+            return self.credential.get_token(*scopes, **kwargs)
+
+        key = (scopes, kwargs.get('tenant_id'))
+        token = self._tokens.get(key)
+        if token and token.expires_on - time.time() > self.refresh_margin:
+            return token
+
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(key, threading.Lock())
+        # Inside the refresh window someone else is already fetching: keep
+        # serving the current token. Without a usable token, wait for them.
+        usable = token is not None and token.expires_on > time.time()
+        if not refresh_lock.acquire(blocking=not usable):
+            return token
+        try:
+            token = self._tokens.get(key)
+            if token and token.expires_on - time.time() > self.refresh_margin:
+                return token
+            token = self._tokens[key] = self.credential.get_token(*scopes, **kwargs)
+            return token
+        finally:
+            refresh_lock.release()
+
+    def close(self):
+        self.credential.close()
+
+
+class AzureClientRegistry:
+    """Builds each Azure SDK client once and shares it across worker threads.
+
+    The SDK clients are safe for concurrent use, so a single instance per
+    target keeps its connection pool and pipeline warm between requests.
+    """
+
+    def __init__(self, credential, subscription_id: str = None):
+        self.credential = credential
+        self.subscription_id = subscription_id
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = factory()
+        return client
+
+    def data_factory(self):
+        return self.get(('datafactory', self.subscription_id),
+                        lambda: DataFactoryManagementClient(self.credential, self.subscription_id))
+
+    def blob_service(self, storage_account: str):
+        return self.get(('blob', storage_account), lambda: BlobServiceClient(
+            account_url=f"https://{storage_account}.blob.core.windows.net",
+            credential=self.credential
+        ))
+
+    def openai(self):
+        return self.get(('openai', os.getenv("AZURE_OPENAI_ENDPOINT")), lambda: AzureOpenAI(
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-02-01",
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        ))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import datetime
+import os
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from azure.mgmt.datafactory.models import RunFilterParameters, RunQueryFilter
+
+from common import metrics
+
+TERMINAL_STATUSES = {'Succeeded', 'Failed', 'Cancelled'}
+# query_by_factory returns at most 100 runs per page
+QUERY_CHUNK = 100
+
+
+class TrackedRun:
+    __slots__ = ('factory_name', 'run_id', 'pipeline_name', 'status', 'run_start', 'run_end',
+                 'duration_in_ms', 'message', 'version', 'interval', 'next_poll', 'registered',
+                 'callbacks')
+
+    def __init__(self, factory_name: str, run_id: str, pipeline_name: str, interval: float):
+        self.factory_name = factory_name
+        self.run_id = run_id
+        self.pipeline_name = pipeline_name
+        self.status = 'Queued'
+        self.run_start = self.run_end = self.duration_in_ms = self.message = None
+        self.version = 0
+        self.interval = interval
+        # First poll happens on the poller's next pass
+        self.next_poll = time.monotonic()
+        self.registered = datetime.datetime.now(datetime.timezone.utc)
+        self.callbacks = set()
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def update(self, info):
+        """Copy the fields of a PipelineRun from ARM"""
+        self.status = info.status
+        self.pipeline_name = self.pipeline_name or info.pipeline_name
+        self.run_start = info.run_start.isoformat() if info.run_start else None
+        self.run_end = info.run_end.isoformat() if info.run_end else None
+        self.duration_in_ms = info.duration_in_ms
+        self.message = info.message or None
+
+    def to_dict(self) -> Dict:
+        return {
+            "factory_name": self.factory_name,
+            "pipeline_name": self.pipeline_name,
+            "run_id": self.run_id,
+            "status": self.status,
+            "run_start": self.run_start,
+            "run_end": self.run_end,
+            "duration_in_ms": self.duration_in_ms,
+            "message": self.message,
+            "version": self.version
+        }
+
+
+class RunTracker:
+    """Follows Data Factory pipeline runs from one background poller.
+
+    All tracked runs that are due are fetched together, one
+    query_by_factory call per factory and 100 runs, instead of a polling
+    loop per client. A run's poll interval doubles from `min_interval` up
+    to `max_interval` while its status is unchanged and resets when it
+    changes. Changes wake long-poll waiters and are POSTed to any callback
+    URLs registered for the run; callbacks may only target hosts in
+    `callback_hosts` (ADF_CALLBACK_HOSTS, by default the host of
+    ADF_RUN_CALLBACK_URL).
+
+    A run ARM reports as not found is marked Failed. Unfinished runs are
+    dropped after `max_age` seconds, and the oldest unfinished run is
+    dropped when more than `max_active` are tracked.
+    """
+
+    def __init__(self, client_fn, resource_group: str, min_interval: float = None, max_interval: float = None,
+                 max_finished: int = 1000, max_active: int = None, max_age: float = None):
+        self.client_fn = client_fn
+        self.resource_group = resource_group
+        self.min_interval = min_interval or float(os.getenv('ADF_POLL_MIN_SECONDS', '5'))
+        self.max_interval = max_interval or float(os.getenv('ADF_POLL_MAX_SECONDS', '60'))
+        self.max_finished = max_finished
+        self.max_active = max_active or int(os.getenv('ADF_MAX_TRACKED_RUNS', '5000'))
+        self.max_age = max_age or float(os.getenv('ADF_RUN_MAX_AGE_SECONDS', str(3 * 86400)))
+        default_host = urlparse(os.getenv('ADF_RUN_CALLBACK_URL', '')).hostname or ''
+        self.callback_hosts = {h.strip() for h in os.getenv('ADF_CALLBACK_HOSTS', default_host).split(',')
+                               if h.strip()}
+        self.dropped = 0
+        self.polls = 0
+        self._runs = {}
+        self._finished = []
+        self._changed = threading.Condition()
+        self._wakeup = threading.Event()
+        self._callbacks = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._poll_loop, name='adf-poller', daemon=True).start()
+        threading.Thread(target=self._deliver_loop, name='adf-callbacks', daemon=True).start()
+        metrics.gauge('adf_tracked_runs', 'Data Factory runs being polled').set_function(
+            lambda: sum(1 for run in list(self._runs.values()) if not run.done))
+
+    def callback_allowed(self, url: str) -> bool:
+        parsed = urlparse(url)
+        return parsed.scheme in ('http', 'https') and parsed.hostname in self.callback_hosts
+
+    def track(self, factory_name: str, run_id: str, pipeline_name: str = None,
+              callback_url: str = None) -> TrackedRun:
+        if callback_url and not self.callback_allowed(callback_url):
+            raise ValueError(f"callback_url host must be one of: {', '.join(sorted(self.callback_hosts)) or 'none'}")
+        with self._changed:
+            run = self._runs.get(run_id)
+            if run is None:
+                run = self._runs[run_id] = TrackedRun(factory_name, run_id, pipeline_name, self.min_interval)
+                active = [r for r in self._runs.values() if not r.done]
+                # Registration order: the first unfinished run is the oldest
+                for stale in active[:max(0, len(active) - self.max_active)]:
+                    self._drop(stale.run_id)
+            if callback_url:
+                run.callbacks.add(callback_url)
+        self._wakeup.set()
+        return run
+
+    def get(self, run_id: str) -> Optional[TrackedRun]:
+        return self._runs.get(run_id)
+
+    def wait(self, run_id: str, known_version: int = None, timeout: float = 25.0) -> Optional[TrackedRun]:
+        """Block until the run changes past known_version, finishes, or timeout"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                run = self._runs.get(run_id)
+                if run is None or run.done or known_version is None or run.version > known_version:
+                    return run
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return run
+                self._changed.wait(remaining)
+
+    def _drop(self, run_id: str):
+        # Caller holds self._changed; waiters see the run disappear
+        self._runs.pop(run_id, None)
+        self.dropped += 1
+        self._changed.notify_all()
+
+    def _due(self) -> Dict[str, List[TrackedRun]]:
+        now = time.monotonic()
+        oldest = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.max_age)
+        due = {}
+        with self._changed:
+            for run in list(self._runs.values()):
+                if run.done:
+                    continue
+                if run.registered < oldest:
+                    print(f"Giving up on pipeline run {run.run_id}: still {run.status} after {self.max_age:.0f}s")
+                    self._drop(run.run_id)
+                elif run.next_poll <= now:
+                    due.setdefault(run.factory_name, []).append(run)
+        return due
+
+    def _poll_loop(self):
+        while True:
+            due = self._due()
+            for factory_name, runs in due.items():
+                for i in range(0, len(runs), QUERY_CHUNK):
+                    try:
+                        self._poll(factory_name, runs[i:i + QUERY_CHUNK])
+                    except Exception as e:
+                        print(f"Pipeline run poll for {factory_name} failed: {e}")
+                        for run in runs[i:i + QUERY_CHUNK]:
+                            self._reschedule(run, changed=False)
+            with self._changed:
+                pending = [run.next_poll for run in self._runs.values() if not run.done]
+            sleep = min(pending) - time.monotonic() if pending else self.max_interval
+            self._wakeup.wait(max(0.05, sleep))
+            self._wakeup.clear()
+
+    def _poll(self, factory_name: str, runs: List[TrackedRun]):
+        client = self.client_fn()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        filters = RunFilterParameters(
+            last_updated_after=min(run.registered for run in runs) - datetime.timedelta(hours=1),
+            last_updated_before=now + datetime.timedelta(hours=1),
+            filters=[RunQueryFilter(operand='RunId', operator='In', values=[run.run_id for run in runs])]
+        )
+        found = {}
+        self.polls += 1
+        with metrics.upstream('arm', 'query_pipeline_runs'):
+            while True:
+                page = client.pipeline_runs.query_by_factory(self.resource_group, factory_name, filters)
+                for info in page.value or []:
+                    found[info.run_id] = info
+                if not page.continuation_token:
+                    break
+                filters.continuation_token = page.continuation_token
+        for run in runs:
+            info = found.get(run.run_id)
+            if info is None:
+                # Outside the query window (or not visible yet); ask for it directly
+                try:
+                    with metrics.upstream('arm', 'get_pipeline_run'):
+                        info = client.pipeline_runs.get(self.resource_group, factory_name, run.run_id)
+                except Exception as e:
+                    if getattr(e, 'status_code', None) != 404:
+                        print(f"Pipeline run poll for {run.run_id} failed: {e}")
+                        self._reschedule(run, changed=False)
+                        continue
+                    info = SimpleNamespace(status='Failed', pipeline_name=None, run_start=None, run_end=None,
+                                           duration_in_ms=None,
+                                           message=f"Pipeline run not found in factory {factory_name}")
+            self.record(run, info)
+
+    def record(self, run: TrackedRun, info):
+        """Apply a PipelineRun from ARM to a tracked run"""
+        with self._changed:
+            changed = info.status != run.status or run.version == 0
+            run.update(info)
+            if changed:
+                run.version += 1
+                self._changed.notify_all()
+                for url in run.callbacks:
+                    try:
+                        self._callbacks.put_nowait((url, run.to_dict()))
+                    except queue.Full:
+                        print(f"Dropping run callback for {run.run_id}: queue full")
+            if changed and run.done:
+                self._finished.append(run.run_id)
+                while len(self._finished) > self.max_finished:
+                    self._runs.pop(self._finished.pop(0), None)
+        self._reschedule(run, changed)
+
+    def _reschedule(self, run: TrackedRun, changed: bool):
+        run.interval = self.min_interval if changed else min(run.interval * 2, self.max_interval)
+        run.next_poll = time.monotonic() + run.interval
+
+    def _deliver_loop(self):
+        session = requests.Session()
+        while True:
+            url, event = self._callbacks.get()
+            payload = {"method": "pipeline/run_event", "params": event}
+            for attempt in range(3):
+                try:
+                    session.post(url, json=payload, timeout=5).raise_for_status()
+                    break
+                except requests.RequestException as e:
+                    if attempt == 2:
+                        print(f"Run callback to {url} failed: {e}")
+                    else:
+                        time.sleep(0.5 * 2 ** attempt)
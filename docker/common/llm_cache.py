@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r'\s+', ' ', prompt).strip()
+
+
+def ngram_embedding(text: str, dims: int = 512) -> List[float]:
+    """Cheap local embedding: hashed character trigrams, L2 normalised.
+
+    Good enough to spot prompts that differ only by a timestamp or a few
+    characters, without a round trip to an embeddings deployment.
+    """
+    vector = [0.0] * dims
+    text = text.lower()
+    for i in range(len(text) - 2):
+        digest = hashlib.blake2b(text[i:i + 3].encode('utf-8'), digest_size=4).digest()
+        vector[int.from_bytes(digest, 'little') % dims] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class MemoryBackend:
+    """In-process LRU store"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, expires: float):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """LRU store in a local SQLite file, shared by restarts of the same pod"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_lru ON llm_cache (last_used)')
+        self._conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+            else:
+                self._conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+        return row[0] if row[1] >= now else None
+
+    def set(self, key: str, value: str, expires: float):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, value, expires, last_used) VALUES (?, ?, ?, ?)',
+                (key, value, expires, time.time()))
+            overflow = self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    'DELETE FROM llm_cache WHERE key IN '
+                    '(SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)', (overflow,))
+                self.evictions += overflow
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+
+class LLMCache:
+    """Response cache for chat completions.
+
+    Exact lookups are keyed on the normalised prompt plus every parameter
+    that changes the completion. With `similarity` set, a miss falls back to
+    the most similar recent prompt sent with the same parameters.
+    """
+
+    def __init__(self, backend, ttl: float, similarity: float = 0.0, embedder=ngram_embedding,
+                 index_size: int = 256):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embedder = embedder
+        self.index_size = index_size
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._index = {}
+        self._index_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['LLMCache']:
+        """Build the cache from LLM_CACHE_* settings, or None when disabled"""
+        kind = os.getenv('LLM_CACHE_BACKEND', 'memory')
+        if kind == 'off':
+            return None
+        max_entries = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1024'))
+        if kind == 'sqlite':
+            backend = SQLiteBackend(os.getenv('LLM_CACHE_PATH', 'llm-cache.db'), max_entries)
+        else:
+            backend = MemoryBackend(max_entries)
+        return cls(backend,
+                   ttl=float(os.getenv('LLM_CACHE_TTL', '300')),
+                   similarity=float(os.getenv('LLM_CACHE_SIMILARITY', '0')))
+
+    @staticmethod
+    def _group(params: Dict) -> str:
+        return json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def _key(prompt: str, group: str) -> str:
+        return hashlib.sha256(f'{group}\n{prompt}'.encode('utf-8')).hexdigest()
+
+    def get(self, prompt: str, **params) -> Optional[str]:
+        """Cached completion for prompt under params (model, temperature, ...)"""
+        prompt = normalize_prompt(prompt)
+        group = self._group(params)
+        value = self.backend.get(self._key(prompt, group))
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self.similarity:
+            value = self._similar(prompt, group)
+            if value is not None:
+                self.semantic_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, prompt: str, value: str, **params):
+        prompt = normalize_prompt(prompt)
+        group = self._group(params)
+        key = self._key(prompt, group)
+        self.backend.set(key, value, time.time() + self.ttl)
+
+        if self.similarity:
+            vector = self.embedder(prompt)
+            with self._index_lock:
+                index = self._index.setdefault(group, OrderedDict())
+                index[key] = vector
+                index.move_to_end(key)
+                while len(index) > self.index_size:
+                    index.popitem(last=False)
+
+    def _similar(self, prompt: str, group: str) -> Optional[str]:
+        with self._index_lock:
+            candidates = list(self._index.get(group, {}).items())
+        if not candidates:
+            return None
+        vector = self.embedder(prompt)
+        best_key, best_score = None, self.similarity
+        for key, other in candidates:
+            score = sum(a * b for a, b in zip(vector, other))
+            if score >= best_score:
+                best_key, best_score = key, score
+        return self.backend.get(best_key) if best_key else None
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'hit_ratio': round((self.hits + self.semantic_hits) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Tuple
+
+from common import tracing
+
+# Seconds; spans a cached tool call up to a slow LLM completion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class _Sharded:
+    """Per-thread value slots.
+
+    Each thread only ever writes its own slot, so updates on the hot path
+    take no lock; the slots are summed when the metric is scraped. A lock
+    is taken once per thread, the first time it touches the metric.
+    """
+
+    def __init__(self, width: int):
+        self.width = width
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def shard(self):
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            with self._lock:
+                shard = self._shards[ident] = [0.0] * self.width
+        return shard
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards.values())
+        totals = [0.0] * self.width
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class CounterChild:
+    def __init__(self):
+        self._values = _Sharded(1)
+
+    def inc(self, amount: float = 1.0):
+        self._values.shard()[0] += amount
+
+    def samples(self, name, labels):
+        yield name + '_total', labels, self._values.totals()[0]
+
+
+class GaugeChild:
+    def __init__(self):
+        self._values = _Sharded(1)
+        self._function = None
+
+    def inc(self, amount: float = 1.0):
+        self._values.shard()[0] += amount
+
+    def dec(self, amount: float = 1.0):
+        self._values.shard()[0] -= amount
+
+    def set_function(self, fn):
+        """Read the value from fn at scrape time instead of tracking it"""
+        self._function = fn
+
+    @contextmanager
+    def track(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def samples(self, name, labels):
+        value = self._function() if self._function else self._values.totals()[0]
+        yield name, labels, value
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Slots: one per bucket, then +Inf, then the running sum
+        self._values = _Sharded(len(buckets) + 2)
+
+    def observe(self, value: float):
+        shard = self._values.shard()
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                shard[i] += 1
+                break
+        else:
+            shard[-2] += 1
+        shard[-1] += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        totals = self._values.totals()
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + (math.inf,), totals):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', _format_value(bound)),), cumulative
+        yield name + '_count', labels, cumulative
+        yield name + '_sum', labels, totals[-1]
+
+
+class Metric:
+    """A named metric family; `labels(...)` returns the child to update"""
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets=DEFAULT_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        if self.kind == 'counter':
+            return CounterChild()
+        if self.kind == 'gauge':
+            return GaugeChild()
+        return HistogramChild(self.buckets)
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    # Unlabelled metrics are updated directly
+    def __getattr__(self, name):
+        if name in ('inc', 'dec', 'observe', 'time', 'track', 'set_function'):
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+    def render(self):
+        # Text format 0.0.4 names counter families by their _total sample
+        family = self.name + '_total' if self.kind == 'counter' else self.name
+        lines = [f'# HELP {family} {self.documentation}', f'# TYPE {family} {self.kind}']
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in sorted(children):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, key))):
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f'{name}{{{label_text}}} {_format_value(value)}' if label_text
+                             else f'{name} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, documentation, labelnames, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(kind, name, documentation, labelnames, **kwargs)
+            elif metric.kind != kind or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'{name} already registered as a different metric')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Metric:
+        return self._get('counter', name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Metric:
+        return self._get('gauge', name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Metric:
+        return self._get('histogram', name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# Shared families used by every service
+MCP_REQUESTS = counter('mcp_requests', 'MCP requests handled', ('method', 'tool', 'outcome'))
+MCP_LATENCY = histogram('mcp_request_duration_seconds', 'MCP request latency', ('method', 'tool'))
+MCP_IN_FLIGHT = gauge('mcp_requests_in_flight', 'MCP requests being handled')
+UPSTREAM_REQUESTS = counter('upstream_requests', 'Calls to upstream dependencies',
+                            ('upstream', 'operation', 'outcome'))
+UPSTREAM_LATENCY = histogram('upstream_request_duration_seconds', 'Upstream call latency',
+                             ('upstream', 'operation'))
+LLM_TOKENS = counter('llm_tokens', 'LLM tokens consumed', ('model', 'kind'))
+LLM_REQUESTS = counter('llm_requests', 'LLM completions requested', ('model', 'outcome'))
+
+
+def request_outcome(response) -> str:
+    return 'error' if isinstance(response, dict) and 'error' in response else 'ok'
+
+
+@contextmanager
+def upstream(name: str, operation: str):
+    """Time and trace one call to an upstream (azure_openai, arm, kubernetes, sqlite, wttr).
+
+    Exceptions are counted as errors and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span(f'{name} {operation}', kind='client', upstream=name):
+            yield
+    except Exception:
+        UPSTREAM_REQUESTS.labels(name, operation, 'error').inc()
+        raise
+    else:
+        UPSTREAM_REQUESTS.labels(name, operation, 'ok').inc()
+    finally:
+        UPSTREAM_LATENCY.labels(name, operation).observe(time.perf_counter() - start)
+
+
+def record_tokens(model: str, usage):
+    """Count prompt/completion tokens from an OpenAI usage object or dict, if present"""
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        LLM_TOKENS.labels(model, 'prompt').inc(usage.get('prompt_tokens') or 0)
+        LLM_TOKENS.labels(model, 'completion').inc(usage.get('completion_tokens') or 0)
+        return
+    LLM_TOKENS.labels(model, 'prompt').inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels(model, 'completion').inc(usage.completion_tokens or 0)
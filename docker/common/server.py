@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+import contextvars
+import json
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from common import metrics, tracing, wire
+from common.tools import ToolRegistry
+
+HEALTH_REQUEST_PREFIX = b'GET /health '
+
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'Content-Length: 31\r\n'
+    b'\r\n'
+    b'{"error": "Server overloaded"}\n'
+)
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+    """HTTP server that serves connections from a bounded worker pool.
+
+    The accept loop only hands new connections to an idle-connection
+    thread, which waits (with one selector for all of them) until a
+    request arrives, then queues the connection for a worker. When the
+    queue is full the connection is answered with a 503 straight away.
+    `GET /health` requests bypass the queue and are served by a dedicated
+    thread, so liveness probes keep answering while every worker is busy.
+    A kept-alive connection goes back to the idle thread between requests,
+    so idle clients never hold a worker; it is closed after
+    `idle_timeout` seconds without a request. A handler may also detach
+    its connection and answer later with send_detached, freeing the worker
+    while the response is computed elsewhere.
+    """
+
+    # Connections are accepted at once, so a burst only needs room in the listen backlog
+    request_queue_size = int(os.getenv('SERVER_LISTEN_BACKLOG', '128'))
+
+    def __init__(self, server_address, handler_class, workers=None, max_queue=None, idle_timeout=None):
+        self.workers = workers or int(os.getenv('SERVER_WORKERS', '16'))
+        self.max_queue = max_queue or int(os.getenv('SERVER_MAX_QUEUE', '64'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SERVER_KEEPALIVE_TIMEOUT', '5'))
+        self.rejected_total = 0
+        self._requests = queue.Queue(maxsize=self.max_queue)
+        self._health_requests = queue.Queue()
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = selectors.DefaultSelector()
+        self._parked = queue.Queue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._idle.register(self._wake_r, selectors.EVENT_READ)
+        self._responder = ThreadPoolExecutor(int(os.getenv('SERVER_RESPONDERS', '4')),
+                                             thread_name_prefix='http-respond')
+        super().__init__(server_address, handler_class)
+
+        self._threads = []
+        for i in range(self.workers):
+            self._start_thread(self._work, self._requests, f'http-worker-{i}')
+        self._start_thread(self._work, self._health_requests, 'http-health')
+        self._start_thread(self._watch_idle, None, 'http-idle')
+
+    def _start_thread(self, target, requests, name):
+        thread = threading.Thread(target=target, args=(requests,) if requests else (), name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _work(self, requests):
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._busy_lock:
+                self._busy += 1
+            self._local.keep_alive = self._local.detached = False
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self._local.keep_alive = False
+                self.handle_error(request, client_address)
+            finally:
+                if self._local.detached:
+                    pass
+                elif self._local.keep_alive:
+                    self._park(request, client_address)
+                else:
+                    self.shutdown_request(request)
+                with self._busy_lock:
+                    self._busy -= 1
+
+    def keep_alive(self):
+        """Called by the handler after a response: wait for the next request off the worker"""
+        self._local.keep_alive = True
+
+    def detach(self):
+        """Called by the handler: its connection stays open for send_detached after it returns"""
+        self._local.detached = True
+
+    def send_detached(self, request, response: bytes):
+        """Write a complete response to a detached connection, then close it (any thread)"""
+        self._responder.submit(self._respond, request, response)
+
+    def _respond(self, request, response: bytes):
+        try:
+            request.settimeout(self.idle_timeout)
+            request.sendall(response)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def _park(self, request, client_address):
+        self._parked.put((request, client_address))
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def _watch_idle(self):
+        deadlines = {}
+        while True:
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic()) if deadlines else None
+            for key, _ in self._idle.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._idle.unregister(key.fileobj)
+                deadlines.pop(key.fileobj, None)
+                self._dispatch(key.fileobj, key.data)
+            while True:
+                try:
+                    request, client_address = self._parked.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    return
+                try:
+                    self._idle.register(request, selectors.EVENT_READ, client_address)
+                except (ValueError, OSError):
+                    # Closed meanwhile
+                    continue
+                deadlines[request] = time.monotonic() + self.idle_timeout
+            now = time.monotonic()
+            for request in [r for r, deadline in deadlines.items() if deadline <= now]:
+                self._idle.unregister(request)
+                del deadlines[request]
+                self.shutdown_request(request)
+
+    def _dispatch(self, request, client_address):
+        """Queue a connection whose request has started arriving"""
+        try:
+            head = request.recv(len(HEALTH_REQUEST_PREFIX), socket.MSG_PEEK)
+        except OSError:
+            head = b''
+        if not head:
+            # Closed by the client while idle
+            self.shutdown_request(request)
+            return
+        if head == HEALTH_REQUEST_PREFIX:
+            self._health_requests.put((request, client_address))
+            return
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected_total += 1
+            try:
+                request.sendall(SERVICE_UNAVAILABLE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def stats(self):
+        """Current pool utilisation"""
+        return {
+            'workers': self.workers,
+            'busy_workers': self._busy,
+            'queued': self._requests.qsize(),
+            'max_queue': self.max_queue,
+            'rejected_total': self.rejected_total,
+            'idle_connections': len(self._idle.get_map() or {}) - 1
+        }
+
+    def process_request(self, request, client_address):
+        # No waiting here: a slow client must not hold up the accept loop
+        self._park(request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        for _ in range(self.workers):
+            self._requests.put(None)
+        self._health_requests.put(None)
+        self._park(None, None)
+
+
+class BatchRunner:
+    """Runs the calls of a batch request concurrently.
+
+    A batch is a JSON array of MCP requests; the response is an array of
+    their responses in the same order. Calls from every batch share one
+    pool of `workers` threads. Each call must finish within `call_timeout`
+    seconds of starting (a call may ask for less with a `timeout` field),
+    and may wait as long again for a free thread; otherwise its slot holds a
+    timeout error. A call that times out while running is not interrupted:
+    it keeps its thread until it returns, and its result is discarded.
+    """
+
+    def __init__(self, workers=None, call_timeout=None, max_size=None):
+        self.workers = workers or int(os.getenv('MCP_BATCH_WORKERS', '8'))
+        self.call_timeout = call_timeout or float(os.getenv('MCP_BATCH_CALL_TIMEOUT', '30'))
+        self.max_size = max_size or int(os.getenv('MCP_BATCH_MAX_SIZE', '100'))
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='mcp-batch')
+
+    def run(self, call, requests):
+        if not requests:
+            return {"error": "Empty batch"}
+        if len(requests) > self.max_size:
+            return {"error": f"Batch of {len(requests)} calls exceeds the limit of {self.max_size}"}
+
+        arrived = time.monotonic()
+        # Each call runs in a copy of this context so its span nests under the batch
+        calls = []
+        for request in requests:
+            started = []
+            calls.append((self._executor.submit(contextvars.copy_context().run, self._call,
+                                                call, request, started), started))
+        responses = []
+        for (future, started), request in zip(calls, requests):
+            timeout = self.call_timeout
+            if isinstance(request, dict) and isinstance(request.get('timeout'), (int, float)):
+                timeout = min(request['timeout'], timeout)
+            response = self._wait(future, started, arrived, timeout)
+            if isinstance(request, dict) and 'id' in request:
+                response = dict(response, id=request['id'])
+            responses.append(response)
+        return responses
+
+    @staticmethod
+    def _wait(future, started, arrived, timeout):
+        """The call's response; its timeout runs from when a thread picked it up"""
+        while True:
+            begun = started[0] if started else None
+            try:
+                return future.result(max(0.0, (begun or arrived) + timeout - time.monotonic()))
+            except FutureTimeout:
+                if begun is not None:
+                    return {"error": f"Tool call timed out after {timeout}s"}
+                # cancel() fails once the call has started, which restarts its clock
+                if future.cancel():
+                    return {"error": f"Tool call waited {timeout}s for a batch worker"}
+
+    @staticmethod
+    def _call(call, request, started):
+        started.append(time.monotonic())
+        if not isinstance(request, dict):
+            return {"error": "Batch entries must be objects"}
+        with tracing.span('mcp call') as span:
+            try:
+                response = call(request, span)
+            except Exception as e:
+                return {"error": str(e)}
+        if not isinstance(response, dict):
+            getattr(response, 'close', lambda: None)()
+            return {"error": "Streaming responses are not supported in a batch"}
+        return response
+
+
+BATCHES = BatchRunner()
+
+
+class MCPHandler(BaseHTTPRequestHandler):
+    # Persistent connections let agent-core reuse sockets across tool calls.
+    # Between requests they wait on the server's idle thread, not a worker;
+    # the timeout only bounds reading a request that has started.
+    protocol_version = 'HTTP/1.1'
+    timeout = float(os.getenv('SERVER_KEEPALIVE_TIMEOUT', '5'))
+
+    def __init__(self, mcp_server, *args, **kwargs):
+        self.mcp_server = mcp_server
+        super().__init__(*args, **kwargs)
+
+    def handle(self):
+        """Serve one request, then hand a kept-alive connection back to the server"""
+        self.close_connection = True
+        self.handle_one_request()
+        if not self.close_connection and hasattr(self.server, 'keep_alive'):
+            self.server.keep_alive()
+
+    def send_body(self, status, content_type, body, close=False, headers=None):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
+        codec = wire.Codec.negotiate(self.headers)
+
+        with tracing.span('mcp request', kind='server', parent=tracing.extract(self.headers)) as span:
+            try:
+                request = wire.loads(post_data, self.headers.get('Content-Type'),
+                                     self.headers.get('Content-Encoding'))
+                if isinstance(request, list):
+                    if span:
+                        span.name = 'batch'
+                        span.set_attribute('mcp.batch_size', len(request))
+                    response = BATCHES.run(self.handle_call, request)
+                else:
+                    response = self.handle_call(request, span)
+                if not isinstance(response, (dict, list)):
+                    self.send_stream(response)
+                    return
+                self.send_encoded(200, codec, response)
+            except Exception as e:
+                if span:
+                    span.set_error(str(e))
+                self.send_encoded(500, codec, {"error": str(e)})
+
+    def send_encoded(self, status, codec, response):
+        body, headers = codec.encode(response)
+        content_type = headers.pop('Content-Type')
+        self.send_body(status, content_type, body, headers=headers)
+
+    def handle_call(self, request, span=None):
+        """Pass one MCP request to the server, recording its metrics"""
+        method, tool, outcome = str(request.get('method')), '', 'error'
+        if method == 'tools/call':
+            tool = str(request.get('params', {}).get('name'))
+        if span:
+            span.name = f'{method} {tool}'.strip()
+            span.set_attribute('mcp.method', method)
+            span.set_attribute('mcp.tool', tool)
+        start = time.perf_counter()
+        metrics.MCP_IN_FLIGHT.inc()
+        try:
+            response = self.mcp_server.handle_request(request)
+            outcome = metrics.request_outcome(response) if isinstance(response, dict) else 'stream'
+            if span and outcome == 'error':
+                span.set_error(str(response['error']))
+            return response
+        finally:
+            metrics.MCP_IN_FLIGHT.dec()
+            metrics.MCP_REQUESTS.labels(method, tool, outcome).inc()
+            metrics.MCP_LATENCY.labels(method, tool).observe(time.perf_counter() - start)
+
+    def send_stream(self, lines):
+        """Write an iterable of JSON values as chunked NDJSON"""
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for line in lines:
+                self.write_chunk(json.dumps(line, separators=(',', ':')) + '\n')
+        except Exception as e:
+            self.write_chunk(json.dumps({"error": str(e)}) + '\n')
+        finally:
+            close = getattr(lines, 'close', None)
+            if close:
+                close()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def do_GET(self):
+        if self.path == '/health':
+            # Probes are served on the single health thread; never hold it open
+            self.send_body(200, 'text/plain', b'OK', close=True)
+        elif self.path == '/metrics':
+            self.send_body(200, metrics.CONTENT_TYPE, metrics.REGISTRY.render().encode('utf-8'))
+        elif self.path == '/tools' and isinstance(getattr(self.mcp_server, 'tools', None), ToolRegistry):
+            self.send_tools(self.mcp_server.tools)
+        else:
+            self.send_error(404)
+
+    def send_tools(self, tools):
+        """The tool listing, or 304 when the client already has this version"""
+        headers = {'ETag': tools.etag, 'Cache-Control': 'no-cache'}
+        if self.headers.get('If-None-Match') == tools.etag:
+            self.send_body(304, 'application/json', b'', headers=headers)
+        else:
+            body, encoded = wire.Codec.negotiate(self.headers).encode(tools.listing())
+            headers.update(encoded)
+            self.send_body(200, headers.pop('Content-Type'), body, headers=headers)
+
+
+def register_server_metrics(httpd):
+    """Export worker pool utilisation, read from the server at scrape time"""
+    metrics.gauge('http_workers', 'HTTP worker threads').set_function(lambda: httpd.workers)
+    metrics.gauge('http_workers_busy', 'HTTP workers serving a connection').set_function(lambda: httpd._busy)
+    metrics.gauge('http_queue_depth', 'Connections waiting for a worker').set_function(httpd._requests.qsize)
+    metrics.gauge('http_idle_connections', 'Open connections waiting for their next request'
+                  ).set_function(lambda: httpd.stats()['idle_connections'])
+    metrics.gauge('http_rejected_connections', 'Connections answered with 503 because the queue was full'
+                  ).set_function(lambda: httpd.rejected_total)
+
+
+def serve(handler, name, port=8000):
+    """Run a service on the shared worker-pool server"""
+    tracing.configure(os.getenv('TRACE_SERVICE_NAME', name.lower().replace(' ', '-')))
+    httpd = WorkerPoolHTTPServer(('0.0.0.0', port), handler)
+    register_server_metrics(httpd)
+    print(f"{name} running on port {port} "
+          f"({httpd.workers} workers, queue {httpd.max_queue})")
+    httpd.serve_forever()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from common import metrics
+
+COALESCED = metrics.counter('tool_calls_coalesced', 'Tool calls answered by a concurrent identical call',
+                            ('tool',))
+CACHE_HITS = metrics.counter('tool_result_cache_hits', 'Tool calls answered from the result cache', ('tool',))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    The first caller runs the function; callers arriving while it is in
+    flight wait for it and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key) -> bool:
+        """Whether a call for key is running, so a new caller would share it"""
+        return key in self._calls
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            self.shared += 1
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ToolCallCoalescer:
+    """Front for an MCP server that deduplicates identical read-only tool calls.
+
+    Read-only tools and their result cache TTLs come from the server's
+    ToolRegistry (`@tools.tool(read_only=True, cache_ttl=...)`; a TTL of 0
+    coalesces concurrent calls only). Other requests pass through
+    untouched. TOOL_RESULT_CACHE=off disables the result cache.
+    """
+
+    def __init__(self, mcp_server):
+        self.mcp_server = mcp_server
+        tools = getattr(mcp_server, 'tools', None)
+        self.read_only_tools = tools.read_only_tools() if tools is not None else {}
+        self.cache_enabled = os.getenv('TOOL_RESULT_CACHE', 'on') != 'off'
+        self.flight = SingleFlight()
+        self.cache = TTLCache()
+        self.cache_hits = 0
+
+    def handle_request(self, request):
+        params = request.get('params', {})
+        tool = params.get('name')
+        if request.get('method') != 'tools/call' or tool not in self.read_only_tools:
+            return self.mcp_server.handle_request(request)
+
+        key = (tool, json.dumps(params.get('arguments', {}), sort_keys=True))
+        ttl = self.read_only_tools[tool] if self.cache_enabled else 0
+        if ttl:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache_hits += 1
+                CACHE_HITS.labels(tool).inc()
+                return cached
+
+        led = []
+
+        def call():
+            led.append(True)
+            response = self.mcp_server.handle_request(request)
+            if ttl and 'error' not in response:
+                self.cache.set(key, response, ttl)
+            return response
+
+        response = self.flight.do(key, call)
+        if not led:
+            COALESCED.labels(tool).inc()
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.mcp_server, name)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+from typing import Callable, Dict, List
+
+
+class ValidationError(ValueError):
+    """Tool arguments do not match the tool's input schema"""
+
+
+def _number(kind):
+    def check(value, path):
+        # Numeric strings are accepted, as the handlers used to int()/float() them
+        if isinstance(value, str):
+            try:
+                value = float(value) if kind is float else int(value)
+            except ValueError:
+                raise ValidationError(f"{path} must be a {'number' if kind is float else 'integer'}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValidationError(f"{path} must be a {'number' if kind is float else 'integer'}")
+        if kind is int and value != int(value):
+            raise ValidationError(f"{path} must be an integer")
+        return int(value) if kind is int else value
+    return check
+
+
+def _typed(kind, name):
+    def check(value, path):
+        if not isinstance(value, kind) or (kind is not bool and isinstance(value, bool)):
+            raise ValidationError(f"{path} must be {name}")
+        return value
+    return check
+
+
+TYPE_CHECKS = {
+    'string': _typed(str, 'a string'),
+    'boolean': _typed(bool, 'a boolean'),
+    'integer': _number(int),
+    'number': _number(float),
+    'array': _typed(list, 'an array'),
+    'object': _typed(dict, 'an object')
+}
+
+
+def compile_schema(schema: Dict, strict: bool = False) -> Callable:
+    """Turn a JSON schema (the subset tools use) into a validating function.
+
+    The function returns the value with numeric strings coerced and object
+    defaults filled in, or raises ValidationError. The schema is walked once
+    here, not on every call. With strict, objects reject unknown properties
+    unless additionalProperties says otherwise.
+    """
+    checks = []
+    kind = schema.get('type')
+    if kind:
+        check = TYPE_CHECKS[kind]
+        checks.append(check)
+    if 'enum' in schema:
+        allowed = schema['enum']
+        def enum(value, path):
+            if value not in allowed:
+                raise ValidationError(f"{path} must be one of {allowed}")
+            return value
+        checks.append(enum)
+    if 'minimum' in schema or 'maximum' in schema:
+        low, high = schema.get('minimum'), schema.get('maximum')
+        def bounds(value, path):
+            if (low is not None and value < low) or (high is not None and value > high):
+                raise ValidationError(f"{path} must be between {low} and {high}")
+            return value
+        checks.append(bounds)
+    if kind == 'array' and 'items' in schema:
+        item = compile_schema(schema['items'], strict)
+        checks.append(lambda value, path: [item(v, f"{path}[{i}]") for i, v in enumerate(value)])
+    if kind == 'object':
+        properties = {k: compile_schema(v, strict) for k, v in schema.get('properties', {}).items()}
+        defaults = {k: v['default'] for k, v in schema.get('properties', {}).items() if 'default' in v}
+        required = list(schema.get('required', []))
+        closed = strict and not schema.get('additionalProperties', False) if 'properties' in schema else False
+        def members(value, path):
+            missing = [k for k in required if value.get(k) is None and k not in defaults]
+            if missing:
+                raise ValidationError(f"{path + '.' if path else ''}{missing[0]} is required")
+            if closed:
+                unknown = sorted(set(value) - set(properties))
+                if unknown:
+                    raise ValidationError(f"unexpected argument {path + '.' if path else ''}{unknown[0]}")
+            result = dict(defaults)
+            for k, v in value.items():
+                if v is None:
+                    continue
+                check = properties.get(k)
+                result[k] = check(v, f"{path}.{k}" if path else k) if check else v
+            return result
+        checks.append(members)
+
+    def validate(value, path=''):
+        for check in checks:
+            value = check(value, path or 'arguments')
+        return value
+    return validate
+
+
+class Tool:
+    __slots__ = ('name', 'description', 'input_schema', 'fn', 'validate', 'read_only', 'cache_ttl')
+
+    def __init__(self, name: str, description: str, input_schema: Dict, fn: Callable, read_only: bool = False,
+                 cache_ttl: float = 0):
+        self.name = name
+        self.description = description
+        self.input_schema = input_schema
+        self.fn = fn
+        self.validate = compile_schema(input_schema, strict=True)
+        self.read_only = read_only
+        self.cache_ttl = cache_ttl
+
+    def to_dict(self) -> Dict:
+        tool = {"name": self.name, "description": self.description, "inputSchema": self.input_schema}
+        if self.read_only:
+            # MCP tool annotation: clients may cache or retry this tool freely
+            tool["annotations"] = {"readOnlyHint": True}
+        return tool
+
+
+class ToolRegistry:
+    """Tools declared with @tools.tool on an MCP server class.
+
+    The tools/list response and its ETag are built once, calls are routed by
+    a dict lookup, and arguments are checked against each tool's compiled
+    input schema before the method runs (with the arguments as keywords).
+    """
+
+    def __init__(self):
+        self._tools = {}
+        self._listing = None
+        self._etag = None
+
+    def tool(self, description: str, properties: Dict = None, required: List[str] = (), name: str = None,
+             read_only: bool = False, cache_ttl: float = 0):
+        """Register the decorated method as a tool named after it.
+
+        read_only marks it side-effect free, which is the only place that is
+        declared: the tools/list annotation and ToolCallCoalescer both come
+        from it. cache_ttl is how long a read-only result may be reused.
+        """
+        if cache_ttl and not read_only:
+            raise ValueError("cache_ttl needs read_only")
+
+        def decorator(fn):
+            schema = {"type": "object", "properties": properties or {}}
+            if required:
+                schema["required"] = list(required)
+            tool = Tool(name or fn.__name__, description, schema, fn, read_only, cache_ttl)
+            self._tools[tool.name] = tool
+            self._listing = self._etag = None
+            return fn
+        return decorator
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def read_only_tools(self) -> Dict[str, float]:
+        """Read-only tool name -> seconds its results may be reused (0 = share concurrent calls only)"""
+        return {tool.name: tool.cache_ttl for tool in self._tools.values() if tool.read_only}
+
+    def listing(self) -> Dict:
+        if self._listing is None:
+            self._listing = {"tools": [tool.to_dict() for tool in self._tools.values()]}
+        return self._listing
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            body = json.dumps(self.listing(), sort_keys=True, separators=(',', ':'))
+            self._etag = '"%s"' % hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+        return self._etag
+
+    def call(self, server, name: str, arguments) -> Dict:
+        tool = self._tools.get(name)
+        if tool is None:
+            return {"error": f"Unknown tool: {name}"}
+        try:
+            arguments = tool.validate(arguments if arguments is not None else {})
+        except ValidationError as e:
+            return {"error": f"Invalid arguments for {name}: {e}"}
+        return tool.fn(server, **arguments)
+
+    def handle(self, server, request: Dict) -> Dict:
+        """Answer tools/list and tools/call for server"""
+        method = request.get('method')
+        if method == 'tools/list':
+            return self.listing()
+        if method == 'tools/call':
+            params = request.get('params') or {}
+            return self.call(server, params.get('name'), params.get('arguments'))
+        return {"error": "Unknown method"}
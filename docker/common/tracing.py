@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# W3C trace context: version-traceid-spanid-flags
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+class SpanContext:
+    __slots__ = ('trace_id', 'span_id', 'sampled')
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+
+class Span:
+    """One timed operation. Unsampled spans carry only their context."""
+
+    __slots__ = ('name', 'context', 'parent_id', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str], kind: str):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = time.time_ns() if context.sampled else 0
+        self.end = 0
+        self.attributes = {}
+        self.error = None
+
+    @property
+    def recording(self) -> bool:
+        return self.context.sampled
+
+    def set_attribute(self, key: str, value):
+        if self.context.sampled:
+            self.attributes[key] = value
+
+    def set_error(self, message: str):
+        if self.context.sampled:
+            self.error = message
+
+    def to_dict(self, service: str) -> Dict:
+        return {
+            'service': service,
+            'name': self.name,
+            'kind': self.kind,
+            'trace_id': self.context.trace_id,
+            'span_id': self.context.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start,
+            'end_ns': self.end,
+            'duration_ms': round((self.end - self.start) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class InMemoryExporter:
+    """Keeps finished spans in a list; for tests and local debugging"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: List[Dict]):
+        self.spans.extend(spans)
+
+
+class FileExporter:
+    """Appends finished spans to a file, one JSON object per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Dict]):
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span) + '\n')
+
+
+class OTLPExporter:
+    """Posts spans to an OpenTelemetry collector using OTLP/HTTP JSON"""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.timeout = timeout
+
+    @staticmethod
+    def _attributes(values: Dict) -> List[Dict]:
+        return [{'key': k, 'value': {'stringValue': str(v)}} for k, v in values.items()]
+
+    def export(self, spans: List[Dict]):
+        by_service = {}
+        for span in spans:
+            by_service.setdefault(span['service'], []).append({
+                'traceId': span['trace_id'],
+                'spanId': span['span_id'],
+                'parentSpanId': span['parent_id'] or '',
+                'name': span['name'],
+                'kind': SPAN_KINDS[span['kind']],
+                'startTimeUnixNano': str(span['start_ns']),
+                'endTimeUnixNano': str(span['end_ns']),
+                'attributes': self._attributes(span['attributes']),
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1}
+            })
+        body = {'resourceSpans': [{
+            'resource': {'attributes': self._attributes({'service.name': service})},
+            'scopeSpans': [{'scope': {'name': 'agentic-platform'}, 'spans': service_spans}]
+        } for service, service_spans in by_service.items()]}
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+class BatchProcessor:
+    """Hands finished spans to an exporter from a background thread.
+
+    Request threads only enqueue; when the queue is full spans are dropped
+    rather than slowing the request down.
+    """
+
+    def __init__(self, exporter, max_queue: int = 2048, batch_size: int = 256, interval: float = 2.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        threading.Thread(target=self._run, name='trace-export', daemon=True).start()
+
+    def export(self, spans: List[Dict]):
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                except Exception as e:
+                    print(f"Trace export failed: {e}")
+
+
+class Tracer:
+    """Creates spans and decides which traces are recorded.
+
+    A trace's sampling decision is made once, at its root, with probability
+    `sample_rate`; every later hop follows the flag in the traceparent it
+    received. Unsampled spans skip timing and export entirely.
+    """
+
+    def __init__(self, service: str, exporter=None, sample_rate: float = 1.0):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_env(cls, service: str) -> 'Tracer':
+        """TRACE_EXPORTER=off|memory|file|otlp, TRACE_SAMPLE_RATE, TRACE_FILE"""
+        kind = os.getenv('TRACE_EXPORTER', 'off')
+        sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))
+        if kind == 'memory':
+            return cls(service, InMemoryExporter(), sample_rate)
+        if kind == 'file':
+            exporter = FileExporter(os.getenv('TRACE_FILE', 'traces.ndjson'))
+        elif kind == 'otlp':
+            exporter = OTLPExporter(os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://otel-collector:4318'))
+        else:
+            return cls(service)
+        return cls(service, BatchProcessor(exporter, int(os.getenv('TRACE_QUEUE_SIZE', '2048'))), sample_rate)
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def start(self, name: str, kind: str, parent: Optional[SpanContext]) -> Span:
+        if parent is None:
+            trace_id = f'{random.getrandbits(128):032x}'
+            sampled = random.random() < self.sample_rate
+        else:
+            trace_id, sampled = parent.trace_id, parent.sampled
+        span_id = f'{random.getrandbits(64):016x}'
+        return Span(name, SpanContext(trace_id, span_id, sampled),
+                    parent.span_id if parent else None, kind)
+
+    def finish(self, span: Span):
+        if span.context.sampled:
+            span.end = time.time_ns()
+            self.exporter.export([span.to_dict(self.service)])
+
+
+_tracer = Tracer('unknown')
+
+
+def configure(service: str, exporter=None, sample_rate: float = None) -> Tracer:
+    """Install the process tracer; without an exporter it is built from TRACE_* settings"""
+    global _tracer
+    if exporter is None:
+        _tracer = Tracer.from_env(service)
+    else:
+        _tracer = Tracer(service, exporter, 1.0 if sample_rate is None else sample_rate)
+    return _tracer
+
+
+def tracer() -> Tracer:
+    return _tracer
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, kind: str = 'internal', parent: SpanContext = None, **attributes):
+    """Run the body inside a child of `parent` (default: the current span)"""
+    if not _tracer.enabled:
+        yield None
+        return
+    current = _current.get()
+    if parent is None and current is not None:
+        if not current.context.sampled:
+            # Nothing below an unsampled span is recorded; reuse it for propagation
+            yield current
+            return
+        parent = current.context
+    s = _tracer.start(name, kind, parent)
+    if s.recording:
+        s.attributes.update(attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.set_error(f'{type(e).__name__}: {e}')
+        raise
+    finally:
+        _current.reset(token)
+        _tracer.finish(s)
+
+
+def extract(headers) -> Optional[SpanContext]:
+    """Parent context from an incoming traceparent header, if valid"""
+    match = TRACEPARENT.match((headers.get('traceparent') or '').strip())
+    if not match:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def inject(headers: Dict = None) -> Dict:
+    """Headers carrying the current span to the next hop"""
+    headers = {} if headers is None else headers
+    current = _current.get()
+    if current is not None:
+        headers['traceparent'] = current.context.traceparent()
+    return headers
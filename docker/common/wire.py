@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import os
+from typing import Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+# Clients that send this header take tool results as structuredContent
+# instead of JSON text inside content[0].text
+STRUCTURED_HEADER = 'MCP-Structured-Content'
+GZIP_MIN_BYTES = int(os.getenv('WIRE_GZIP_MIN_BYTES', '32768'))
+
+
+def structured(value, **extra) -> Dict:
+    """A tool result carrying value as data rather than pre-rendered text"""
+    return dict(extra, structuredContent=value)
+
+
+def as_text(response):
+    """The response as older clients expect it, with the value as JSON text"""
+    if isinstance(response, list):
+        return [as_text(r) for r in response]
+    if not isinstance(response, dict) or 'structuredContent' not in response:
+        return response
+    response = dict(response)
+    value = response.pop('structuredContent')
+    response['content'] = [{"type": "text", "text": json.dumps(value, indent=2, default=str)}]
+    return response
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def loads(data: bytes, content_type: str = JSON, content_encoding: str = None):
+    """Decode a request or response body sent with the given headers"""
+    if content_encoding and 'gzip' in content_encoding:
+        data = gzip.decompress(data)
+    if MSGPACK in (content_type or ''):
+        if msgpack is None:
+            raise ValueError(f"{MSGPACK} is not supported here")
+        return msgpack.unpackb(data)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+class Codec:
+    """How one response is encoded, negotiated from the request headers.
+
+    Accept picks msgpack (when installed) or JSON, which is written with
+    orjson when available. MCP-Structured-Content keeps tool results as
+    structuredContent; without it they are rendered to text exactly as
+    before. Bodies of GZIP_MIN_BYTES or more are gzipped for clients that
+    accept it.
+    """
+
+    def __init__(self, content_type: str = JSON, structured: bool = False, gzip_ok: bool = False):
+        self.content_type = content_type
+        self.structured = structured
+        self.gzip_ok = gzip_ok
+
+    @classmethod
+    def negotiate(cls, headers) -> 'Codec':
+        accept = headers.get('Accept') or ''
+        content_type = MSGPACK if msgpack is not None and MSGPACK in accept else JSON
+        return cls(content_type,
+                   structured=(headers.get(STRUCTURED_HEADER) or '').strip() not in ('', '0'),
+                   gzip_ok='gzip' in (headers.get('Accept-Encoding') or ''))
+
+    @staticmethod
+    def request_headers() -> Dict:
+        """Headers a client sends to get the most compact responses available"""
+        return {
+            'Content-Type': JSON,
+            'Accept': f'{MSGPACK}, {JSON};q=0.9' if msgpack is not None else JSON,
+            'Accept-Encoding': 'gzip',
+            STRUCTURED_HEADER: '1'
+        }
+
+    def encode(self, response):
+        """(body, headers) for a response value"""
+        if not self.structured:
+            response = as_text(response)
+        if self.content_type == MSGPACK:
+            body = msgpack.packb(response, default=str)
+        else:
+            body = dumps(response)
+        headers = {'Content-Type': self.content_type}
+        if self.gzip_ok and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
@@ -1,141 +1,120 @@
 #!/usr/bin/env python3
-import json
 import sys
-import requests
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from common import metrics, wire
+from common.server import MCPHandler, serve
+from common.singleflight import ToolCallCoalescer
+from common.tools import ToolRegistry
+from kvstore import KVStore
+from weather import ProviderError, WeatherService
 
 class CustomMCP:
+    tools = ToolRegistry()
+    
     def __init__(self):
-        self.data_store = {}
+        self.data_store = KVStore.from_env()
+        self.weather = WeatherService.from_env()
+        for name, field, description in [('kv_keys', 'keys', 'Keys held by the store'),
+                                         ('kv_bytes', 'bytes', 'Value bytes held by the store'),
+                                         ('kv_evictions', 'evictions', 'Keys evicted to stay within bounds')]:
+            metrics.gauge(name, description).set_function(lambda field=field: self.data_store.stats()[field])
     
     def handle_request(self, request):
-        method = request.get('method')
-        params = request.get('params', {})
-        
-        if method == 'tools/list':
-            return {
-                "tools": [
-                    {
-                        "name": "store_data",
-                        "description": "Store key-value data",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "key": {"type": "string", "description": "Data key"},
-                                "value": {"type": "string", "description": "Data value"}
-                            },
-                            "required": ["key", "value"]
-                        }
-                    },
-                    {
-                        "name": "get_data",
-                        "description": "Retrieve stored data",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "key": {"type": "string", "description": "Data key"}
-                            },
-                            "required": ["key"]
-                        }
-                    },
-                    {
-                        "name": "get_weather",
-                        "description": "Get weather info",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "city": {"type": "string", "description": "City name"}
-                            },
-                            "required": ["city"]
-                        }
-                    }
-                ]
-            }
-        
-        elif method == 'tools/call':
-            tool_name = params.get('name')
-            args = params.get('arguments', {})
-            
-            if tool_name == 'store_data':
-                return self.store_data(args['key'], args['value'])
-            elif tool_name == 'get_data':
-                return self.get_data(args['key'])
-            elif tool_name == 'get_weather':
-                return self.get_weather(args['city'])
-        
-        return {"error": "Unknown method"}
+        return self.tools.handle(self, request)
     
-    def store_data(self, key, value):
-        self.data_store[key] = {
-            "value": value,
-            "timestamp": datetime.now().isoformat()
+    @staticmethod
+    def describe(entry):
+        data = {
+            "value": entry.value,
+            "timestamp": datetime.fromtimestamp(entry.timestamp).isoformat()
         }
+        if entry.expires is not None:
+            data["expires_at"] = datetime.fromtimestamp(entry.expires).isoformat()
+        return data
+    
+    @tools.tool("Store key-value data", {
+        "key": {"type": "string", "description": "Data key"},
+        "value": {"type": "string", "description": "Data value"},
+        "ttl_seconds": {"type": "number", "description": "Expire the key after this many seconds (0 = never)"}
+    }, required=["key", "value"])
+    def store_data(self, key, value, ttl_seconds=None):
+        self.data_store.put(key, value, ttl_seconds)
         return {"content": [{"type": "text", "text": f"Stored '{key}' = '{value}'"}]}
     
+    @tools.tool("Retrieve stored data", {
+        "key": {"type": "string", "description": "Data key"}
+    }, required=["key"], read_only=True)
     def get_data(self, key):
-        if key in self.data_store:
-            data = self.data_store[key]
-            return {"content": [{"type": "text", "text": json.dumps(data, indent=2)}]}
+        entry = self.data_store.get(key)
+        if entry:
+            return wire.structured(self.describe(entry))
         else:
             return {"error": f"Key '{key}' not found"}
     
-    def get_weather(self, city):
-        try:
-            url = f"https://wttr.in/{city}?format=j1"
-            response = requests.get(url, timeout=5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                current = data['current_condition'][0]
-                weather_info = {
-                    "city": city,
-                    "temperature": f"{current['temp_C']}°C",
-                    "description": current['weatherDesc'][0]['value']
-                }
-                return {"content": [{"type": "text", "text": json.dumps(weather_info, indent=2)}]}
-            else:
-                return {"error": f"Weather API error: {response.status_code}"}
-        
-        except Exception as e:
-            return {"error": f"Weather request failed: {str(e)}"}
-
-class MCPHandler(BaseHTTPRequestHandler):
-    def __init__(self, mcp_server, *args, **kwargs):
-        self.mcp_server = mcp_server
-        super().__init__(*args, **kwargs)
+    @tools.tool("Store several key-value pairs", {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "key": {"type": "string"},
+                    "value": {"type": "string"},
+                    "ttl_seconds": {"type": "number"}
+                },
+                "required": ["key", "value"]
+            }
+        }
+    }, required=["items"])
+    def put_many(self, items):
+        stored = self.data_store.put_many(items)
+        return {"content": [{"type": "text", "text": f"Stored {stored} keys"}]}
     
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        
-        try:
-            request = json.loads(post_data.decode('utf-8'))
-            response = self.mcp_server.handle_request(request)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
+    @tools.tool("Retrieve several keys; missing keys map to null", {
+        "keys": {"type": "array", "items": {"type": "string"}}
+    }, required=["keys"], read_only=True)
+    def get_many(self, keys):
+        entries = self.data_store.get_many(keys)
+        data = {key: self.describe(entry) if entry else None for key, entry in entries.items()}
+        return wire.structured(data)
+    
+    @tools.tool("List stored keys starting with a prefix, in key order", {
+        "prefix": {"type": "string", "description": "Key prefix"},
+        "limit": {"type": "integer", "default": 100},
+        "after": {"type": "string", "description": "Continue after this key"}
+    }, required=["prefix"], read_only=True)
+    def scan_prefix(self, prefix, limit, after=None):
+        limit = max(1, min(int(limit), 1000))
+        entries = self.data_store.scan(prefix, limit + 1, after)
+        result = {"items": {key: self.describe(entry) for key, entry in entries[:limit]}}
+        if len(entries) > limit:
+            result["next_after"] = entries[limit - 1][0]
+        return wire.structured(result)
+    
+    @tools.tool("Delete stored data", {
+        "key": {"type": "string", "description": "Data key"}
+    }, required=["key"])
+    def delete_data(self, key):
+        if self.data_store.delete(key):
+            return {"content": [{"type": "text", "text": f"Deleted '{key}'"}]}
+        return {"error": f"Key '{key}' not found"}
     
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
+    # No cache_ttl: WeatherService caches per city, so only concurrent calls are shared
+    @tools.tool("Get weather info", {
+        "city": {"type": "string", "description": "City name"}
+    }, required=["city"], read_only=True)
+    def get_weather(self, city):
+        try:
+            weather_info, cache = self.weather.get(city)
+        except ProviderError as e:
+            return {"error": str(e)}
+        return wire.structured(weather_info, _meta={"cache": cache})
 
 if __name__ == "__main__":
     server = CustomMCP()
     
+    coalesced = ToolCallCoalescer(server)
+    
     def handler(*args, **kwargs):
-        MCPHandler(server, *args, **kwargs)
+        MCPHandler(coalesced, *args, **kwargs)
     
-    httpd = HTTPServer(('0.0.0.0', 8000), handler)
-    print("Custom MCP Server running on port 8000")
-    httpd.serve_forever()
\ No newline at end of file
+    serve(handler, "Custom MCP Server")
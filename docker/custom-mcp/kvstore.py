@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class Entry:
+    __slots__ = ('value', 'timestamp', 'expires', 'size')
+
+    def __init__(self, value: str, timestamp: float, expires: Optional[float]):
+        self.value = value
+        self.timestamp = timestamp
+        self.expires = expires
+        self.size = len(value)
+
+    def expired(self, now: float) -> bool:
+        return self.expires is not None and self.expires <= now
+
+
+class AppendLog:
+    """Append-only record of puts and deletes, replayed on startup.
+
+    Every write is flushed to the OS, so a crashed process loses nothing;
+    fsync runs at most every `fsync_interval` seconds to keep write rates
+    high. The log is rewritten with only live entries once it grows
+    `compact_ratio` times larger than it was after the last rewrite (and
+    than the data it holds), so rewrites stay amortized whatever the
+    per-record overhead.
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 1.0, compact_ratio: float = 2.0,
+                 compact_min_bytes: int = 1 << 20):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.compactions = 0
+        self.compacted_size = 0
+        self._file = None
+        self._last_sync = time.monotonic()
+
+    def replay(self):
+        """Yield (op, key, entry) records; a torn final line is ignored"""
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    entry = None
+                    if record['op'] == 'put':
+                        entry = Entry(record['v'], record['ts'], record.get('exp'))
+                    yield record['op'], record['k'], entry
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    @property
+    def size(self) -> int:
+        return self._file.tell() if self._file else 0
+
+    def _write(self, record: Dict):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        now = time.monotonic()
+        if now - self._last_sync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+    def put(self, key: str, entry: Entry):
+        record = {'op': 'put', 'k': key, 'v': entry.value, 'ts': entry.timestamp}
+        if entry.expires is not None:
+            record['exp'] = entry.expires
+        self._write(record)
+
+    def delete(self, key: str):
+        self._write({'op': 'del', 'k': key})
+
+    def needs_compaction(self, live_bytes: int) -> bool:
+        size = self.size
+        return size > self.compact_min_bytes and size > max(live_bytes, self.compacted_size) * self.compact_ratio
+
+    def compact(self, entries):
+        """Replace the log with one put per live entry"""
+        tmp = self.path + '.compact'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for key, entry in entries:
+                record = {'op': 'put', 'k': key, 'v': entry.value, 'ts': entry.timestamp}
+                if entry.expires is not None:
+                    record['exp'] = entry.expires
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self.compacted_size = self.size
+        self.compactions += 1
+
+    def close(self):
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class KVStore:
+    """Bounded key-value store with per-key TTL and LRU eviction.
+
+    Values are held in memory, capped by entry count and total value bytes;
+    the least recently used keys are evicted first. With a log, writes are
+    persisted and the store is rebuilt from the log on startup.
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, default_ttl: float = None,
+                 log: AppendLog = None):
+        self.max_entries = max_entries or int(os.getenv('KV_MAX_ENTRIES', '100000'))
+        self.max_bytes = max_bytes or int(os.getenv('KV_MAX_BYTES', str(64 << 20)))
+        self.default_ttl = default_ttl if default_ttl is not None else float(os.getenv('KV_DEFAULT_TTL', '0'))
+        self.log = log
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if log:
+            self._replay()
+
+    @classmethod
+    def from_env(cls) -> 'KVStore':
+        """KV_PATH enables persistence; unset keeps the store in memory only"""
+        path = os.getenv('KV_PATH')
+        log = None
+        if path:
+            log = AppendLog(path, fsync_interval=float(os.getenv('KV_FSYNC_INTERVAL', '1')))
+        return cls(log=log)
+
+    def _replay(self):
+        now = time.time()
+        started = time.monotonic()
+        for op, key, entry in self.log.replay():
+            if op == 'put' and not entry.expired(now):
+                self._set(key, entry)
+            else:
+                self._remove(key)
+        self.evictions = 0
+        self._maybe_compact()
+        print(f"KV store restored {len(self._entries)} keys in {time.monotonic() - started:.2f}s")
+
+    def _remove(self, key: str) -> Optional[Entry]:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry.size
+        return entry
+
+    def _set(self, key: str, entry: Entry):
+        self._remove(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def _maybe_compact(self):
+        if self.log and self.log.needs_compaction(self.bytes):
+            now = time.time()
+            self.log.compact((k, e) for k, e in self._entries.items() if not e.expired(now))
+
+    def _live(self, key: str, now: float) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expired(now):
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value: str, ttl: float = None) -> Entry:
+        ttl = self.default_ttl if ttl is None else float(ttl)
+        now = time.time()
+        entry = Entry(value, now, now + ttl if ttl else None)
+        with self._lock:
+            self._set(key, entry)
+            if self.log:
+                self.log.put(key, entry)
+                self._maybe_compact()
+        return entry
+
+    def put_many(self, items: List[Dict]) -> int:
+        """Store [{"key", "value", "ttl_seconds"?}, ...] under one lock"""
+        now = time.time()
+        with self._lock:
+            for item in items:
+                ttl = item.get('ttl_seconds')
+                ttl = self.default_ttl if ttl is None else float(ttl)
+                entry = Entry(item['value'], now, now + ttl if ttl else None)
+                self._set(item['key'], entry)
+                if self.log:
+                    self.log.put(item['key'], entry)
+            self._maybe_compact()
+        return len(items)
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            return self._live(key, time.time())
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[Entry]]:
+        now = time.time()
+        with self._lock:
+            return {key: self._live(key, now) for key in keys}
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            entry = self._remove(key)
+            if entry and self.log:
+                self.log.delete(key)
+        return entry is not None
+
+    def scan(self, prefix: str, limit: int = 100, after: str = None) -> List:
+        """Live (key, entry) pairs starting with prefix, in key order"""
+        now = time.time()
+        with self._lock:
+            keys = sorted(k for k, e in self._entries.items()
+                          if k.startswith(prefix) and (after is None or k > after) and not e.expired(now))
+            return [(k, self._entries[k]) for k in keys[:limit]]
+
+    def stats(self) -> Dict:
+        return {
+            'keys': len(self._entries),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'log_bytes': self.log.size if self.log else None,
+            'compactions': self.log.compactions if self.log else None
+        }
+
+    def close(self):
+        if self.log:
+            with self._lock:
+                self.log.close()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from common import metrics
+from common.singleflight import SingleFlight
+
+WEATHER_LOOKUPS = metrics.counter('weather_lookups', 'Weather lookups by how they were answered', ('result',))
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class ProviderError(Exception):
+    """The weather upstream failed or refused the request"""
+
+
+class WttrProvider:
+    """wttr.in over a keep-alive session"""
+
+    name = 'wttr'
+
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def fetch(self, city: str) -> Tuple[Dict, Optional[float]]:
+        """Current conditions and the upstream's max-age, if it sent one"""
+        try:
+            with metrics.upstream('wttr', 'weather'):
+                response = self.session.get(f"https://wttr.in/{city}?format=j1", timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ProviderError(f"Weather request failed: {e}")
+        if response.status_code != 200:
+            raise ProviderError(f"Weather API error: {response.status_code}")
+        current = response.json()['current_condition'][0]
+        max_age = MAX_AGE.search(response.headers.get('Cache-Control', ''))
+        return {
+            "city": city,
+            "temperature": f"{current['temp_C']}°C",
+            "description": current['weatherDesc'][0]['value']
+        }, float(max_age.group(1)) if max_age else None
+
+
+class FakeProvider:
+    """Deterministic offline weather for tests and local runs.
+
+    `fail` can be flipped to make every fetch raise, and `latency` adds a
+    delay, so caching, breaker and rate limiting can be exercised offline.
+    """
+
+    name = 'fake'
+    DESCRIPTIONS = ('Sunny', 'Partly cloudy', 'Overcast', 'Light rain', 'Snow')
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.fail = False
+        self.calls = 0
+
+    def fetch(self, city: str) -> Tuple[Dict, Optional[float]]:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise ProviderError("Fake provider failure")
+        seed = int(hashlib.sha1(city.lower().encode('utf-8')).hexdigest(), 16)
+        return {
+            "city": city,
+            "temperature": f"{seed % 40 - 5}°C",
+            "description": self.DESCRIPTIONS[seed % len(self.DESCRIPTIONS)]
+        }, None
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after repeated failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    calls are refused for `reset_timeout` seconds; then a single trial call
+    is let through (half-open) and its outcome closes or reopens it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+
+class WeatherService:
+    """Per-city weather cache in front of a provider.
+
+    Entries are fresh for `fresh_ttl` seconds (or the provider's max-age).
+    A stale entry younger than `stale_ttl` is served at once while one
+    background refresh runs. Older entries, up to `stale_if_error`, are
+    still served when the provider fails, is rate limited or has its
+    breaker open. Concurrent fetches for one city (misses and refreshes)
+    share a single provider call.
+    """
+
+    def __init__(self, provider, fresh_ttl: float = None, stale_ttl: float = None,
+                 stale_if_error: float = None, limiter: TokenBucket = None, breaker: CircuitBreaker = None,
+                 max_entries: int = None):
+        self.provider = provider
+        self.fresh_ttl = fresh_ttl or float(os.getenv('WEATHER_FRESH_SECONDS', '600'))
+        self.stale_ttl = stale_ttl or float(os.getenv('WEATHER_STALE_SECONDS', '3600'))
+        self.stale_if_error = stale_if_error or float(os.getenv('WEATHER_STALE_IF_ERROR_SECONDS', '86400'))
+        self.limiter = limiter or TokenBucket(float(os.getenv('WEATHER_RATE_PER_SECOND', '2')),
+                                              int(os.getenv('WEATHER_BURST', '5')))
+        self.breaker = breaker or CircuitBreaker(int(os.getenv('WEATHER_BREAKER_FAILURES', '5')),
+                                                 float(os.getenv('WEATHER_BREAKER_RESET_SECONDS', '30')))
+        self.max_entries = max_entries or int(os.getenv('WEATHER_CACHE_MAX_ENTRIES', '1024'))
+        self._cache = OrderedDict()
+        self._refreshing = set()
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        metrics.gauge('weather_breaker_open', 'Whether the weather provider circuit breaker is open'
+                      ).set_function(lambda: int(self.breaker.state != CircuitBreaker.CLOSED))
+
+    @classmethod
+    def from_env(cls) -> 'WeatherService':
+        """WEATHER_PROVIDER=wttr (default) or fake"""
+        if os.getenv('WEATHER_PROVIDER', 'wttr') == 'fake':
+            provider = FakeProvider(float(os.getenv('WEATHER_FAKE_LATENCY', '0')))
+        else:
+            provider = WttrProvider(float(os.getenv('WEATHER_TIMEOUT', '5')))
+        return cls(provider)
+
+    @staticmethod
+    def _key(city: str) -> str:
+        return ' '.join(city.lower().split())
+
+    def _lookup(self, key: str):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry:
+                self._cache.move_to_end(key)
+            return entry
+
+    def _store(self, key: str, data: Dict, max_age: Optional[float]):
+        with self._lock:
+            self._cache[key] = (data, time.time(), max_age or self.fresh_ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _fetch(self, key: str, city: str) -> Dict:
+        return self._flight.do(key, lambda: self._fetch_now(key, city))
+
+    def _fetch_now(self, key: str, city: str) -> Dict:
+        # Rate limit first: a half-open breaker's trial call must always report back
+        if not self.limiter.try_acquire():
+            raise ProviderError("Weather provider rate limit reached")
+        if not self.breaker.allow():
+            raise ProviderError("Weather provider unavailable (circuit open)")
+        try:
+            data, max_age = self.provider.fetch(city)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self._store(key, data, max_age)
+        return data
+
+    def _refresh(self, key: str, city: str):
+        try:
+            self._fetch(key, city)
+        except Exception as e:
+            print(f"Weather refresh for {city} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, city: str) -> Tuple[Dict, Dict]:
+        """Weather for city and how it was obtained; raises ProviderError"""
+        key = self._key(city)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry:
+            data, fetched, fresh_for = entry
+            age = now - fetched
+            if age < fresh_for:
+                WEATHER_LOOKUPS.labels('hit').inc()
+                return data, {"source": "cache", "age_seconds": round(age, 1)}
+            if age < fresh_for + self.stale_ttl:
+                with self._lock:
+                    start = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start:
+                    threading.Thread(target=self._refresh, args=(key, city), daemon=True).start()
+                WEATHER_LOOKUPS.labels('stale').inc()
+                return data, {"source": "stale", "age_seconds": round(age, 1)}
+        coalesced = self._flight.in_flight(key)
+        try:
+            data = self._fetch(key, city)
+        except Exception as e:
+            error = e if isinstance(e, ProviderError) else ProviderError(f"Weather request failed: {e}")
+            if entry and now - entry[1] < entry[2] + self.stale_if_error:
+                WEATHER_LOOKUPS.labels('stale').inc()
+                return entry[0], {"source": "stale", "age_seconds": round(now - entry[1], 1),
+                                  "error": str(error)}
+            WEATHER_LOOKUPS.labels('error').inc()
+            raise error
+        WEATHER_LOOKUPS.labels('coalesced' if coalesced else 'miss').inc()
+        return data, {"source": self.provider.name, "age_seconds": 0}
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+from common import metrics
+
+# Statements that may run on a read-only connection. SQLite itself enforces
+# the split: anything that writes fails there and is retried on the writer.
+READ_PREFIXES = ('SELECT', 'WITH', 'EXPLAIN', 'VALUES')
+LEADING_COMMENTS = re.compile(r'^(\s+|--[^\n]*(\n|$)|/\*.*?\*/)+', re.S)
+READONLY_ERROR = 'attempt to write a readonly database'
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def is_read_query(query: str) -> bool:
+    return LEADING_COMMENTS.sub('', query)[:7].upper().startswith(READ_PREFIXES)
+
+
+def default_pragmas() -> Dict[str, str]:
+    return {
+        'cache_size': os.getenv('SQLITE_CACHE_SIZE', '-16000'),      # KiB when negative
+        'mmap_size': os.getenv('SQLITE_MMAP_SIZE', '268435456'),
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),   # durable enough with WAL
+        'busy_timeout': os.getenv('SQLITE_BUSY_TIMEOUT', '5000'),
+        'temp_store': 'MEMORY'
+    }
+
+
+class SQLiteEngine:
+    """Pooled SQLite access in WAL mode.
+
+    One writer connection serialises writes (SQLite allows a single writer);
+    a pool of read-only connections serves reads concurrently from WAL
+    snapshots. Each connection keeps its own prepared-statement cache.
+    """
+
+    def __init__(self, db_path: str, pool_size: int = None, pragmas: Dict[str, str] = None,
+                 statement_cache: int = None):
+        self.db_path = db_path
+        self.pool_size = pool_size or int(os.getenv('SQLITE_POOL_SIZE', '8'))
+        self.pragmas = {**default_pragmas(), **(pragmas or {})}
+        self.statement_cache = statement_cache or int(os.getenv('SQLITE_STATEMENT_CACHE', '256'))
+
+        self._writer = self._connect(read_only=False)
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._write_lock = threading.Lock()
+
+        self._readers = queue.Queue()
+        for _ in range(self.pool_size):
+            self._readers.put(self._connect(read_only=True))
+        metrics.gauge('sqlite_readers_idle', 'Read-only connections waiting in the pool'
+                      ).set_function(self._readers.qsize)
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True,
+                                   check_same_thread=False, cached_statements=self.statement_cache)
+            conn.execute('PRAGMA query_only=ON')
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   cached_statements=self.statement_cache)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """Exclusive writer connection; commits on success, rolls back on error"""
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    def execute(self, query: str, params=()) -> Dict:
+        """Run one statement on the right connection.
+
+        Returns rows (as dicts) for statements that produce a result set,
+        otherwise the affected row count.
+        """
+        if is_read_query(query):
+            try:
+                with metrics.upstream('sqlite', 'read'), self.reader() as conn:
+                    return self._collect(conn.execute(query, params))
+            except sqlite3.OperationalError as e:
+                if READONLY_ERROR not in str(e):
+                    raise
+        with metrics.upstream('sqlite', 'write'), self.writer() as conn:
+            # total_changes also counts rows for CTE-prefixed DML, unlike cursor.rowcount
+            before = conn.total_changes
+            cursor = conn.execute(query, params)
+            if cursor.description is None:
+                return {"rowcount": conn.total_changes - before}
+            return {"rows": [dict(row) for row in cursor.fetchall()]}
+
+    def iterate(self, query: str, params=(), offset: int = 0, batch_size: int = 500):
+        """Yield the column names, then row batches of a read query.
+
+        Rows are pulled with fetchmany, so memory is bounded by batch_size
+        however large the result. One reader is held until the generator
+        is exhausted or closed.
+        """
+        with self.reader() as conn:
+            cursor = conn.execute(query, params)
+            try:
+                yield [column[0] for column in cursor.description or []]
+                while offset > 0:
+                    skipped = cursor.fetchmany(min(batch_size, offset))
+                    if not skipped:
+                        return
+                    offset -= len(skipped)
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        return
+                    yield batch
+            finally:
+                # Finalise the statement so the reader drops its WAL snapshot
+                cursor.close()
+
+    def page(self, query: str, offset: int, limit: int, params=()):
+        """One page of a read query: (columns, rows, has_more)"""
+        batches = self.iterate(query, params, offset, batch_size=limit + 1)
+        try:
+            with metrics.upstream('sqlite', 'page'):
+                columns = next(batches)
+                rows = next(batches, [])
+        finally:
+            batches.close()
+        return columns, rows[:limit], len(rows) > limit
+
+    def keyset_page(self, query: str, key: str, after, limit: int, params=()):
+        """One page of a read query ordered by its unique column `key`, starting after `after`.
+
+        The filter and order are applied around the query, so each page is
+        an index seek when `key` is indexed instead of skipping earlier rows.
+        """
+        if not IDENTIFIER.match(key):
+            raise ValueError(f"Invalid key column: {key}")
+        query = query.strip().rstrip(';')
+        if after is None:
+            sql = f'SELECT * FROM ({query}) ORDER BY "{key}"'
+        else:
+            sql = f'SELECT * FROM ({query}) WHERE "{key}" > ? ORDER BY "{key}"'
+            params = tuple(params) + (after,)
+        columns, rows, has_more = self.page(sql, 0, limit, params)
+        # SQLite reads an unknown "name" as a string literal rather than failing
+        if key.lower() not in (column.lower() for column in columns):
+            raise ValueError(f"Key column {key} is not in the query result")
+        return columns, rows, has_more
+
+    @staticmethod
+    def _collect(cursor) -> Dict:
+        if cursor.description is None:
+            return {"rowcount": cursor.rowcount}
+        return {"rows": [dict(row) for row in cursor.fetchall()]}
+
+    def close(self):
+        self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
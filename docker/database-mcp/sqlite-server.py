@@ -1,124 +1,160 @@
 #!/usr/bin/env python3
+import base64
+import hashlib
 import json
-import sys
+import os
 import sqlite3
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import sys
+import time
+from engine import READONLY_ERROR, SQLiteEngine, is_read_query
+from common import wire
+from common.server import MCPHandler, serve
+from common.singleflight import ToolCallCoalescer
+from common.tools import ToolRegistry
+
+DEFAULT_PAGE_SIZE = int(os.getenv('DB_DEFAULT_PAGE_SIZE', '500'))
+MAX_PAGE_SIZE = int(os.getenv('DB_MAX_PAGE_SIZE', '5000'))
+STREAM_BATCH_SIZE = int(os.getenv('DB_STREAM_BATCH_SIZE', '500'))
+# A stream holds a reader and its WAL snapshot until it ends, so it is cut off
+STREAM_MAX_SECONDS = float(os.getenv('DB_STREAM_MAX_SECONDS', '60'))
+STREAM_MAX_ROWS = int(os.getenv('DB_STREAM_MAX_ROWS', '1000000'))
+
+def encode_cursor(position, query):
+    """position is {"o": offset} or, for keyset paging, {"k": key column, "a": last key value}"""
+    token = json.dumps({**position, "q": hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]})
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, query):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if token.get("q") != hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]:
+        raise ValueError("Cursor does not belong to this query")
+    return token
 
 class SQLiteMCP:
+    tools = ToolRegistry()
+    
     def __init__(self, db_path="learning.db"):
         self.db_path = db_path
+        self.engine = SQLiteEngine(db_path)
         self.init_sample_data()
     
     def init_sample_data(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute("SELECT COUNT(*) FROM users")
-        if cursor.fetchone()[0] == 0:
-            sample_users = [
-                ("Alice Johnson", "alice@example.com"),
-                ("Bob Smith", "bob@example.com")
-            ]
-            cursor.executemany("INSERT INTO users (name, email) VALUES (?, ?)", sample_users)
-        
-        conn.commit()
-        conn.close()
+        with self.engine.writer() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    email TEXT UNIQUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute("SELECT COUNT(*) FROM users")
+            if cursor.fetchone()[0] == 0:
+                sample_users = [
+                    ("Alice Johnson", "alice@example.com"),
+                    ("Bob Smith", "bob@example.com")
+                ]
+                cursor.executemany("INSERT INTO users (name, email) VALUES (?, ?)", sample_users)
     
     def handle_request(self, request):
-        method = request.get('method')
-        params = request.get('params', {})
-        
-        if method == 'tools/list':
-            return {
-                "tools": [
-                    {
-                        "name": "execute_query",
-                        "description": "Execute a SQL query",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "query": {"type": "string", "description": "SQL query to execute"}
-                            },
-                            "required": ["query"]
-                        }
-                    }
-                ]
-            }
-        
-        elif method == 'tools/call':
-            tool_name = params.get('name')
-            args = params.get('arguments', {})
-            
-            if tool_name == 'execute_query':
-                return self.execute_query(args['query'])
-        
-        return {"error": "Unknown method"}
+        return self.tools.handle(self, request)
     
-    def execute_query(self, query):
+    @tools.tool("Execute a SQL query", {
+        "query": {"type": "string", "description": "SQL query to execute"},
+        "limit": {"type": "integer", "description": f"Rows per page (default {DEFAULT_PAGE_SIZE}, max {MAX_PAGE_SIZE})"},
+        "cursor": {"type": "string", "description": "next_cursor from the previous page"},
+        "key": {"type": "string",
+                "description": "Unique result column to page by (keyset paging, ordered by it); "
+                               "without it pages are found by offset, which slows down deep into large results"},
+        "format": {"type": "string", "enum": ["rows", "columnar"], "default": "rows",
+                   "description": "rows: list of objects; columnar: column names once, rows as arrays"},
+        "stream": {"type": "boolean", "default": False,
+                   "description": "Stream every row as NDJSON instead of paging"}
+    }, required=["query"])
+    def execute_query(self, query, limit=None, cursor=None, format='rows', stream=False, key=None):
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            if is_read_query(query):
+                try:
+                    if stream:
+                        return self.stream_query(query, format)
+                    return self.query_page(query, limit, cursor, format, key)
+                except sqlite3.OperationalError as e:
+                    # Read-looking statement that writes (e.g. WITH ... INSERT)
+                    if READONLY_ERROR not in str(e):
+                        raise
             
-            cursor.execute(query)
+            result = self.engine.execute(query)
             
-            if query.strip().upper().startswith('SELECT'):
-                results = [dict(row) for row in cursor.fetchall()]
-                return {"content": [{"type": "text", "text": json.dumps(results, indent=2)}]}
+            if "rows" in result:
+                return wire.structured(result["rows"])
             else:
-                conn.commit()
-                return {"content": [{"type": "text", "text": f"Query executed. Rows affected: {cursor.rowcount}"}]}
+                return {"content": [{"type": "text", "text": f"Query executed. Rows affected: {result['rowcount']}"}]}
         
         except Exception as e:
             return {"error": str(e)}
-        finally:
-            conn.close()
-
-class MCPHandler(BaseHTTPRequestHandler):
-    def __init__(self, mcp_server, *args, **kwargs):
-        self.mcp_server = mcp_server
-        super().__init__(*args, **kwargs)
     
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
+    def query_page(self, query, limit, cursor, format, key=None):
+        """One page of a read query plus an opaque cursor for the next one"""
+        position = decode_cursor(cursor, query) if cursor else {}
+        key = key or position.get("k")
+        limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        if key:
+            if position and position.get("k") != key:
+                raise ValueError("Cursor was not issued for this key")
+            columns, rows, has_more = self.engine.keyset_page(query, key, position.get("a"), limit)
+            next_cursor = encode_cursor({"k": key, "a": rows[-1][key]}, query) if has_more else None
+        else:
+            offset = int(position.get("o", 0))
+            columns, rows, has_more = self.engine.page(query, offset, limit)
+            next_cursor = encode_cursor({"o": offset + len(rows)}, query) if has_more else None
         
-        try:
-            request = json.loads(post_data.decode('utf-8'))
-            response = self.mcp_server.handle_request(request)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
+        if format == 'columnar':
+            payload = {"columns": columns, "rows": [list(row) for row in rows], "next_cursor": next_cursor}
+        else:
+            payload = [dict(row) for row in rows]
+        return wire.structured(payload, _meta={"row_count": len(rows), "next_cursor": next_cursor})
     
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
+    def stream_query(self, query, format):
+        """NDJSON lines: the column names, one line per row, then a summary.
+
+        Streams longer than DB_STREAM_MAX_SECONDS or DB_STREAM_MAX_ROWS end
+        early with "truncated" in the summary; page with a key to read on.
+        """
+        batches = self.engine.iterate(query, batch_size=STREAM_BATCH_SIZE)
+        # Runs the statement now so SQL errors are reported before streaming starts
+        columns = next(batches)
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        
+        def lines():
+            row_count = 0
+            try:
+                yield {"columns": columns}
+                for batch in batches:
+                    for row in batch:
+                        yield list(row) if format == 'columnar' else dict(row)
+                    row_count += len(batch)
+                    # Checked per batch, so a slow reader cannot pin the snapshot
+                    if row_count >= STREAM_MAX_ROWS or time.monotonic() > deadline:
+                        yield {"done": False, "truncated": True, "row_count": row_count}
+                        return
+                yield {"done": True, "row_count": row_count}
+            finally:
+                batches.close()
+        
+        return lines()
 
 if __name__ == "__main__":
     server = SQLiteMCP()
     
+    coalesced = ToolCallCoalescer(server)
+    
     def handler(*args, **kwargs):
-        MCPHandler(server, *args, **kwargs)
+        MCPHandler(coalesced, *args, **kwargs)
     
-    httpd = HTTPServer(('0.0.0.0', 8000), handler)
-    print("Database MCP Server running on port 8000")
-    httpd.serve_forever()
\ No newline at end of file
+    serve(handler, "Database MCP Server")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import os
+import random
+import threading
+import time
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+from common import metrics
+
+HTTP_GONE = 410
+
+INFORMER_EVENTS = metrics.counter('k8s_informer_events', 'Watch events applied to informer caches',
+                                  ('informer', 'type'))
+INFORMER_RELISTS = metrics.counter('k8s_informer_relists', 'Full lists performed by informers', ('informer',))
+INFORMER_AGE = metrics.gauge('k8s_informer_age_seconds', 'Seconds since the informer last heard from the API server',
+                             ('informer',))
+INFORMER_OBJECTS = metrics.gauge('k8s_informer_objects', 'Objects held in the informer cache', ('informer',))
+
+
+class Informer:
+    """Local cache of one resource kind, kept current by a watch stream.
+
+    The cache is filled with a full list, then follows the watch from the
+    list's resourceVersion. A 410 Gone (history compacted) or a periodic
+    resync triggers a fresh list. `watch_factory` is injectable so the cache
+    can be driven by a fake stream in tests.
+    """
+
+    def __init__(self, name, list_fn, key_fn, watch_factory=watch.Watch,
+                 resync_period: float = None, watch_timeout: int = None):
+        self.name = name
+        self.list_fn = list_fn
+        self.key_fn = key_fn
+        self.watch_factory = watch_factory
+        self.resync_period = resync_period or float(os.getenv('K8S_INFORMER_RESYNC_SECONDS', '300'))
+        self.watch_timeout = watch_timeout or int(os.getenv('K8S_INFORMER_WATCH_TIMEOUT', '60'))
+        self.resource_version = None
+        self.last_list = None
+        self.last_heartbeat = None
+        self.watch_healthy = False
+        self.relists = 0
+        self._store = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._watch = None
+        INFORMER_AGE.labels(name).set_function(
+            lambda: time.time() - self.last_heartbeat if self.last_heartbeat else -1)
+        INFORMER_OBJECTS.labels(name).set_function(lambda: len(self._store))
+
+    def start(self):
+        threading.Thread(target=self.run, name=f'informer-{self.name}', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch:
+            self._watch.stop()
+
+    def wait_for_sync(self, timeout: float = None) -> bool:
+        return self._synced.wait(timeout)
+
+    @property
+    def synced(self) -> bool:
+        return self._synced.is_set()
+
+    def list(self):
+        with metrics.upstream('kubernetes', f'list_{self.name}'):
+            result = self.list_fn()
+        store = {self.key_fn(obj): obj for obj in result.items}
+        now = time.time()
+        with self._lock:
+            self._store = store
+            self.resource_version = result.metadata.resource_version
+            self.last_list = self.last_heartbeat = now
+        self.relists += 1
+        INFORMER_RELISTS.labels(self.name).inc()
+        self.watch_healthy = True
+        self._synced.set()
+
+    def apply(self, event):
+        kind = event['type']
+        INFORMER_EVENTS.labels(self.name, kind).inc()
+        if kind == 'ERROR':
+            raw = event.get('raw_object') or {}
+            raise ApiException(status=raw.get('code', 500), reason=raw.get('message', 'watch error'))
+
+        obj = event['object']
+        with self._lock:
+            if kind == 'ADDED' or kind == 'MODIFIED':
+                self._store[self.key_fn(obj)] = obj
+            elif kind == 'DELETED':
+                self._store.pop(self.key_fn(obj), None)
+            # BOOKMARK events only advance the resourceVersion
+            self.resource_version = obj.metadata.resource_version
+            self.last_heartbeat = time.time()
+
+    def watch_once(self):
+        """Follow the watch until it times out or a resync is due"""
+        self._watch = self.watch_factory()
+        stream = self._watch.stream(
+            self.list_fn,
+            resource_version=self.resource_version,
+            timeout_seconds=self.watch_timeout,
+            allow_watch_bookmarks=True
+        )
+        for event in stream:
+            self.apply(event)
+            self.watch_healthy = True
+            if self._stopped.is_set() or time.time() - self.last_list >= self.resync_period:
+                self._watch.stop()
+                break
+        else:
+            # A watch that ends cleanly confirms nothing changed since the last event
+            with self._lock:
+                self.last_heartbeat = time.time()
+        self.watch_healthy = True
+
+    def run(self):
+        backoff = 1.0
+        while not self._stopped.is_set():
+            try:
+                if self.resource_version is None or time.time() - self.last_list >= self.resync_period:
+                    self.list()
+                self.watch_once()
+                backoff = 1.0
+                continue
+            except ApiException as e:
+                self.watch_healthy = False
+                if e.status == HTTP_GONE:
+                    # Our resourceVersion was compacted away; relist
+                    self.resource_version = None
+                    continue
+                print(f"Informer {self.name} error: {e}")
+            except Exception as e:
+                self.watch_healthy = False
+                print(f"Informer {self.name} error: {e}")
+            self._stopped.wait(backoff + random.uniform(0, backoff))
+            backoff = min(backoff * 2, 30.0)
+
+    def get(self, key):
+        with self._lock:
+            return self._store.get(key)
+
+    def items(self, predicate=None):
+        with self._lock:
+            objs = list(self._store.values())
+        return [obj for obj in objs if predicate is None or predicate(obj)]
+
+    def staleness(self) -> dict:
+        """How current the cache is, for inclusion in tool responses"""
+        return {
+            "source": "informer",
+            "resource_version": self.resource_version,
+            "age_seconds": round(time.time() - self.last_heartbeat, 3) if self.last_heartbeat else None,
+            "watch_healthy": self.watch_healthy
+        }
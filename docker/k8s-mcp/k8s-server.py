@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
-import json
+import os
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from common import metrics, wire
+from common.server import MCPHandler, serve
+from common.singleflight import ToolCallCoalescer
+from common.tools import ToolRegistry
+from informer import Informer
 
 class KubernetesMCP:
+    tools = ToolRegistry()
+    
+    # Reads are served from the informer caches, so read-only tools set no cache_ttl
     def __init__(self):
         try:
             config.load_incluster_config()
@@ -17,84 +24,38 @@ class KubernetesMCP:
         self.v1 = client.CoreV1Api()
         self.apps_v1 = client.AppsV1Api()
         self.autoscaling_v1 = client.AutoscalingV1Api()
+        
+        # Watch-fed caches for reads; K8S_INFORMER=off queries the API server directly
+        self.pods = self.nodes = None
+        if os.getenv('K8S_INFORMER', 'on') != 'off':
+            self.pods = Informer('pods', self.v1.list_pod_for_all_namespaces,
+                                 lambda pod: (pod.metadata.namespace, pod.metadata.name)).start()
+            self.nodes = Informer('nodes', self.v1.list_node,
+                                  lambda node: node.metadata.name).start()
+    
+    @staticmethod
+    def cached(informer):
+        """The informer if it has completed its initial list, else None"""
+        return informer if informer and informer.synced else None
     
     def handle_request(self, request):
-        method = request.get('method')
-        params = request.get('params', {})
-        
-        if method == 'tools/list':
-            return {
-                "tools": [
-                    {
-                        "name": "list_pods",
-                        "description": "List pods in a namespace",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "namespace": {"type": "string", "default": "default"}
-                            }
-                        }
-                    },
-                    {
-                        "name": "scale_deployment",
-                        "description": "Scale a deployment",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "deployment_name": {"type": "string"},
-                                "namespace": {"type": "string", "default": "default"},
-                                "replicas": {"type": "integer"}
-                            },
-                            "required": ["deployment_name", "replicas"]
-                        }
-                    },
-                    {
-                        "name": "get_cluster_status",
-                        "description": "Get cluster health status",
-                        "inputSchema": {"type": "object", "properties": {}}
-                    },
-                    {
-                        "name": "troubleshoot_pod",
-                        "description": "Analyze pod issues",
-                        "inputSchema": {
-                            "type": "object",
-                            "properties": {
-                                "pod_name": {"type": "string"},
-                                "namespace": {"type": "string", "default": "default"}
-                            },
-                            "required": ["pod_name"]
-                        }
-                    }
-                ]
-            }
-        
-        elif method == 'tools/call':
-            tool_name = params.get('name')
-            args = params.get('arguments', {})
-            
-            if tool_name == 'list_pods':
-                return self.list_pods(args.get('namespace', 'default'))
-            elif tool_name == 'scale_deployment':
-                return self.scale_deployment(
-                    args['deployment_name'],
-                    args.get('namespace', 'default'),
-                    args['replicas']
-                )
-            elif tool_name == 'get_cluster_status':
-                return self.get_cluster_status()
-            elif tool_name == 'troubleshoot_pod':
-                return self.troubleshoot_pod(
-                    args['pod_name'],
-                    args.get('namespace', 'default')
-                )
-        
-        return {"error": "Unknown method"}
+        return self.tools.handle(self, request)
     
+    @tools.tool("List pods in a namespace", {
+        "namespace": {"type": "string", "default": "default"}
+    }, read_only=True)
     def list_pods(self, namespace):
         try:
-            pods = self.v1.list_namespaced_pod(namespace)
+            if self.cached(self.pods):
+                pods = self.pods.items(lambda pod: pod.metadata.namespace == namespace)
+                pods.sort(key=lambda pod: pod.metadata.name)
+                cache = self.pods.staleness()
+            else:
+                with metrics.upstream('kubernetes', 'list_namespaced_pod'):
+                    pods = self.v1.list_namespaced_pod(namespace).items
+                cache = {"source": "api"}
             pod_list = []
-            for pod in pods.items:
+            for pod in pods:
                 pod_info = {
                     "name": pod.metadata.name,
                     "status": pod.status.phase,
@@ -103,43 +64,68 @@ class KubernetesMCP:
                 }
                 pod_list.append(pod_info)
             
-            return {"content": [{"type": "text", "text": json.dumps(pod_list, indent=2)}]}
+            return wire.structured(pod_list, _meta={"cache": cache})
         except ApiException as e:
             return {"error": f"Kubernetes API error: {e}"}
     
+    @tools.tool("Scale a deployment", {
+        "deployment_name": {"type": "string"},
+        "namespace": {"type": "string", "default": "default"},
+        "replicas": {"type": "integer"}
+    }, required=["deployment_name", "replicas"])
     def scale_deployment(self, deployment_name, namespace, replicas):
         try:
-            deployment = self.apps_v1.read_namespaced_deployment(deployment_name, namespace)
+            with metrics.upstream('kubernetes', 'read_namespaced_deployment'):
+                deployment = self.apps_v1.read_namespaced_deployment(deployment_name, namespace)
             deployment.spec.replicas = replicas
             
-            self.apps_v1.patch_namespaced_deployment(
-                name=deployment_name,
-                namespace=namespace,
-                body=deployment
-            )
+            with metrics.upstream('kubernetes', 'patch_namespaced_deployment'):
+                self.apps_v1.patch_namespaced_deployment(
+                    name=deployment_name,
+                    namespace=namespace,
+                    body=deployment
+                )
             
             return {"content": [{"type": "text", "text": f"Scaled {deployment_name} to {replicas} replicas"}]}
         except ApiException as e:
             return {"error": f"Could not scale deployment: {e}"}
     
+    @tools.tool("Get cluster health status", read_only=True)
     def get_cluster_status(self):
         try:
-            nodes = self.v1.list_node()
+            if self.cached(self.nodes):
+                nodes = sorted(self.nodes.items(), key=lambda node: node.metadata.name)
+                cache = self.nodes.staleness()
+            else:
+                with metrics.upstream('kubernetes', 'list_node'):
+                    nodes = self.v1.list_node().items
+                cache = {"source": "api"}
             node_status = []
-            for node in nodes.items:
+            for node in nodes:
                 conditions = {c.type: c.status for c in node.status.conditions or []}
                 node_status.append({
                     "name": node.metadata.name,
                     "ready": conditions.get("Ready", "Unknown")
                 })
             
-            return {"content": [{"type": "text", "text": json.dumps(node_status, indent=2)}]}
+            return wire.structured(node_status, _meta={"cache": cache})
         except ApiException as e:
             return {"error": f"Could not get cluster status: {e}"}
     
+    @tools.tool("Analyze pod issues", {
+        "pod_name": {"type": "string"},
+        "namespace": {"type": "string", "default": "default"}
+    }, required=["pod_name"], read_only=True)
     def troubleshoot_pod(self, pod_name, namespace):
         try:
-            pod = self.v1.read_namespaced_pod(pod_name, namespace)
+            pod = self.pods.get((namespace, pod_name)) if self.cached(self.pods) else None
+            if pod:
+                cache = self.pods.staleness()
+            else:
+                # Not cached (yet): the pod may be newer than the last watch event
+                with metrics.upstream('kubernetes', 'read_namespaced_pod'):
+                    pod = self.v1.read_namespaced_pod(pod_name, namespace)
+                cache = {"source": "api"}
             
             issues = []
             if pod.status.phase != "Running":
@@ -156,46 +142,16 @@ class KubernetesMCP:
                 "issues": issues
             }
             
-            return {"content": [{"type": "text", "text": json.dumps(troubleshoot_info, indent=2)}]}
+            return wire.structured(troubleshoot_info, _meta={"cache": cache})
         except ApiException as e:
             return {"error": f"Could not troubleshoot pod: {e}"}
 
-class MCPHandler(BaseHTTPRequestHandler):
-    def __init__(self, mcp_server, *args, **kwargs):
-        self.mcp_server = mcp_server
-        super().__init__(*args, **kwargs)
-    
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        
-        try:
-            request = json.loads(post_data.decode('utf-8'))
-            response = self.mcp_server.handle_request(request)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-    
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK')
-
 if __name__ == "__main__":
     server = KubernetesMCP()
     
+    coalesced = ToolCallCoalescer(server)
+    
     def handler(*args, **kwargs):
-        MCPHandler(server, *args, **kwargs)
+        MCPHandler(coalesced, *args, **kwargs)
     
-    httpd = HTTPServer(('0.0.0.0', 8000), handler)
-    print("Kubernetes MCP Server running on port 8000")
-    httpd.serve_forever()
\ No newline at end of file
+    serve(handler, "Kubernetes MCP Server")